@@ -1,12 +1,29 @@
 # agents/answer_processor.py - Debug Enhanced Version
+import asyncio
+import json
+import os
+import re
 from typing import Dict, List, Any
-from utils.ocr_openai import pdf_to_images, gpt4o_extract_answer_latex
-from utils.ocr_gemini import gemini_extract_answer_latex
+from utils.ocr_openai import (pdf_to_images, DEFAULT_DPI, PREVIEW_DPI, ANSWER_MAX_TOKENS, gpt4o_extract_answer_latex,
+                              gpt4o_map_answer_pages, gpt4o_extract_answer_section, answer_latex_messages, finalize_answer_latex,
+                              continue_completion)
+from utils.ocr_gemini import gemini_extract_answer_latex, gemini_map_answer_pages, gemini_extract_answer_section
+from utils.page_stats import triage_pages
+from utils.metrics import timed
+from utils.pdf_text import typed_page_items
+from utils.profiling import threaded
+from utils.prompt_cache import prefix_cacheable
+from utils.resilience import retry_allowed
+from utils.result_cache import answer_cache_key, load_answer, store_answer
+from utils.validation import validate_latex, scan_latex, question_blocks
 from .base_agent import BaseAgent, AgentResult
 
 class AnswerProcessorAgent(BaseAgent):
     def __init__(self):
         super().__init__("AnswerProcessor", ["openai_vision", "gemini_vision"])
+        self.max_parallel_sections = 4  # Concurrent section calls in chunked mode
+        self.pages_per_group = 3  # Page group size when the mapping pass fails
+        self.low_confidence = 0.5  # Progressive mode re-renders below this
         self.answer_prompt = """Create a comprehensive LaTeX document mapping student answers to questions.
 
 CRITICAL: Generate a COMPLETE document. Do not truncate or abbreviate.
@@ -55,49 +72,134 @@ CRITICAL: Ensure the output is COMPLETE and well-formed."""
             print(f"DEBUG: Processing answer sheet: {file_path}")
             print(f"DEBUG: Question text length: {len(question_text) if question_text else 0}")
             
-            # Convert PDF to images
-            image_paths = pdf_to_images(file_path)
-            print(f"DEBUG: Generated {len(image_paths)} images from answer sheet")
+            # Execution mode comes from the analyzer's strategy
+            full_dpi = strategy.get("dpi_setting", DEFAULT_DPI)
+            preprocess = strategy.get("preprocessing_needed", False)
+            multi_page_strategy = strategy.get("multi_page_strategy", "batch_process")
+            answer_mode = strategy.get("answer_mode", "single_pass")
+            if multi_page_strategy == "page_by_page_fallback":
+                # Very long scripts go straight to page groups
+                answer_mode = "chunked"
+            
+            # Progressive mode renders a cheap preview first and re-renders only what fails
+            progressive = strategy.get("render_mode") == "progressive"
+            render_dpi = min(strategy.get("preview_dpi", PREVIEW_DPI), full_dpi) if progressive else full_dpi
             
             # Choose model based on strategy
             model = strategy["recommended_model"]
             print(f"DEBUG: Using model: {model}")
+            print(f"DEBUG: Answer mode: {answer_mode}, multi-page strategy: {multi_page_strategy}")
             
-            # Create comprehensive prompt with question context
-            full_prompt = self._create_debug_prompt(question_text)
-            print(f"DEBUG: Prompt length: {len(full_prompt)}")
-            
-            # Process answers using chosen model
-            latex_output = self._process_answers_debug(image_paths, question_text, model, full_prompt)
-            print(f"DEBUG: Raw output length: {len(latex_output) if latex_output else 0}")
-            
-            if latex_output:
-                print(f"DEBUG: Output preview: {latex_output[:500]}...")
-                print(f"DEBUG: Output ending: ...{latex_output[-200:]}")
+            # A re-run of the same script against the same paper skips straight to compilation
+            use_cache = strategy.get("use_cache", True)
+            cache_key = answer_cache_key(file_path, question_text, model, "agent") if use_cache else None
+            cached = load_answer(cache_key) if cache_key else None
+            if cached:
+                validation = validate_latex(cached["latex_output"])
+                return AgentResult(
+                    success=True,
+                    data={
+                        "latex_output": cached["latex_output"],
+                        "model_used": model,
+                        "answer_mode": cached.get("answer_mode", answer_mode),
+                        "validation": validation,
+                        "cached": True,
+                        "execution": {"cached": True, "cached_at": cached.get("created")}
+                    },
+                    confidence=validation["confidence"]
+                )
             
-            # Enhanced validation
-            validation = self._enhanced_validate_latex(latex_output)
-            print(f"DEBUG: Validation result: {validation}")
-            
-            # Retry with different approach if validation fails
-            if not validation["is_valid"]:
-                print("DEBUG: First attempt failed, trying simplified approach...")
-                simplified_prompt = self._create_simplified_prompt(question_text)
-                latex_output = self._process_answers_debug(image_paths, question_text, model, simplified_prompt)
-                validation = self._enhanced_validate_latex(latex_output)
+            with timed("answer_processing", model=model, mode=answer_mode, strategy=multi_page_strategy,
+                       dpi=render_dpi, preprocessed=preprocess) as execution:
+                page_numbers, image_paths, page_report, typed_count = self._prepare_pages(
+                    file_path, render_dpi, preprocess, strategy.get("use_text_layer", True)
+                )
+                execution["typed_pages"] = typed_count
+                rerendered_pages = set()
+                
+                def rerender(indices: List[int]) -> List:
+                    """Re-render image pages (1-based indices into image_paths) at full resolution"""
+                    targets = [i for i in indices if isinstance(image_paths[i - 1], str)]
+                    pages = [page_numbers[i - 1] for i in targets]
+                    if not pages:
+                        return [image_paths[i - 1] for i in indices]
+                    rerendered_pages.update(pages)
+                    print(f"DEBUG: Re-rendering pages {pages} at {full_dpi} DPI")
+                    sharp = dict(zip(targets, pdf_to_images(file_path, dpi=full_dpi, pages=pages, preprocess=preprocess)))
+                    return [sharp.get(i, image_paths[i - 1]) for i in indices]
+                
+                can_rerender = progressive and render_dpi != full_dpi
+                
+                if answer_mode == "chunked" and len(image_paths) > 1:
+                    # Map pages to questions, then extract each group in parallel
+                    latex_output = await self._process_answers_chunked(
+                        image_paths, question_text, model, rerender if can_rerender else None
+                    )
+                else:
+                    # Create comprehensive prompt with question context
+                    full_prompt = self._create_debug_prompt(question_text)
+                    print(f"DEBUG: Prompt length: {len(full_prompt)}")
+                    
+                    # Process answers using chosen model
+                    latex_output = self._process_answers_debug(image_paths, question_text, model, full_prompt)
+                print(f"DEBUG: Raw output length: {len(latex_output) if latex_output else 0}")
+                
+                if latex_output:
+                    print(f"DEBUG: Output preview: {latex_output[:500]}...")
+                    print(f"DEBUG: Output ending: ...{latex_output[-200:]}")
+                
+                # Enhanced validation
+                validation = validate_latex(latex_output)
+                print(f"DEBUG: Validation result: {validation}")
+                
+                # A whole-document failure at preview resolution gets one full-resolution retry
+                if (can_rerender and not rerendered_pages and self._needs_higher_resolution(latex_output, validation)
+                        and retry_allowed("answers.full_resolution")):
+                    print("DEBUG: Preview extraction weak, retrying at full resolution...")
+                    image_paths = rerender(list(range(1, len(image_paths) + 1)))
+                    execution["dpi"] = full_dpi
+                    full_prompt = self._create_debug_prompt(question_text)
+                    latex_output = self._process_answers_debug(image_paths, question_text, model, full_prompt)
+                    validation = validate_latex(latex_output)
+                
+                # A failed single batch falls back to page groups when the strategy allows it
+                if (answer_mode != "chunked" and multi_page_strategy == "batch_with_page_fallback"
+                        and len(image_paths) > 1 and self._needs_higher_resolution(latex_output, validation)
+                        and retry_allowed("answers.page_groups")):
+                    print("DEBUG: Batch extraction failed, falling back to page groups...")
+                    execution["page_fallback"] = True
+                    latex_output = await self._process_answers_chunked(image_paths, question_text, model)
+                    validation = validate_latex(latex_output)
+                
+                # Retry with different approach if validation fails
+                if not validation["is_valid"] and retry_allowed("answers.simplified_prompt"):
+                    print("DEBUG: First attempt failed, trying simplified approach...")
+                    execution["simplified_retry"] = True
+                    simplified_prompt = self._create_simplified_prompt(question_text)
+                    latex_output = self._process_answers_debug(image_paths, question_text, model, simplified_prompt)
+                    validation = validate_latex(latex_output)
                 
                 if not validation["is_valid"]:
-                    print("DEBUG: Second attempt failed, creating structured fallback...")
+                    print("DEBUG: Extraction still invalid, creating structured fallback...")
                     latex_output = self._create_structured_fallback(latex_output, question_text)
                     validation = {"is_valid": True, "confidence": 0.6, "issues": ["Used structured fallback"]}
             
+            fell_back = "Used structured fallback" in validation.get("issues", [])
+            if cache_key and not fell_back and not self._needs_higher_resolution(latex_output, validation):
+                store_answer(cache_key, latex_output, model=model, answer_mode=answer_mode)
+            
             return AgentResult(
                 success=validation["is_valid"],
                 data={
                     "latex_output": latex_output,
                     "model_used": model,
+                    "answer_mode": answer_mode,
                     "validation": validation,
-                    "image_paths": image_paths
+                    "image_paths": image_paths,
+                    "page_report": page_report,
+                    "render_dpi": render_dpi,
+                    "rerendered_pages": sorted(rerendered_pages),
+                    "execution": execution
                 },
                 confidence=validation["confidence"]
             )
@@ -108,6 +210,87 @@ CRITICAL: Ensure the output is COMPLETE and well-formed."""
             traceback.print_exc()
             return AgentResult(success=False, error=str(e))
     
+    def _prepare_pages(self, file_path: str, dpi: int, preprocess: bool, use_text_layer: bool = True):
+        """Render, triage and order answer pages.
+        
+        Returns (page_numbers, image_paths, page_report, typed_count) where each item of
+        image_paths is a typed page dict or a rendered image path, in document order.
+        """
+        # Typed or tablet-exported pages are sent as text plus figure crops
+        typed_pages, total_pages = {}, 0
+        if use_text_layer:
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            typed_pages, total_pages = typed_page_items(file_path, f"tmp/{base_name}/figures")
+        scan_pages = [num for num in range(1, total_pages + 1) if num not in typed_pages]
+        
+        # Convert the remaining (handwritten or scanned) pages to images
+        if not typed_pages:
+            rendered_paths = pdf_to_images(file_path, dpi=dpi, preprocess=preprocess)
+            rendered_numbers = list(range(1, len(rendered_paths) + 1))
+        elif scan_pages:
+            rendered_paths = pdf_to_images(file_path, dpi=dpi, pages=scan_pages, preprocess=preprocess)
+            rendered_numbers = scan_pages
+        else:
+            rendered_paths, rendered_numbers = [], []
+        print(f"DEBUG: Generated {len(rendered_paths)} images and {len(typed_pages)} typed pages from answer sheet")
+        
+        # Skip blank backs of sheets before anything is uploaded
+        kept_paths, page_report = triage_pages(rendered_paths) if rendered_paths else ([], [])
+        kept_numbers = {rendered_numbers[rendered_paths.index(path)]: path for path in kept_paths}
+        
+        # Page items in document order: typed page dicts or image paths
+        page_numbers = sorted(set(typed_pages) | set(kept_numbers))
+        image_paths = [typed_pages.get(num) or kept_numbers[num] for num in page_numbers]
+        return page_numbers, image_paths, page_report, len(typed_pages)
+    
+    def build_batch_request(self, file_path: str, question_text: str, strategy: Dict[str, Any]) -> Dict[str, Any]:
+        """Prepare one student's full-document request for offline Batch API submission.
+        
+        There is no interactive retry loop in batch mode, so pages are rendered at full DPI.
+        """
+        _, image_paths, page_report, _ = self._prepare_pages(
+            file_path,
+            strategy.get("dpi_setting", DEFAULT_DPI),
+            strategy.get("preprocessing_needed", False),
+            strategy.get("use_text_layer", True)
+        )
+        prompt = self._create_debug_prompt(question_text)
+        return {
+            "messages": answer_latex_messages(image_paths, prompt),
+            "max_tokens": ANSWER_MAX_TOKENS,
+            "pages": len(image_paths),
+            "page_report": page_report
+        }
+    
+    def continue_batch_output(self, file_path: str, question_text: str, strategy: Dict[str, Any], raw_output: str) -> str:
+        """Continue a Batch API answer document cut off at max_tokens, as the interactive path does.
+        
+        The original request is rebuilt (same pages and prompt) so the continuation sees it.
+        """
+        request = self.build_batch_request(file_path, question_text, strategy)
+        return continue_completion(request["messages"], raw_output, "length", request["max_tokens"],
+                                   stream_label="batch_answer")
+    
+    def finalize_batch_output(self, raw_output: str, question_text: str) -> AgentResult:
+        """Validate a Batch API answer document the same way as an interactive one"""
+        latex_output = finalize_answer_latex(raw_output, question_text)
+        validation = validate_latex(latex_output)
+        if not validation["is_valid"]:
+            print("DEBUG: Batch output failed validation, creating structured fallback...")
+            latex_output = self._create_structured_fallback(latex_output, question_text)
+            validation = {"is_valid": True, "confidence": 0.6, "issues": ["Used structured fallback"]}
+        
+        return AgentResult(
+            success=validation["is_valid"],
+            data={
+                "latex_output": latex_output,
+                "model_used": "openai",
+                "answer_mode": "offline_batch",
+                "validation": validation
+            },
+            confidence=validation["confidence"]
+        )
+    
     def _create_debug_prompt(self, question_text: str) -> str:
         return f"""Generate a complete LaTeX document. CRITICAL: Do not truncate the output.
 
@@ -171,49 +354,211 @@ Extract ALL student work from the images and create this complete document."""
             print(f"DEBUG: Error in model processing: {e}")
             return f"Error in processing: {str(e)}"
     
-    def _enhanced_validate_latex(self, latex_output: str) -> Dict:
-        validation = {
-            "is_valid": True,
-            "should_retry": False,
-            "confidence": 0.9,
-            "issues": []
-        }
+    def _needs_higher_resolution(self, latex_output: str, validation: Dict) -> bool:
+        """Invalid, low-confidence or provider-fallback output is worth a sharper render"""
+        if not validation["is_valid"] or validation["confidence"] < self.low_confidence:
+            return True
+        # Provider functions wrap failed generations in their own fallback document
+        return scan_latex(latex_output)["fallback_document"]
+    
+    async def _process_answers_chunked(self, image_paths: List[str], question_text: str, model: str, rerender=None) -> str:
+        """Extract answers per page group with small prompts and merge into one document.
+        
+        When rerender is given, groups whose section fails validation are re-rendered at
+        full resolution and extracted again; other groups keep their preview result.
+        """
+        questions = self._split_questions(question_text)
+        page_map = self._map_pages_to_questions(image_paths, questions, model)
+        groups = self._build_page_groups(page_map, questions, len(image_paths))
+        print(f"DEBUG: Chunked mode: {len(groups)} groups from {len(image_paths)} pages")
+        
+        semaphore = asyncio.Semaphore(self.max_parallel_sections)
+        
+        # One prefix for every group and every student sharing this question paper, as long as a
+        # provider cache serves it; otherwise each group sends only its own questions
+        context = self._create_section_context(question_text)
+        if not prefix_cacheable(context, model):
+            print("DEBUG: Question paper prefix not cached, sending each group its own questions")
+            context = None
+        
+        async def run_group(group: Dict) -> str:
+            group_images = [image_paths[page - 1] for page in group["pages"]]
+            if context:
+                prompt = self._create_section_prompt(group)
+            else:
+                prompt = self._create_standalone_section_prompt(group, questions, question_text)
+            async with semaphore:
+                return await asyncio.to_thread(threaded(self._extract_section), group_images, model, prompt, context)
+        
+        sections = await asyncio.gather(*(run_group(group) for group in groups))
+        
+        failed = [i for i, section in enumerate(sections) if not self._is_valid_section(section)]
+        if rerender and failed and retry_allowed("answers.section_rerender"):
+            print(f"DEBUG: {len(failed)} of {len(groups)} groups failed at preview resolution")
+            failed_pages = sorted({page for i in failed for page in groups[i]["pages"]})
+            sharp_paths = dict(zip(failed_pages, rerender(failed_pages)))
+            for page, path in sharp_paths.items():
+                image_paths[page - 1] = path
+            retried = await asyncio.gather(*(run_group(groups[i]) for i in failed))
+            for i, section in zip(failed, retried):
+                sections[i] = section
+        
+        return self._merge_sections(groups, sections)
+    
+    def _is_valid_section(self, section: str) -> bool:
+        """A usable section has some content and at least one answer block"""
+        if not section or len(section.strip()) < 80:
+            return False
+        return "Student Answer" in section or "\\subsection" in section
+    
+    def _split_questions(self, question_text: str) -> Dict[str, str]:
+        """Split extracted question text into blocks keyed by question number"""
+        return question_blocks(question_text) if question_text else {}
+    
+    def _map_pages_to_questions(self, image_paths: List[str], questions: Dict[str, str], model: str) -> Dict[str, List[int]]:
+        """Cheap pass that returns {question_number: [page numbers]}"""
+        if not questions:
+            return {}
+        
+        # Stable prefix first so it is cached across students; the page count varies
+        question_index = "\n".join(text.split("\n")[0][:150] for text in questions.values())
+        context = f"""For each question below, list the page numbers of the student answer sheet where the student wrote an answer to it.
+
+QUESTIONS:
+{question_index}
+
+Respond with ONLY a JSON object mapping question numbers to page number lists, for example:
+{{"1": [1], "2": [1, 2], "3": [3]}}
+Omit questions that were not answered."""
+        prompt = f"You are given {len(image_paths)} pages of a student answer sheet, in order, numbered 1 to {len(image_paths)}."
+        
+        try:
+            if model == "gemini":
+                raw = gemini_map_answer_pages(image_paths, prompt, context)
+            else:
+                raw = gpt4o_map_answer_pages(image_paths, prompt, context)
+            
+            json_match = re.search(r'\{.*\}', raw or "", re.DOTALL)
+            if not json_match:
+                print("DEBUG: Page mapping returned no JSON")
+                return {}
+            
+            page_map = {}
+            for number, pages in json.loads(json_match.group(0)).items():
+                valid_pages = sorted({int(p) for p in pages if 1 <= int(p) <= len(image_paths)})
+                if valid_pages:
+                    page_map[str(number)] = valid_pages
+            
+            print(f"DEBUG: Page mapping: {page_map}")
+            return page_map
+            
+        except Exception as e:
+            print(f"DEBUG: Page mapping failed: {e}")
+            return {}
+    
+    def _build_page_groups(self, page_map: Dict[str, List[int]], questions: Dict[str, str], num_pages: int) -> List[Dict]:
+        """Group questions that share the same pages so each page set is sent once"""
+        groups = {}
+        for number, pages in page_map.items():
+            groups.setdefault(tuple(pages), []).append(number)
+        
+        # Pages the mapping did not assign go out as unlabelled groups
+        mapped_pages = {page for pages in page_map.values() for page in pages}
+        unmapped = [page for page in range(1, num_pages + 1) if page not in mapped_pages]
+        for i in range(0, len(unmapped), self.pages_per_group):
+            groups.setdefault(tuple(unmapped[i:i + self.pages_per_group]), [])
         
-        if not latex_output or len(latex_output.strip()) < 100:
-            validation["is_valid"] = False
-            validation["should_retry"] = True
-            validation["confidence"] = 0.1
-            validation["issues"].append("Output too short")
-            return validation
-        
-        # Check for LaTeX structure
-        required_elements = [
-            ("\\documentclass", "Missing \\documentclass"),
-            ("\\begin{document}", "Missing \\begin{document}"),
-            ("\\end{document}", "Missing \\end{document}")
-        ]
-        
-        for element, error_msg in required_elements:
-            if element not in latex_output:
-                validation["is_valid"] = False
-                validation["confidence"] = 0.3
-                validation["issues"].append(error_msg)
-        
-        # Check for content between begin and end document
-        import re
-        doc_match = re.search(r'\\begin\{document\}(.*?)\\end\{document\}', latex_output, re.DOTALL)
-        if doc_match:
-            content = doc_match.group(1).strip()
-            if len(content) < 50:
-                validation["is_valid"] = False
-                validation["confidence"] = 0.4
-                validation["issues"].append("Insufficient content in document")
+        ordered = sorted(groups.items(), key=lambda item: item[0][0])
+        return [{"pages": list(pages), "questions": numbers} for pages, numbers in ordered]
+    
+    def _create_section_context(self, question_text: str) -> str:
+        """Instructions plus the full question paper, identical for every group and student"""
+        return f"""Extract student answers from the answer sheet pages provided.
+
+{self._section_instructions()}
+
+QUESTION PAPER:
+{question_text if question_text else "No questions provided"}"""
+    
+    def _create_standalone_section_prompt(self, group: Dict, questions: Dict[str, str], question_text: str) -> str:
+        """Complete prompt for one group, carrying only its own questions, for when no prefix is cached"""
+        if group["questions"]:
+            group_questions = "\n\n".join(questions[number] for number in group["questions"] if number in questions)
+            scope = f"Questions {', '.join(group['questions'])}"
         else:
-            validation["is_valid"] = False
-            validation["confidence"] = 0.2
-            validation["issues"].append("Cannot find document content")
+            # Unmapped pages may answer anything, so give the model the full paper
+            group_questions = question_text if question_text else "No questions provided"
+            scope = "whichever questions appear on these pages"
+        
+        return f"""Extract the student's answers for {scope} from the answer sheet pages provided.
+
+{self._section_instructions()}
+
+QUESTIONS:
+{group_questions}"""
+    
+    def _section_instructions(self) -> str:
+        """Output format and rules shared by the cached prefix and standalone section prompts"""
+        return """Output ONLY LaTeX body content (no \\documentclass, no \\begin{document}), one block per question:
+
+\\subsection*{Question N}
+\\textbf{Question:} [Question text]
+
+\\textbf{Student Answer:}
+\\begin{quote}
+[Student response exactly as written]
+\\end{quote}
+
+EXTRACTION RULES:
+- Extract ALL student handwriting on these pages
+- Include calculations, diagrams (describe as "Student drew: ...")
+- Do NOT correct or summarize the student's work"""
+    
+    def _create_section_prompt(self, group: Dict) -> str:
+        """Per-group suffix naming the questions expected on these pages"""
+        if group["questions"]:
+            return f"Extract the student's answers for Questions {', '.join(group['questions'])} from the pages below."
+        # Unmapped pages may answer anything
+        return "Extract the student's answers for whichever questions appear on the pages below."
+    
+    def _extract_section(self, image_paths: List[str], model: str, prompt: str, context: str = None) -> str:
+        try:
+            if model == "gemini":
+                return gemini_extract_answer_section(image_paths, prompt, context=context)
+            return gpt4o_extract_answer_section(image_paths, prompt, context=context)
+        except Exception as e:
+            print(f"DEBUG: Error in section extraction: {e}")
+            return ""
+    
+    def _merge_sections(self, groups: List[Dict], sections: List[str]) -> str:
+        """Merge per-group LaTeX bodies into one complete document"""
+        bodies = []
+        for group, section in zip(groups, sections):
+            # Drop any document wrapper the model added despite instructions
+            body = re.sub(r'\\documentclass.*?\\begin\{document\}', '', section or "", flags=re.DOTALL)
+            body = body.replace("\\end{document}", "").replace("\\maketitle", "").strip()
+            if not body:
+                pages = ", ".join(str(page) for page in group["pages"])
+                body = f"\\subsection*{{Pages {pages}}}\nNo content could be extracted from these pages."
+            bodies.append(body)
         
-        return validation
+        merged_body = "\n\n\\vspace{0.5cm}\n\n".join(bodies)
+        return f"""\\documentclass[12pt]{{article}}
+\\usepackage{{amsmath, amssymb, geometry, enumitem}}
+\\usepackage[utf8]{{inputenc}}
+\\geometry{{margin=1in}}
+
+\\begin{{document}}
+\\title{{Student Answer Sheet Analysis}}
+\\author{{Automated Processing System}}
+\\date{{\\today}}
+\\maketitle
+
+\\section*{{Questions and Student Responses}}
+
+{merged_body}
+
+\\end{{document}}"""
     
     def _create_structured_fallback(self, original_output: str, question_text: str) -> str:
         """Create a well-structured fallback document"""
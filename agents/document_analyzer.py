@@ -4,8 +4,17 @@ import os
 from typing import Dict, List, Any
 from pdf2image import convert_from_path
 from PIL import Image
+from utils.page_stats import get_page_stats, BLANK_INK_RATIO, SPARSE_INK_RATIO
 from .base_agent import BaseAgent, AgentResult
 
+# Thresholds for the measured page signals (pages analysed at 150 DPI, downsampled)
+BLUR_LOW_VARIANCE = 40.0
+BLUR_SHARP_VARIANCE = 150.0
+LOW_CONTRAST = 60.0
+GOOD_CONTRAST = 120.0
+DENSE_INK_RATIO = 0.08
+SKEW_LIMIT_DEGREES = 1.5
+
 class DocumentAnalyzerAgent(BaseAgent):
     def __init__(self):
         super().__init__("DocumentAnalyzer", ["pdf_reader", "image_converter"])
@@ -53,15 +62,23 @@ class DocumentAnalyzerAgent(BaseAgent):
             # Analyze first page in detail
             first_page = images[0]
             
+            # Measure every analysed page once; the stats are cached per page
+            mtime = os.path.getmtime(file_path)
+            page_stats = [
+                get_page_stats(image, cache_key=(os.path.abspath(file_path), mtime, page_num, 150))
+                for page_num, image in enumerate(images, 1)
+            ]
+            
             # Enhanced analysis based on research factors
             analysis = {
                 "file_size_mb": round(os.path.getsize(file_path) / (1024*1024), 2),
                 "image_dimensions": first_page.size,
                 "total_pages": total_pages,
                 "pages_analyzed": len(images),
-                "image_quality": self._assess_image_quality(first_page),
-                "complexity": self._assess_document_complexity_multipage(images),
-                "text_density": self._estimate_text_density_multipage(images),
+                "page_stats": page_stats,
+                "image_quality": self._assess_image_quality(first_page, page_stats[0]),
+                "complexity": self._assess_document_complexity_multipage(page_stats),
+                "text_density": self._estimate_text_density_multipage(page_stats),
                 "document_type_confidence": self._assess_document_type_confidence(images),
                 "has_handwriting": True,  # Assume true for exam sheets
                 "confidence": 0.85
@@ -75,6 +92,9 @@ class DocumentAnalyzerAgent(BaseAgent):
             print(f"   • Quality: {analysis['image_quality']}")
             print(f"   • Complexity: {analysis['complexity']}")
             print(f"   • Text Density: {analysis['text_density']}")
+            for page_num, stats in enumerate(page_stats, 1):
+                print(f"   • Page {page_num}: ink {stats['ink_ratio']:.3f}, contrast {stats['contrast']:.0f}, "
+                      f"blur {stats['blur_variance']:.0f}, skew {stats['skew_degrees']:+.2f}°")
             
             return analysis
             
@@ -92,17 +112,24 @@ class DocumentAnalyzerAgent(BaseAgent):
             print(f"⚠️ Could not count pages: {e}")
             return 1
     
-    def _assess_document_complexity_multipage(self, images: List[Image.Image]) -> str:
-        """Assess document complexity across multiple pages"""
+    def _assess_document_complexity_multipage(self, page_stats: List[Dict]) -> str:
+        """Assess document complexity across multiple pages from measured page signals"""
         complexities = []
         
-        for i, image in enumerate(images):
-            width, height = image.size
+        for stats in page_stats:
+            if stats["ink_ratio"] < BLANK_INK_RATIO:
+                continue
             
-            # Analyze each page
-            if width > 2500 and height > 3000:
+            # Skewed, blurry or densely written pages are harder to read
+            difficult = (abs(stats["skew_degrees"]) > SKEW_LIMIT_DEGREES
+                         or stats["blur_variance"] < BLUR_LOW_VARIANCE
+                         or stats["ink_ratio"] > DENSE_INK_RATIO)
+            easy = (stats["ink_ratio"] < SPARSE_INK_RATIO * 2
+                    and stats["blur_variance"] > BLUR_SHARP_VARIANCE)
+            
+            if difficult:
                 complexities.append("high")
-            elif width < 1200 or height < 1500:
+            elif easy:
                 complexities.append("low")
             else:
                 complexities.append("medium")
@@ -110,34 +137,27 @@ class DocumentAnalyzerAgent(BaseAgent):
         # Determine overall complexity
         if "high" in complexities:
             return "high"
-        elif all(c == "low" for c in complexities):
+        elif complexities and all(c == "low" for c in complexities):
             return "low"
         else:
             return "medium"
     
-    def _estimate_text_density_multipage(self, images: List[Image.Image]) -> str:
-        """Estimate text density across multiple pages"""
+    def _estimate_text_density_multipage(self, page_stats: List[Dict]) -> str:
+        """Estimate text density across multiple pages from ink coverage"""
         densities = []
         
-        for image in images:
-            width, height = image.size
-            
-            try:
-                gray = image.convert('L')
-                # Simple estimation based on image size and analysis
-                if width * height > 3000000:
-                    densities.append("high")
-                elif width * height < 1000000:
-                    densities.append("low")
-                else:
-                    densities.append("medium")
-            except:
+        for stats in page_stats:
+            if stats["ink_ratio"] > DENSE_INK_RATIO:
+                densities.append("high")
+            elif stats["ink_ratio"] < SPARSE_INK_RATIO * 2:
+                densities.append("low")
+            else:
                 densities.append("medium")
         
         # Determine overall density
         if "high" in densities:
             return "high"
-        elif all(d == "low" for d in densities):
+        elif densities and all(d == "low" for d in densities):
             return "low"
         else:
             return "medium"
@@ -151,14 +171,20 @@ class DocumentAnalyzerAgent(BaseAgent):
         else:
             return 0.8
     
-    def _assess_image_quality(self, image: Image.Image) -> str:
-        """Assess image quality based on resolution and clarity"""
+    def _assess_image_quality(self, image: Image.Image, stats: Dict) -> str:
+        """Assess image quality from resolution, contrast and sharpness"""
         width, height = image.size
         total_pixels = width * height
         
-        if total_pixels < 500000:  # Less than 0.5MP
+        if stats["ink_ratio"] < BLANK_INK_RATIO:
+            # Nothing written to measure; fall back to resolution alone
+            return "low" if total_pixels < 500000 else "medium"
+        
+        if (total_pixels < 500000  # Less than 0.5MP
+                or stats["contrast"] < LOW_CONTRAST
+                or stats["blur_variance"] < BLUR_LOW_VARIANCE):
             return "low"
-        elif total_pixels > 4000000:  # More than 4MP
+        elif stats["blur_variance"] > BLUR_SHARP_VARIANCE and stats["contrast"] > GOOD_CONTRAST:
             return "high"
         else:
             return "medium"
@@ -172,6 +198,8 @@ class DocumentAnalyzerAgent(BaseAgent):
             "preprocessing_needed": False,
             "retry_strategy": "fallback_model",
             "multi_page_strategy": "batch_process",  # New field
+            "answer_mode": "single_pass",
+            "render_mode": "progressive",  # Preview DPI first, full DPI only for failures
             "reasoning": []
         }
         
@@ -213,11 +241,19 @@ class DocumentAnalyzerAgent(BaseAgent):
             strategy["recommended_model"] = "gemini"
             strategy["reasoning"].append("Poor image quality: Gemini handles noise better")
             strategy["dpi_setting"] = 400  # Higher DPI for poor quality
+            strategy["render_mode"] = "fixed"  # A low-DPI preview would just fail first
             
         elif analysis.get("image_quality") == "high" and total_pages <= 5:
             strategy["recommended_model"] = "openai"
             strategy["reasoning"].append("High quality images: OpenAI maximizes detail extraction")
         
+        page_stats = analysis.get("page_stats", [])
+        if any(stats["ink_ratio"] >= BLANK_INK_RATIO
+               and (abs(stats["skew_degrees"]) > SKEW_LIMIT_DEGREES or stats["contrast"] < LOW_CONTRAST)
+               for stats in page_stats):
+            strategy["preprocessing_needed"] = True
+            strategy["reasoning"].append("Skewed or low-contrast pages: preprocessing recommended")
+        
         # 4. COMPLEXITY AND DENSITY (Detailed Factor)
         complexity = analysis.get("complexity", "medium")
         text_density = analysis.get("text_density", "medium")
@@ -246,10 +282,15 @@ class DocumentAnalyzerAgent(BaseAgent):
             if strategy["recommended_model"] == "openai" and total_pages > 8:
                 strategy["multi_page_strategy"] = "batch_with_page_fallback"
                 strategy["reasoning"].append("OpenAI with page-by-page fallback for reliability")
-            elif strategy["recommended_model"] == "gemini":
+            elif strategy["recommended_model"] == "gemini" and strategy["multi_page_strategy"] != "page_by_page_fallback":
                 strategy["multi_page_strategy"] = "batch_process"
                 strategy["reasoning"].append("Gemini batch processing for efficiency")
         
+        # 8. ANSWER CHUNKING (long scripts truncate in a single request)
+        if file_type == "answer_sheet" and total_pages >= 4:
+            strategy["answer_mode"] = "chunked"
+            strategy["reasoning"].append(f"Long answer script ({total_pages} pages): per-question chunked extraction")
+        
         return strategy
     
     def _print_selection_reasoning(self, strategy: Dict, analysis: Dict, file_type: str):
@@ -260,6 +301,8 @@ class DocumentAnalyzerAgent(BaseAgent):
         
         print(f"🤖 Model Selection: {selected_model.upper()}")
         print(f"📄 Multi-page Strategy: {strategy.get('multi_page_strategy', 'standard')}")
+        print(f"🧩 Answer Mode: {strategy.get('answer_mode', 'single_pass')}")
+        print(f"🖼️ Render Mode: {strategy.get('render_mode', 'fixed')}")
         print(f"🧠 Selection Reasoning:")
         
         if reasoning:
@@ -4,6 +4,7 @@ import os
 import re
 from typing import Dict, Any
 from .base_agent import BaseAgent, AgentResult
+from utils.latex_lint import lint_latex
 
 class LatexCompilerAgent(BaseAgent):
     def __init__(self):
@@ -15,8 +16,13 @@ class LatexCompilerAgent(BaseAgent):
             output_folder = task["output_folder"]
             filename = task["filename"]
             
-            # Clean LaTeX content
-            cleaned_latex = self._clean_latex_output(latex_content)
+            # Clean LaTeX content (already-cleaned sources are recompiled as they are)
+            cleaned_latex = latex_content if task.get("skip_clean") else self._clean_latex_output(latex_content)
+            
+            # Repair what would make the first pdflatex run fail
+            cleaned_latex, lint_issues = lint_latex(cleaned_latex)
+            if lint_issues:
+                print(f"DEBUG: LaTeX lint fixed {filename}: {'; '.join(lint_issues)}")
             
             # Write LaTeX file
             tex_path = os.path.join(output_folder, f"{filename}.tex")
@@ -34,6 +40,7 @@ class LatexCompilerAgent(BaseAgent):
                     f.write(fixed_latex)
                 
                 compilation_result = self._compile_latex(tex_path, output_folder)
+                cleaned_latex = fixed_latex
             
             pdf_path = os.path.join(output_folder, f"{filename}.pdf")
             
@@ -42,7 +49,9 @@ class LatexCompilerAgent(BaseAgent):
                 data={
                     "pdf_path": pdf_path if compilation_result["success"] else None,
                     "tex_path": tex_path,
+                    "latex_source": cleaned_latex,
                     "compilation_log": compilation_result["log"],
+                    "lint_issues": lint_issues,
                     "filename": f"{filename}.pdf" if compilation_result["success"] else None
                 },
                 confidence=1.0 if compilation_result["success"] else 0.0
@@ -1,13 +1,26 @@
 # agents/orchestrator.py
+import asyncio
 import os
 import shutil
-from typing import Dict, Any
+import time
+from typing import Dict, Any, List
 from datetime import datetime
 from .base_agent import BaseAgent, AgentResult
 from .document_analyzer import DocumentAnalyzerAgent
 from .question_extractor import QuestionExtractorAgent
 from .answer_processor import AnswerProcessorAgent
 from .latex_compiler import LatexCompilerAgent
+from utils.artifacts import JobArtifacts, new_job_id
+from utils.checkpoints import CheckpointStore, run_id_for, student_key
+from utils.metrics import timed
+from utils.profiling import profile_workflow
+from utils.resilience import retry_allowed, retry_budget
+from utils.result_cache import answer_cache_key, load_answer, store_answer
+from utils.openai_batch import build_batch_line, write_batch_files, submit_batch, get_batch, is_batch_finished, download_batch_results
+
+# Offline batch mode: how often to poll and how long to wait for the provider
+BATCH_POLL_SECONDS = 60
+BATCH_TIMEOUT_SECONDS = 26 * 3600
 
 class ExamProcessingOrchestrator:
     def __init__(self):
@@ -20,9 +33,40 @@ class ExamProcessingOrchestrator:
         self.workflow_state = {}
         self.max_retries = 2
     
-    async def process_exam_documents(self, question_pdf: str, answer_pdf: str, output_folder: str, selected_model: str = "gemini") -> Dict[str, Any]:
-        """Main orchestration method that coordinates all agents"""
+    async def process_exam_documents(self, question_pdf: str, answer_pdf: str, output_folder: str, selected_model: str = "gemini",
+                                     question_text: str = None, strategy_overrides: Dict[str, Any] = None,
+                                     profile: bool = None) -> Dict[str, Any]:
+        """Main orchestration method that coordinates all agents.
         
+        Runs that grade many scripts against one paper pass the question_text from
+        extract_questions, which skips the question analysis and extraction steps.
+        strategy_overrides are applied on top of the analyzer's answer strategy.
+        profile (default: PROFILE_WORKFLOWS) saves a CPU profile and stage timeline
+        of the workflow next to the compiled PDF.
+        """
+        student_name = os.path.splitext(os.path.basename(answer_pdf))[0]
+        with profile_workflow(f"{student_name}_answers", output_folder, enabled=profile) as session:
+            # One retry budget covers agent retries, agent fallbacks and OCR fallbacks alike
+            with retry_budget() as budget:
+                result = await self._run_workflow(question_pdf, answer_pdf, output_folder, selected_model,
+                                                  question_text, strategy_overrides or {})
+            self.workflow_state["retries_spent"] = budget.spent
+        if session:
+            result["profile"] = session.files
+        return result
+    
+    async def extract_questions(self, question_pdf: str, selected_model: str = "gemini") -> AgentResult:
+        """Analyze and extract a question paper on its own, for reuse across many scripts"""
+        with retry_budget():
+            analysis = await self._execute_agent("analyzer", {"file_path": question_pdf, "file_type": "question_paper"})
+            if not analysis.success:
+                return analysis
+            strategy = analysis.data["strategy"].copy()
+            strategy["recommended_model"] = selected_model
+            return await self._execute_agent("question_extractor", {"file_path": question_pdf, "strategy": strategy})
+    
+    async def _run_workflow(self, question_pdf: str, answer_pdf: str, output_folder: str, selected_model: str,
+                            question_text: str = None, strategy_overrides: Dict[str, Any] = None) -> Dict[str, Any]:
         workflow_id = f"workflow_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         self.workflow_state = {
             "id": workflow_id,
@@ -38,17 +82,18 @@ class ExamProcessingOrchestrator:
         
         try:
             # Step 1: Analyze question document
-            print("Step 1: Analyzing question document...")
-            q_analysis_result = await self._execute_agent(
-                "analyzer",
-                {
-                    "file_path": question_pdf,
-                    "file_type": "question_paper"
-                }
-            )
-            
-            if not q_analysis_result.success:
-                return self._create_error_response("Question document analysis failed", q_analysis_result.error)
+            if question_text is None:
+                print("Step 1: Analyzing question document...")
+                q_analysis_result = await self._execute_agent(
+                    "analyzer",
+                    {
+                        "file_path": question_pdf,
+                        "file_type": "question_paper"
+                    }
+                )
+                
+                if not q_analysis_result.success:
+                    return self._create_error_response("Question document analysis failed", q_analysis_result.error)
             
             # Step 2: Analyze answer document  
             print("Step 2: Analyzing answer document...")
@@ -64,64 +109,73 @@ class ExamProcessingOrchestrator:
                 return self._create_error_response("Answer document analysis failed", a_analysis_result.error)
             
             # Step 3: Extract questions
-            print("Step 3: Extracting questions...")
-            # Override model selection with user preference
-            q_strategy = q_analysis_result.data["strategy"].copy()
-            q_strategy["recommended_model"] = selected_model
-            
-            question_result = await self._execute_agent(
-                "question_extractor",
-                {
-                    "file_path": question_pdf,
-                    "strategy": q_strategy
-                }
-            )
-            
-            if not question_result.success:
-                return self._create_error_response("Question extraction failed", question_result.error)
+            if question_text is None:
+                print("Step 3: Extracting questions...")
+                # Override model selection with user preference
+                q_strategy = q_analysis_result.data["strategy"].copy()
+                q_strategy["recommended_model"] = selected_model
+                
+                question_result = await self._execute_agent(
+                    "question_extractor",
+                    {
+                        "file_path": question_pdf,
+                        "strategy": q_strategy
+                    }
+                )
+                
+                if not question_result.success:
+                    return self._create_error_response("Question extraction failed", question_result.error)
+                question_text = question_result.data["question_text"]
+            else:
+                print("Steps 1 and 3: Using the question text extracted for this run")
             
             # Step 4: Process answers
             print("Step 4: Processing answer sheet...")
             # Override model selection with user preference
             a_strategy = a_analysis_result.data["strategy"].copy()
             a_strategy["recommended_model"] = selected_model
+            a_strategy.update(strategy_overrides or {})
+            
+            # Every stage output is kept so the job can be rebuilt from any stage
+            student_name = os.path.splitext(os.path.basename(answer_pdf))[0]
+            artifacts = JobArtifacts.create(
+                new_job_id(student_name),
+                workflow_id=workflow_id,
+                question_pdf=question_pdf,
+                answer_pdf=answer_pdf,
+                output_folder=output_folder,
+                student_name=student_name,
+                strategy=a_strategy
+            )
+            self.workflow_state["job_id"] = artifacts.job_id
+            artifacts.save_text("questions", "questions.txt", question_text)
             
             answer_result = await self._execute_agent(
                 "answer_processor",
                 {
                     "file_path": answer_pdf,
-                    "question_text": question_result.data["question_text"],
+                    "question_text": question_text,
                     "strategy": a_strategy
                 }
             )
             
             if not answer_result.success:
                 return self._create_error_response("Answer processing failed", answer_result.error)
+            self._save_answer_artifacts(artifacts, answer_result)
             
             # Step 5: Compile LaTeX
             print("Step 5: Compiling LaTeX...")
-            student_name = os.path.splitext(os.path.basename(answer_pdf))[0]
-            
-            compile_result = await self._execute_agent(
-                "latex_compiler",
-                {
-                    "latex_content": answer_result.data["latex_output"],
-                    "output_folder": output_folder,
-                    "filename": f"{student_name}_answers"
-                }
-            )
+            compile_result = await self._compile_student(answer_result.data["latex_output"], output_folder, student_name, artifacts)
             
             if not compile_result.success:
                 return self._create_error_response("LaTeX compilation failed", compile_result.error)
             
-            # Cleanup temporary files
-            self._cleanup_temp_files(output_folder, f"{student_name}_answers")
-            
             # Success!
             return {
                 "success": True,
                 "pdf_filename": compile_result.data["filename"],
                 "pdf_path": compile_result.data["pdf_path"],
+                "job_id": artifacts.job_id,
                 "workflow_state": self.workflow_state,
                 "model_used": selected_model
             }
@@ -129,6 +183,321 @@ class ExamProcessingOrchestrator:
         except Exception as e:
             return self._create_error_response("Unexpected error in orchestration", str(e))
     
+    async def process_exam_batch_offline(self, question_pdf: str, answer_pdfs: List[str], output_folder: str,
+                                         poll_interval: int = BATCH_POLL_SECONDS, sync_fallback: bool = True,
+                                         run_id: str = None) -> Dict[str, Any]:
+        """Grade a whole class through the OpenAI Batch API.
+        
+        The question paper is extracted interactively once; every student's answer
+        request is then packaged into batch jobs, polled until finished and compiled.
+        Students missing from the batch output are processed interactively when
+        sync_fallback is set. Set OPENAI_BATCH_BASE_URL to use a stand-in batch server.
+        
+        Progress is checkpointed per student and stage under run_id (derived from the
+        input files by default), so re-running after a crash only schedules unfinished
+        work and resumes polling batches that were already submitted.
+        """
+        workflow_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        checkpoint = CheckpointStore(run_id or run_id_for("offline_batch", question_pdf, answer_pdfs))
+        self.workflow_state = {
+            "id": workflow_id,
+            "mode": "offline_batch",
+            "run_id": checkpoint.run_id,
+            "question_pdf": question_pdf,
+            "answer_pdfs": answer_pdfs,
+            "output_folder": output_folder,
+            "selected_model": "openai",
+            "steps": [],
+            "current_step": 0,
+            "errors": [],
+            "retry_count": 0,
+            "batch_ids": []
+        }
+        
+        try:
+            # Step 1: Questions once for the whole class
+            saved_questions = checkpoint.run_stage("questions")
+            if saved_questions:
+                print("Step 1: Using question text from checkpoint")
+                question_text = saved_questions["question_text"]
+            else:
+                print("Step 1: Extracting questions for the batch...")
+                q_analysis_result = await self._execute_agent("analyzer", {"file_path": question_pdf, "file_type": "question_paper"})
+                if not q_analysis_result.success:
+                    return self._create_error_response("Question document analysis failed", q_analysis_result.error)
+                
+                q_strategy = q_analysis_result.data["strategy"].copy()
+                q_strategy["recommended_model"] = "openai"
+                question_result = await self._execute_agent("question_extractor", {"file_path": question_pdf, "strategy": q_strategy})
+                if not question_result.success:
+                    return self._create_error_response("Question extraction failed", question_result.error)
+                question_text = question_result.data["question_text"]
+                checkpoint.mark_run("questions", question_text=question_text)
+            
+            # Step 2: Render and package every unfinished student's request
+            print(f"Step 2: Preparing {len(answer_pdfs)} answer sheets for batch submission...")
+            answer_agent = self.agents["answer_processor"]
+            pending_batches = set(checkpoint.unfinished_batches())
+            students, requests, results = {}, [], []
+            for answer_pdf in answer_pdfs:
+                student_name = os.path.splitext(os.path.basename(answer_pdf))[0]
+                key = student_key(answer_pdf)
+                custom_id = f"student-{key}"
+                if custom_id in students:
+                    print(f"  Skipping {student_name}: same script as {students[custom_id]['student']}")
+                    continue
+                
+                compiled = checkpoint.student_stage(key, "compiled")
+                if compiled and os.path.exists(os.path.join(output_folder, compiled["pdf_filename"])):
+                    results.append({"student": student_name, "answer_pdf": answer_pdf, "success": True, "resumed": True,
+                                    "pdf_filename": compiled["pdf_filename"], "job_id": compiled.get("job_id")})
+                    continue
+                
+                try:
+                    analyzed = checkpoint.student_stage(key, "analyzed")
+                    if analyzed:
+                        strategy = analyzed["strategy"]
+                    else:
+                        analysis = await self._execute_agent("analyzer", {"file_path": answer_pdf, "file_type": "answer_sheet"})
+                        strategy = analysis.data["strategy"].copy() if analysis.success else {}
+                        strategy["recommended_model"] = "openai"
+                        checkpoint.mark_student(key, "analyzed", name=student_name, answer_pdf=answer_pdf, strategy=strategy)
+                    
+                    # Same key as the interactive answer processor, so either path can reuse the other's output
+                    cache_key = answer_cache_key(answer_pdf, question_text, "openai", "agent")
+                    cached = load_answer(cache_key)
+                    students[custom_id] = {"key": key, "student": student_name, "answer_pdf": answer_pdf, "strategy": strategy,
+                                           "cache_key": cache_key, "cached": cached}
+                    
+                    submitted = checkpoint.student_stage(key, "submitted")
+                    if cached or (submitted and submitted["batch_id"] in pending_batches):
+                        # Already answered, or waiting in a batch an earlier run submitted
+                        continue
+                    request = answer_agent.build_batch_request(answer_pdf, question_text, strategy)
+                except Exception as e:
+                    print(f"  Could not prepare {student_name}: {e}")
+                    students.pop(custom_id, None)
+                    results.append({"student": student_name, "answer_pdf": answer_pdf, "success": False, "error": str(e)})
+                    continue
+                
+                requests.append((custom_id, build_batch_line(custom_id, request["messages"], request["max_tokens"])))
+            
+            # Step 3: Submit new requests, then wait for every batch this run still owes
+            outputs, collected = {}, []
+            if requests:
+                print(f"Step 3: Submitting {len(requests)} requests...")
+                for path, custom_ids in write_batch_files(requests, os.path.join("tmp", workflow_id)):
+                    batch_id = submit_batch(path, {"workflow_id": workflow_id, "run_id": checkpoint.run_id})
+                    checkpoint.record_batch(batch_id, custom_ids)
+                    for custom_id in custom_ids:
+                        checkpoint.mark_student(students[custom_id]["key"], "submitted", batch_id=batch_id)
+            
+            batch_ids = checkpoint.unfinished_batches()
+            self.workflow_state["batch_ids"] = batch_ids
+            if batch_ids:
+                with timed("offline_batch", students=len(students), batches=len(batch_ids)) as execution:
+                    for batch_id in batch_ids:
+                        batch = await self._wait_for_batch(batch_id, poll_interval)
+                        self.workflow_state["steps"].append({
+                            "agent": "openai_batch",
+                            "batch_id": batch_id,
+                            "status": batch.status,
+                            "timestamp": datetime.now().isoformat()
+                        })
+                        if batch.status == "completed":
+                            outputs.update(download_batch_results(batch))
+                            collected.append(batch_id)
+                        elif is_batch_finished(batch):
+                            checkpoint.update_batch(batch_id, batch.status)
+                            self.workflow_state["errors"].append(f"Batch {batch_id} ended with status {batch.status}")
+                        else:
+                            # Still running at the deadline; a later run resumes polling it
+                            self.workflow_state["errors"].append(f"Batch {batch_id} still {batch.status} at timeout")
+                    execution["returned"] = sum(1 for output in outputs.values() if "content" in output)
+            
+            # Step 4: Validate and compile each student's document
+            print("Step 4: Compiling batch results...")
+            still_running = set(checkpoint.unfinished_batches()) - set(collected)
+            for custom_id, student in students.items():
+                output = outputs.get(custom_id, {"error": "Missing from batch output"})
+                submitted = checkpoint.student_stage(student["key"], "submitted")
+                if not student["cached"] and "content" not in output and submitted and submitted["batch_id"] in still_running:
+                    results.append({"student": student["student"], "answer_pdf": student["answer_pdf"], "success": False,
+                                    "error": f"Waiting on batch {submitted['batch_id']}"})
+                    continue
+                
+                if not student["cached"] and output.get("finish_reason") == "length":
+                    # Truncated at max_tokens: continue and stitch like the interactive path, or fall back to it
+                    print(f"  {student['student']}: batch output hit max_tokens, continuing interactively...")
+                    try:
+                        output = {**output, "content": answer_agent.continue_batch_output(
+                            student["answer_pdf"], question_text, student["strategy"], output["content"])}
+                    except Exception as e:
+                        output = {"error": f"Truncated batch output could not be continued: {e}"}
+                
+                if student["cached"]:
+                    answer_result = AgentResult(success=True, data={"latex_output": student["cached"]["latex_output"]})
+                    output = {"cached": True}
+                elif "content" in output:
+                    answer_result = answer_agent.finalize_batch_output(output["content"], question_text)
+                    if "Used structured fallback" not in answer_result.data["validation"]["issues"]:
+                        store_answer(student["cache_key"], answer_result.data["latex_output"], model="openai", answer_mode="offline_batch")
+                elif sync_fallback:
+                    print(f"  {student['student']}: {output['error']}, processing interactively...")
+                    with retry_budget():
+                        answer_result = await self._execute_agent("answer_processor", {
+                            "file_path": student["answer_pdf"],
+                            "question_text": question_text,
+                            "strategy": student["strategy"]
+                        })
+                else:
+                    answer_result = AgentResult(success=False, error=output["error"])
+                
+                entry = {"student": student["student"], "answer_pdf": student["answer_pdf"],
+                         "from_batch": "content" in output, "cached": bool(student["cached"])}
+                if not answer_result.success:
+                    results.append({**entry, "success": False, "error": answer_result.error})
+                    continue
+                
+                artifacts = JobArtifacts.create(
+                    new_job_id(student["student"]),
+                    workflow_id=workflow_id,
+                    question_pdf=question_pdf,
+                    answer_pdf=student["answer_pdf"],
+                    output_folder=output_folder,
+                    student_name=student["student"],
+                    strategy=student["strategy"]
+                )
+                artifacts.save_text("questions", "questions.txt", question_text)
+                self._save_answer_artifacts(artifacts, answer_result)
+                entry["job_id"] = artifacts.job_id
+                
+                compile_result = await self._compile_student(answer_result.data["latex_output"], output_folder,
+                                                             student["student"], artifacts)
+                if compile_result.success:
+                    checkpoint.mark_student(student["key"], "compiled", pdf_filename=compile_result.data["filename"],
+                                            job_id=artifacts.job_id)
+                    results.append({**entry, "success": True, "pdf_filename": compile_result.data["filename"]})
+                else:
+                    results.append({**entry, "success": False, "error": compile_result.error or "LaTeX compilation failed"})
+            
+            # Only now are the downloaded outputs safely turned into cache entries or PDFs
+            for batch_id in collected:
+                checkpoint.update_batch(batch_id, "collected")
+            
+            succeeded = sum(1 for result in results if result["success"])
+            print(f"Batch complete: {succeeded}/{len(answer_pdfs)} answer sheets compiled")
+            return {
+                "success": succeeded > 0,
+                "results": results,
+                "run_id": checkpoint.run_id,
+                "batch_ids": batch_ids,
+                "workflow_state": self.workflow_state,
+                "model_used": "openai"
+            }
+            
+        except Exception as e:
+            return self._create_error_response("Unexpected error in batch orchestration", str(e))
+    
+    async def _wait_for_batch(self, batch_id: str, poll_interval: int):
+        """Poll a batch job until the provider reports a final status"""
+        deadline = time.monotonic() + BATCH_TIMEOUT_SECONDS
+        while True:
+            batch = await asyncio.to_thread(get_batch, batch_id)
+            counts = getattr(batch, "request_counts", None)
+            progress = f" ({counts.completed}/{counts.total})" if counts else ""
+            print(f"  Batch {batch_id}: {batch.status}{progress}")
+            if is_batch_finished(batch) or time.monotonic() > deadline:
+                return batch
+            await asyncio.sleep(poll_interval)
+    
+    async def rebuild_from_stage(self, job_id: str, stage: str) -> Dict[str, Any]:
+        """Re-run a stored job from "extract", "clean" or "compile" without repeating earlier stages.
+        
+        extract re-runs answer extraction (bypassing the result cache), clean re-cleans
+        and compiles the stored raw model output, compile recompiles the stored cleaned LaTeX.
+        """
+        if stage not in ("extract", "clean", "compile"):
+            return self._create_error_response("Unknown rebuild stage", stage)
+        
+        artifacts = JobArtifacts.load(job_id)
+        inputs = artifacts.manifest["inputs"]
+        self.workflow_state = {
+            "id": f"rebuild_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+            "job_id": job_id,
+            "rebuild_stage": stage,
+            "steps": [],
+            "errors": []
+        }
+        
+        try:
+            if stage == "extract":
+                with retry_budget():
+                    answer_result = await self._execute_agent("answer_processor", {
+                        "file_path": inputs["answer_pdf"],
+                        "question_text": artifacts.read_text("questions"),
+                        "strategy": {**inputs["strategy"], "use_cache": False}
+                    })
+                if not answer_result.success:
+                    return self._create_error_response("Answer processing failed", answer_result.error)
+                self._save_answer_artifacts(artifacts, answer_result)
+            
+            if stage == "compile":
+                latex_source, skip_clean = artifacts.read_text("cleaned"), True
+            else:
+                latex_source, skip_clean = artifacts.read_text("raw"), False
+            
+            compile_result = await self._compile_student(latex_source, inputs["output_folder"], inputs["student_name"],
+                                                         artifacts, skip_clean)
+            if not compile_result.success:
+                return self._create_error_response("LaTeX compilation failed", compile_result.error)
+            
+            return {
+                "success": True,
+                "pdf_filename": compile_result.data["filename"],
+                "pdf_path": compile_result.data["pdf_path"],
+                "job_id": job_id,
+                "workflow_state": self.workflow_state
+            }
+            
+        except FileNotFoundError as e:
+            return self._create_error_response("Missing artifact for rebuild", str(e))
+        except Exception as e:
+            return self._create_error_response("Unexpected error in rebuild", str(e))
+    
+    def _save_answer_artifacts(self, artifacts: JobArtifacts, answer_result: AgentResult):
+        """Keep the pages that were sent and the model's answer document"""
+        page_images = [path for path in answer_result.data.get("image_paths", []) if isinstance(path, str)]
+        if page_images:
+            artifacts.save_files("pages", page_images)
+        artifacts.save_text("raw", "raw_output.tex", answer_result.data["latex_output"],
+                            model=answer_result.data.get("model_used"), cached=answer_result.data.get("cached", False))
+    
+    async def _compile_student(self, latex_output: str, output_folder: str, student_name: str,
+                               artifacts: JobArtifacts = None, skip_clean: bool = False) -> AgentResult:
+        """Compile one student's answer document and remove LaTeX intermediates"""
+        with timed("latex_compile", student=student_name):
+            compile_result = await self._execute_agent(
+                "latex_compiler",
+                {
+                    "latex_content": latex_output,
+                    "output_folder": output_folder,
+                    "filename": f"{student_name}_answers",
+                    "skip_clean": skip_clean
+                }
+            )
+        
+        if artifacts and isinstance(compile_result.data, dict):
+            # The .tex in output_folder is removed below; the artifact copy is what survives
+            artifacts.save_text("cleaned", "cleaned.tex", compile_result.data["latex_source"])
+            if compile_result.success:
+                artifacts.save_files("pdf", [compile_result.data["pdf_path"]])
+        
+        if compile_result.success:
+            # Cleanup temporary files
+            self._cleanup_temp_files(output_folder, f"{student_name}_answers")
+        return compile_result
+    
     async def _execute_agent(self, agent_name: str, task: Dict[str, Any]) -> AgentResult:
         """Execute an agent with retry logic"""
         agent = self.agents[agent_name]
@@ -144,17 +513,17 @@ class ExamProcessingOrchestrator:
                 
                 if result.success:
                     return result
-                elif attempt < self.max_retries:
+                elif attempt < self.max_retries and retry_allowed(f"{agent_name}.retry"):
                     print(f"  {agent_name} failed, retrying... Error: {result.error}")
                     # Modify task for retry (could implement specific retry strategies)
                     task = self._modify_task_for_retry(agent_name, task, result.error)
                 else:
-                    print(f"  {agent_name} failed after {self.max_retries + 1} attempts")
+                    print(f"  {agent_name} failed after {attempt + 1} attempts")
                     return result
                     
             except Exception as e:
                 print(f"  Exception in {agent_name}: {str(e)}")
-                if attempt >= self.max_retries:
+                if attempt >= self.max_retries or not retry_allowed(f"{agent_name}.retry"):
                     return AgentResult(success=False, error=str(e))
         
         return AgentResult(success=False, error="Max retries exceeded")
@@ -185,6 +554,9 @@ class ExamProcessingOrchestrator:
             "error": result.error,
             "timestamp": result.timestamp
         }
+        if isinstance(result.data, dict) and "execution" in result.data:
+            # Which execution mode ran and its labels, recorded by the agent
+            step_info["execution"] = result.data["execution"]
         self.workflow_state["steps"].append(step_info)
     
     def _create_error_response(self, message: str, error: str) -> Dict[str, Any]:
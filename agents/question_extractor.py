@@ -1,12 +1,19 @@
 # agents/question_extractor.py - Enhanced multi-page support
-from typing import Dict, List, Any
-from utils.ocr_openai import pdf_to_images, gpt4o_extract_questions
+import os
+from typing import Dict, List, Any, Optional
+from utils.ocr_openai import pdf_to_images, DEFAULT_DPI, PREVIEW_DPI, gpt4o_extract_questions
 from utils.ocr_gemini import gemini_extract_question_text
+from utils.metrics import timed
+from utils.pdf_text import (extract_page_texts, is_usable_text, figure_pages, extract_page_figures, format_question_text,
+                            scanned_pages)
+from utils.resilience import retry_allowed
+from utils.validation import validate_questions
 from .base_agent import BaseAgent, AgentResult
 
 class QuestionExtractorAgent(BaseAgent):
     def __init__(self):
         super().__init__("QuestionExtractor", ["openai_vision", "gemini_vision"])
+        self.page_batch_size = 5  # Pages per request in page_by_page_fallback mode
         self.question_prompt = '''EXTRACT ALL EXAMINATION QUESTIONS FROM ALL PAGES
 
 CRITICAL: This is a MULTI-PAGE examination paper. You must extract questions from EVERY page provided.
@@ -76,34 +83,77 @@ OUTPUT ONLY the extracted questions from ALL pages in this format. No explanatio
             
             print(f"🔍 Extracting questions from: {file_path}")
             
-            # Convert PDF to images with higher DPI for better text recognition
-            image_paths = pdf_to_images(file_path)
-            print(f"📄 Processing {len(image_paths)} pages for question extraction")
+            # Execution mode comes from the analyzer's strategy
+            full_dpi = strategy.get("dpi_setting", DEFAULT_DPI)
+            preprocess = strategy.get("preprocessing_needed", False)
+            multi_page_strategy = strategy.get("multi_page_strategy", "batch_with_page_fallback")
+            progressive = strategy.get("render_mode") == "progressive"
+            render_dpi = min(strategy.get("preview_dpi", PREVIEW_DPI), full_dpi) if progressive else full_dpi
             
             # Choose model based on strategy
             model = strategy["recommended_model"]
-            print(f"🤖 Using {model.upper()} for question extraction")
             
-            # Extract questions using chosen model
-            question_text = self._extract_questions_multipage(image_paths, model)
-            print(f"📝 Extracted {len(question_text)} characters from {len(image_paths)} pages")
+            # Born-digital papers carry their text; read it locally before paying for vision
+            if strategy.get("use_text_layer", True):
+                text_layer = self._extract_from_text_layer(file_path, model, multi_page_strategy, full_dpi, preprocess)
+                if text_layer:
+                    validation = self._validate_multipage_extraction(text_layer["question_text"], text_layer["pages"])
+                    if validation["is_valid"]:
+                        return AgentResult(
+                            success=True,
+                            data={
+                                "question_text": text_layer["question_text"],
+                                "model_used": model if text_layer["vision_pages"] else "text_layer",
+                                "validation": validation,
+                                "image_paths": text_layer["image_paths"],
+                                "pages_processed": text_layer["pages"],
+                                "render_dpi": full_dpi if text_layer["vision_pages"] else None,
+                                "source": text_layer["source"],
+                                "execution": text_layer["execution"]
+                            },
+                            confidence=validation["confidence"]
+                        )
+                    print("⚠️ Text layer extraction failed validation, using vision extraction")
             
-            # Validate and enhance extraction
-            validation = self._validate_multipage_extraction(question_text, len(image_paths))
-            print(f"✅ Validation result: {validation['confidence']:.2f} confidence, valid: {validation['is_valid']}")
-            
-            # Retry with different model if validation fails
-            if not validation["is_valid"] and validation["should_retry"]:
-                fallback_model = "gemini" if model == "openai" else "openai"
-                print(f"🔄 Retrying question extraction with {fallback_model.upper()}")
-                question_text = self._extract_questions_multipage(image_paths, fallback_model)
+            with timed("question_extraction", model=model, mode=multi_page_strategy,
+                       dpi=render_dpi, preprocessed=preprocess) as execution:
+                # Progressive mode tries a modest DPI first; printed papers usually read fine
+                image_paths = pdf_to_images(file_path, dpi=render_dpi, preprocess=preprocess)
+                print(f"📄 Processing {len(image_paths)} pages for question extraction at {render_dpi} DPI")
+                print(f"🤖 Using {model.upper()} for question extraction ({multi_page_strategy})")
+                
+                # Extract questions using chosen model
+                question_text = self._extract_questions_multipage(image_paths, model, multi_page_strategy)
+                print(f"📝 Extracted {len(question_text)} characters from {len(image_paths)} pages")
+                
+                # Validate and enhance extraction
                 validation = self._validate_multipage_extraction(question_text, len(image_paths))
+                print(f"✅ Validation result: {validation['confidence']:.2f} confidence, valid: {validation['is_valid']}")
+                
+                # Re-render at full resolution before giving up on the chosen model
+                if (render_dpi != full_dpi and (not validation["is_valid"] or validation["confidence"] < 0.5)
+                        and retry_allowed("questions.full_resolution")):
+                    print(f"🔍 Preview extraction weak, re-rendering at {full_dpi} DPI")
+                    image_paths = pdf_to_images(file_path, dpi=full_dpi, preprocess=preprocess)
+                    render_dpi = full_dpi
+                    execution["dpi"] = full_dpi
+                    question_text = self._extract_questions_multipage(image_paths, model, multi_page_strategy)
+                    validation = self._validate_multipage_extraction(question_text, len(image_paths))
                 
-                # If still failing, try enhanced extraction
-                if not validation["is_valid"]:
-                    print("🔧 Trying enhanced page-by-page extraction...")
-                    question_text = self._enhanced_question_extraction_multipage(image_paths, model)
+                # Retry with different model if validation fails
+                if not validation["is_valid"] and validation["should_retry"] and retry_allowed("questions.fallback_model"):
+                    fallback_model = "gemini" if model == "openai" else "openai"
+                    print(f"🔄 Retrying question extraction with {fallback_model.upper()}")
+                    execution["fallback_model"] = fallback_model
+                    question_text = self._extract_questions_multipage(image_paths, fallback_model, multi_page_strategy)
                     validation = self._validate_multipage_extraction(question_text, len(image_paths))
+                    
+                    # If still failing, try enhanced extraction
+                    if not validation["is_valid"] and retry_allowed("questions.enhanced"):
+                        print("🔧 Trying enhanced page-by-page extraction...")
+                        execution["enhanced"] = True
+                        question_text = self._enhanced_question_extraction_multipage(image_paths, model)
+                        validation = self._validate_multipage_extraction(question_text, len(image_paths))
             
             return AgentResult(
                 success=validation["is_valid"],
@@ -112,7 +162,10 @@ OUTPUT ONLY the extracted questions from ALL pages in this format. No explanatio
                     "model_used": model,
                     "validation": validation,
                     "image_paths": image_paths,
-                    "pages_processed": len(image_paths)
+                    "pages_processed": len(image_paths),
+                    "render_dpi": render_dpi,
+                    "source": "vision",
+                    "execution": execution
                 },
                 confidence=validation["confidence"]
             )
@@ -121,12 +174,96 @@ OUTPUT ONLY the extracted questions from ALL pages in this format. No explanatio
             print(f"❌ Error in question extraction: {e}")
             return AgentResult(success=False, error=str(e))
     
-    def _extract_questions_multipage(self, image_paths: List[str], model: str) -> str:
-        """Extract questions with multi-page awareness"""
+    def _extract_questions_multipage(self, image_paths: List[str], model: str,
+                                     multi_page_strategy: str = "batch_with_page_fallback") -> str:
+        """Extract questions with multi-page awareness.
+        
+        batch_process sends every page in one request, batch_with_page_fallback adds a
+        per-page retry when the batch looks incomplete, and page_by_page_fallback sends
+        pages in small batches (each with the per-page retry) for very long papers.
+        """
+        if multi_page_strategy == "page_by_page_fallback" and len(image_paths) > self.page_batch_size:
+            parts = []
+            for start in range(0, len(image_paths), self.page_batch_size):
+                batch = image_paths[start:start + self.page_batch_size]
+                print(f"📑 Extracting pages {start + 1}-{start + len(batch)}")
+                parts.append(self._extract_questions_batch(batch, model, page_fallback=True))
+            return "\n\n".join(part for part in parts if part)
+        
+        page_fallback = multi_page_strategy != "batch_process"
+        return self._extract_questions_batch(image_paths, model, page_fallback)
+    
+    def _extract_questions_batch(self, image_paths: List[str], model: str, page_fallback: bool, prompt: str = None) -> str:
+        prompt = prompt or self.question_prompt
         if model == "gemini":
-            return gemini_extract_question_text(image_paths, self.question_prompt)
+            return gemini_extract_question_text(image_paths, prompt, page_fallback=page_fallback)
         else:
-            return gpt4o_extract_questions(image_paths, self.question_prompt)
+            return gpt4o_extract_questions(image_paths, prompt, page_fallback=page_fallback)
+    
+    def _extract_from_text_layer(self, file_path: str, model: str, multi_page_strategy: str,
+                                 dpi: int, preprocess: bool) -> Optional[Dict]:
+        """Build question text from the PDF text layer; only textless pages and figures use vision.
+        
+        Returns None when no page has a usable text layer.
+        """
+        page_texts = extract_page_texts(file_path)
+        # Scans carry at most a scanner's OCR layer; the page image reads better
+        scanned = scanned_pages(file_path) if page_texts else set()
+        text_pages = [num for num, text in enumerate(page_texts, 1) if num not in scanned and is_usable_text(text)]
+        if not text_pages:
+            print("📄 No usable text layer (or scanned pages only), using vision extraction")
+            return None
+        
+        vision_pages = [num for num in range(1, len(page_texts) + 1) if num not in text_pages]
+        source = "mixed" if vision_pages else "text_layer"
+        
+        with timed("question_extraction", model=model, mode=source, text_pages=len(text_pages),
+                   vision_pages=len(vision_pages)) as execution:
+            print(f"📄 Text layer found on {len(text_pages)}/{len(page_texts)} pages")
+            figures = figure_pages(file_path)
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            
+            # Scanned pages still need the vision model, in one request
+            image_paths = []
+            vision_text = ""
+            if vision_pages:
+                image_paths = pdf_to_images(file_path, dpi=dpi, pages=vision_pages, preprocess=preprocess)
+                vision_text = self._extract_questions_multipage(image_paths, model, multi_page_strategy)
+            
+            parts = []
+            for page_num in range(1, len(page_texts) + 1):
+                if page_num in text_pages:
+                    parts.append(page_texts[page_num - 1])
+                    if figures.get(page_num):
+                        parts.append(self._describe_page_figures(file_path, page_num, model, base_name))
+                elif page_num == vision_pages[0]:
+                    # Vision output for all textless pages goes where the first one was
+                    parts.append(vision_text)
+            
+            question_text = format_question_text("\n\n".join(part for part in parts if part))
+            execution["figure_pages"] = len([p for p in text_pages if figures.get(p)])
+        
+        return {
+            "question_text": question_text,
+            "pages": len(page_texts),
+            "vision_pages": vision_pages,
+            "image_paths": image_paths,
+            "source": source,
+            "execution": execution
+        }
+    
+    def _describe_page_figures(self, file_path: str, page_num: int, model: str, base_name: str) -> str:
+        """Send only the figure crops of a text page to the vision model"""
+        crops = extract_page_figures(file_path, page_num, f"tmp/{base_name}/figures")
+        if not crops:
+            return "[FIGURE/DIAGRAM REFERENCED]"
+        
+        prompt = f"""These images are figures from page {page_num} of an examination paper.
+Describe each figure precisely enough for a student to answer questions about it:
+graph nodes and edges, table contents, matrix entries, axis labels and values.
+Format each as: [FIGURE/DIAGRAM: description]"""
+        description = self._extract_questions_batch(crops, model, page_fallback=False, prompt=prompt)
+        return description or "[FIGURE/DIAGRAM REFERENCED]"
     
     def _enhanced_question_extraction_multipage(self, image_paths: List[str], model: str) -> str:
         """Enhanced extraction with page-by-page processing for difficult cases"""
@@ -166,102 +303,15 @@ Extract EVERYTHING students need to answer from ALL pages. Be thorough and compl
             return gpt4o_extract_questions(image_paths, enhanced_prompt)
     
     def _validate_multipage_extraction(self, question_text: str, num_pages: int) -> Dict:
-        """Enhanced validation for multi-page extraction"""
-        validation = {
-            "is_valid": True,
-            "should_retry": False,
-            "confidence": 0.9,
-            "issues": [],
-            "pages_processed": num_pages
-        }
-        
-        if not question_text or len(question_text.strip()) < 100:
-            validation["is_valid"] = False
-            validation["should_retry"] = True
-            validation["confidence"] = 0.1
-            validation["issues"].append("Extracted text too short")
-            return validation
-        
-        if "NO QUESTIONS FOUND" in question_text.upper():
-            validation["is_valid"] = False
-            validation["should_retry"] = True
-            validation["confidence"] = 0.0
-            validation["issues"].append("No questions detected")
-            return validation
-        
-        # Enhanced multi-page specific validation
-        if num_pages > 1:
-            expected_min_length = num_pages * 200  # At least 200 chars per page
-            if len(question_text) < expected_min_length:
-                validation["confidence"] *= 0.6
-                validation["issues"].append(f"Content seems short for {num_pages} pages")
-        
-        # Check for question patterns
-        import re
-        question_patterns = [
-            r'Question\s+\d+',
-            r'Q\d+',
-            r'^\d+[\.:]\s',
-            r'\(\d+\)',
-            r'\d+\)',
-            r'Consider',
-            r'Which',
-            r'What',
-            r'How',
-            r'Explain'
-        ]
-        
-        question_matches = []
-        for pattern in question_patterns:
-            matches = re.findall(pattern, question_text, re.MULTILINE | re.IGNORECASE)
-            question_matches.extend(matches)
-        
-        if not question_matches:
-            validation["confidence"] *= 0.3
-            validation["should_retry"] = True
-            validation["issues"].append("No clear question patterns found")
-        
-        # Count actual questions
-        question_count = len(re.findall(r'Question\s+\d+', question_text, re.IGNORECASE))
-        
-        if num_pages > 1 and question_count < 2:
-            validation["confidence"] *= 0.7
-            validation["issues"].append(f"Only {question_count} questions found across {num_pages} pages")
-        
-        # Check for mark allocations (good indicator of real questions)
-        mark_patterns = [r'\[\d+\]', r'\[\d+\s*marks?\]', r'\(\d+\s*marks?\)']
-        has_marks = any(re.search(pattern, question_text, re.IGNORECASE) 
-                       for pattern in mark_patterns)
-        
-        if has_marks:
-            validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
-        else:
-            validation["confidence"] *= 0.8
-            validation["issues"].append("No mark allocations found")
-        
-        # Check for multiple choice patterns
-        mcq_patterns = [r'A\.\s', r'B\.\s', r'C\.\s', r'D\.\s']
-        mcq_count = sum(len(re.findall(pattern, question_text)) for pattern in mcq_patterns)
-        
-        if mcq_count >= 4:  # At least one complete MCQ
-            validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
-        
-        # Check for page indicators (if extraction was page-by-page)
-        if "PAGE" in question_text.upper() and num_pages > 1:
-            validation["confidence"] = min(validation["confidence"] + 0.05, 1.0)
-            validation["issues"].append("Page-by-page extraction detected")
-        
-        # Final confidence adjustment based on content length and pages
-        content_per_page = len(question_text) / num_pages if num_pages > 0 else len(question_text)
-        if content_per_page > 500:  # Good amount of content per page
-            validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
+        """Shared single-pass validation; the provider helper's scan of the same text is reused"""
+        validation = validate_questions(question_text, num_pages)
         
         print(f"📊 Validation Details:")
-        print(f"   • {question_count} questions found")
-        print(f"   • {len(question_text)} total characters")
-        print(f"   • {content_per_page:.0f} characters per page")
-        print(f"   • Mark allocations: {'Yes' if has_marks else 'No'}")
-        print(f"   • MCQ options: {mcq_count}")
+        print(f"   • {validation['question_count']} questions found")
+        print(f"   • {validation['chars']} total characters")
+        print(f"   • {validation['chars'] / max(num_pages, 1):.0f} characters per page")
+        print(f"   • Mark allocations: {'Yes' if validation['has_marks'] else 'No'}")
+        print(f"   • MCQ options: {validation['mcq_options']}")
         print(f"   • Issues: {validation['issues'] if validation['issues'] else 'None'}")
         
         return validation
\ No newline at end of file
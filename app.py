@@ -1,5 +1,6 @@
 # app.py - Enhanced with agentic features
-from flask import Flask, request, render_template, redirect, url_for, send_from_directory, session, jsonify
+from flask import Flask, request, render_template, redirect, url_for, send_from_directory, session, jsonify, Response
+import functools
 import json
 import shutil
 import asyncio
@@ -8,7 +9,8 @@ from datetime import datetime
 import os
 
 # Import the main processing functions
-from main import extract_question_text, process_student_pdf, process_exam_documents_agentic
+from main import extract_question_text, process_student_pdf, process_exam_documents_agentic, rebuild_job_from_stage
+from utils import metrics, progress, profiling
 
 UPLOAD_FOLDER = "uploads"
 QUESTION_FOLDER = os.path.join(UPLOAD_FOLDER, "question_data")
@@ -115,6 +117,16 @@ def copy_current_files_to_tmp(question_folder, question_file, student_folder, st
     except Exception as e:
         print(f"Error copying files to tmp: {e}")
 
+def tracks_progress(get_job_id):
+    """Publish a request's stage and token progress under the job id the client chose"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with progress.track(get_job_id()):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 @app.route("/api/folders")
 def get_folders():
     try:
@@ -124,6 +136,29 @@ def get_folders():
         print(f"Error in get_folders: {e}")
         return jsonify({"question_folders": [], "student_folders": []})
 
+@app.route("/api/metrics")
+def get_metrics():
+    """Per-stage timings and recent execution modes"""
+    return jsonify({
+        "summary": metrics.summarize(),
+        "recent": metrics.recent_events(limit=int(request.args.get("limit", 50)))
+    })
+
+@app.route("/api/progress/<job_id>")
+def progress_events(job_id):
+    """Server-Sent Events stream of a job's stages, streamed tokens and stalls"""
+    last_id = int(request.headers.get("Last-Event-ID") or request.args.get("after", 0))
+    
+    def stream():
+        for event in progress.subscribe(job_id, last_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/download/<filename>")
 def download(filename):
     return send_from_directory("outputs", filename, as_attachment=True)
@@ -132,6 +167,13 @@ def download(filename):
 def view_pdf(filename):
     return send_from_directory("outputs", filename)
 
+@app.route("/profile/<filename>")
+def view_profile(filename):
+    """A workflow's profile report and the files it links to, all saved next to the PDF"""
+    if not filename.endswith(tuple(profiling.PROFILE_FILES.values())):
+        return "Not a profile file", 404
+    return send_from_directory(OUTPUT_FOLDER, filename)
+
 @app.route("/view_question/<folder>/<filename>")
 def view_question_pdf(folder, filename):
     return send_from_directory(f"uploads/question_data/{folder}", filename)
@@ -157,15 +199,24 @@ def results():
     question_filename = session.get('question_filename', None)
     student_folder = session.get('student_folder', None)
     student_filename = session.get('student_filename', None)
+    # Profile reports exist for workflows that ran with profiling on
+    profiles = {}
+    for file in results:
+        if file:
+            report = profiling.report_filename(os.path.splitext(file)[0])
+            if os.path.exists(os.path.join(OUTPUT_FOLDER, report)):
+                profiles[file] = report
     
     return render_template("results.html", 
                          results=results, 
+                         profiles=profiles,
                          question_folder=question_folder, 
                          question_filename=question_filename,
                          student_folder=student_folder,
                          student_filename=student_filename)
 
 @app.route("/api/process_agentic", methods=["POST"])
+@tracks_progress(lambda: (request.get_json(silent=True) or {}).get("progress_job"))
 def process_agentic_endpoint():
     """New endpoint for full agentic processing"""
     try:
@@ -173,13 +224,14 @@ def process_agentic_endpoint():
         question_pdf = data.get("question_pdf")
         answer_pdf = data.get("answer_pdf")
         fallback_model = data.get("fallback_model", "gemini")
+        profile = data.get("profile")
         
         # Run agentic processing
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
         result = loop.run_until_complete(
-            process_exam_documents_agentic(question_pdf, answer_pdf, OUTPUT_FOLDER, fallback_model)
+            process_exam_documents_agentic(question_pdf, answer_pdf, OUTPUT_FOLDER, fallback_model, profile)
         )
         
         return jsonify(result)
@@ -190,7 +242,30 @@ def process_agentic_endpoint():
             "error": str(e)
         }), 500
 
+@app.route("/api/jobs/<job_id>/rebuild", methods=["POST"])
+def rebuild_job_endpoint(job_id):
+    """Re-run a stored job from a later stage, e.g. {"stage": "compile"}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        stage = data.get("stage", "compile")
+        
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(rebuild_job_from_stage(job_id, stage))
+        finally:
+            loop.close()
+        
+        return jsonify(result), 200 if result.get("success") else 400
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
 @app.route("/", methods=["GET", "POST"])
+@tracks_progress(lambda: request.form.get("progress_job"))
 def index():
     if request.method == "POST":
         try:
@@ -204,6 +279,8 @@ def index():
             
             # Get fallback model preference (automatic selection is primary)
             fallback_model = request.form.get('fallback_model', 'gemini')
+            # Unchecked leaves it to PROFILE_WORKFLOWS
+            profile = True if request.form.get('profile') else None
             print(f"Using automatic model selection with {fallback_model} as fallback")
             
             # Handle question paper
@@ -270,7 +347,7 @@ def index():
                                     main_path = os.path.join(STUDENT_FOLDER, clean_filename)
                                     shutil.copy2(s_path, main_path)
                                     
-                                    pdf_filename = process_student_pdf(clean_filename, question_text, OUTPUT_FOLDER, fallback_model)
+                                    pdf_filename = process_student_pdf(clean_filename, question_text, OUTPUT_FOLDER, fallback_model, profile)
                                     if pdf_filename:
                                         generated_pdfs.append(pdf_filename)
                                         student_folder = folder_name
@@ -301,7 +378,7 @@ def index():
                         temp_path = os.path.join(STUDENT_FOLDER, temp_file)
                         shutil.copy2(s_path, temp_path)
                         
-                        pdf_filename = process_student_pdf(temp_file, question_text, OUTPUT_FOLDER, fallback_model)
+                        pdf_filename = process_student_pdf(temp_file, question_text, OUTPUT_FOLDER, fallback_model, profile)
                         if pdf_filename:
                             generated_pdfs.append(pdf_filename)
                             student_folder = existing_folder
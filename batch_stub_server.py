@@ -0,0 +1,161 @@
+# batch_stub_server.py - Local stand-in for the OpenAI Files and Batch APIs
+#
+# Run:   python batch_stub_server.py
+# Use:   OPENAI_BATCH_BASE_URL=http://127.0.0.1:5055/v1 with the offline batch mode
+#
+# Batches complete STUB_BATCH_SECONDS after submission and answer every request
+# with a small well-formed LaTeX document, so the full submit/poll/download/compile
+# path can be exercised without quota or cost.
+import json
+import os
+import time
+import uuid
+from flask import Flask, request, jsonify, Response
+
+STUB_BATCH_SECONDS = float(os.getenv("STUB_BATCH_SECONDS", 5))
+# Fail every Nth request with an error line to exercise the interactive fallback (0 = never)
+STUB_FAIL_EVERY = int(os.getenv("STUB_FAIL_EVERY", 0))
+
+app = Flask(__name__)
+files = {}
+batches = {}
+
+def _file_object(file_id):
+    entry = files[file_id]
+    return {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(entry["content"]),
+        "created_at": entry["created_at"],
+        "filename": entry["filename"],
+        "purpose": entry["purpose"],
+        "status": "processed"
+    }
+
+def _stub_answer(body):
+    """A minimal answer document that mentions how many pages were sent"""
+    content = body["messages"][0]["content"]
+    pages = sum(1 for part in content if isinstance(part, dict) and part.get("type") != "text")
+    return f"""\\documentclass[12pt]{{article}}
+\\begin{{document}}
+\\title{{Student Answer Sheet Analysis}}
+\\maketitle
+\\section*{{Questions and Student Responses}}
+\\subsection*{{Question 1}}
+\\textbf{{Question:}} Stub question
+
+\\textbf{{Student Answer:}}
+\\begin{{quote}}
+Stub answer generated from {pages} page(s).
+\\end{{quote}}
+\\end{{document}}"""
+
+def _complete_batch(batch):
+    output_lines, error_lines = [], []
+    for number, line in enumerate(files[batch["input_file_id"]]["content"].decode("utf-8").splitlines(), 1):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        request_id = f"req_{uuid.uuid4().hex[:12]}"
+        if STUB_FAIL_EVERY and number % STUB_FAIL_EVERY == 0:
+            error_lines.append({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": item["custom_id"],
+                "response": None,
+                "error": {"code": "stub_failure", "message": "Simulated request failure"}
+            })
+            continue
+        output_lines.append({
+            "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+            "custom_id": item["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": request_id,
+                "body": {
+                    "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": item["body"].get("model", "gpt-4o"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": _stub_answer(item["body"])},
+                        "finish_reason": "stop"
+                    }]
+                }
+            },
+            "error": None
+        })
+
+    for key, lines in (("output_file_id", output_lines), ("error_file_id", error_lines)):
+        if not lines:
+            continue
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        files[file_id] = {
+            "content": "\n".join(json.dumps(line) for line in lines).encode("utf-8"),
+            "filename": f"{batch['id']}_{key}.jsonl",
+            "purpose": "batch_output",
+            "created_at": int(time.time())
+        }
+        batch[key] = file_id
+
+    batch["status"] = "completed"
+    batch["completed_at"] = int(time.time())
+    batch["request_counts"] = {
+        "total": len(output_lines) + len(error_lines),
+        "completed": len(output_lines),
+        "failed": len(error_lines)
+    }
+
+@app.route("/v1/files", methods=["POST"])
+def create_file():
+    upload = request.files["file"]
+    file_id = f"file-{uuid.uuid4().hex[:24]}"
+    files[file_id] = {
+        "content": upload.read(),
+        "filename": upload.filename,
+        "purpose": request.form.get("purpose", "batch"),
+        "created_at": int(time.time())
+    }
+    return jsonify(_file_object(file_id))
+
+@app.route("/v1/files/<file_id>/content")
+def file_content(file_id):
+    if file_id not in files:
+        return jsonify({"error": {"message": f"No such file: {file_id}"}}), 404
+    return Response(files[file_id]["content"], mimetype="application/jsonl")
+
+@app.route("/v1/batches", methods=["POST"])
+def create_batch():
+    data = request.get_json()
+    if data.get("input_file_id") not in files:
+        return jsonify({"error": {"message": "Unknown input_file_id"}}), 400
+
+    batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+    total = sum(1 for line in files[data["input_file_id"]]["content"].splitlines() if line.strip())
+    batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": data.get("endpoint"),
+        "input_file_id": data["input_file_id"],
+        "completion_window": data.get("completion_window", "24h"),
+        "status": "in_progress",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "metadata": data.get("metadata"),
+        "request_counts": {"total": total, "completed": 0, "failed": 0}
+    }
+    return jsonify(batches[batch_id])
+
+@app.route("/v1/batches/<batch_id>")
+def retrieve_batch(batch_id):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return jsonify({"error": {"message": f"No such batch: {batch_id}"}}), 404
+    if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= STUB_BATCH_SECONDS:
+        _complete_batch(batch)
+    return jsonify(batch)
+
+if __name__ == "__main__":
+    print(f"Stub batch server on http://127.0.0.1:5055/v1 (batches finish after {STUB_BATCH_SECONDS}s)")
+    app.run(host="127.0.0.1", port=5055, threaded=True)
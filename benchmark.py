@@ -0,0 +1,169 @@
+# benchmark.py - Reproducible end-to-end pipeline benchmark against recorded provider responses
+#
+# Record once (needs API keys and network):
+#   python benchmark.py --mode record --model gemini
+# Then measure offline as often as needed:
+#   python benchmark.py --model gemini --latency recorded --repeat 3
+#
+# Every provider call made while recording is saved under benchmarks/recordings,
+# keyed by its full request (prompt text, page images and parameters). Replay serves
+# those responses after a simulated latency, so runs differ only by the code under
+# test. A change that alters a prompt or a rendered page needs a fresh recording.
+import argparse
+import asyncio
+import glob
+import json
+import os
+import statistics
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Stages reported in pipeline order; anything else recorded is listed after them
+REPORT_STAGES = ("rasterize", "png_write", "base64_encode", "provider", "validation", "latex_compile",
+                 "question_extraction", "answer_processing")
+RESULTS_DIR = os.path.join("benchmarks", "results")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the grading pipeline with recorded provider responses.")
+    parser.add_argument("--mode", choices=("replay", "record"), default="replay")
+    parser.add_argument("--question", help="question paper PDF (default: newest under uploads/question_data)")
+    parser.add_argument("--students", default=os.path.join("uploads", "students_data"),
+                        help="folder of answer PDFs, searched recursively")
+    parser.add_argument("--limit", type=int, help="only the first N answer sheets")
+    parser.add_argument("--model", choices=("gemini", "openai"), default="gemini")
+    parser.add_argument("--recordings", help="recordings folder (default: benchmarks/recordings)")
+    parser.add_argument("--latency", help='replay latency: "recorded" or a fixed number of seconds per call')
+    parser.add_argument("--latency-scale", type=float, help="multiply every replayed latency, e.g. 0 for none")
+    parser.add_argument("--jitter", type=float, help="+/- fraction of latency, seeded per request")
+    parser.add_argument("--repeat", type=int, default=1, help="runs to take the median over")
+    parser.add_argument("--output", default=RESULTS_DIR, help="folder for the JSON report")
+    return parser.parse_args()
+
+def page_count(pdf_path):
+    from pdf2image import pdfinfo_from_path
+    try:
+        return int(pdfinfo_from_path(pdf_path)["Pages"])
+    except Exception as e:
+        print(f"DEBUG: Could not count pages of {pdf_path}: {e}")
+        return 0
+
+def run_once(orchestrator, question_pdf, answer_pdfs, model, output_folder):
+    """One pass over the inputs; returns per-phase stage summaries and per-student wall times"""
+    from utils import metrics
+
+    loop = asyncio.new_event_loop()
+    try:
+        metrics.reset()
+        started = time.perf_counter()
+        question_result = loop.run_until_complete(orchestrator.extract_questions(question_pdf, model))
+        if not question_result.success:
+            raise RuntimeError(f"Question extraction failed: {question_result.error}")
+        questions = {"seconds": time.perf_counter() - started, "stages": metrics.summarize()["stages"]}
+
+        metrics.reset()
+        students = []
+        for answer_pdf in answer_pdfs:
+            started = time.perf_counter()
+            result = loop.run_until_complete(orchestrator.process_exam_documents(
+                question_pdf, answer_pdf, output_folder, model,
+                question_text=question_result.data["question_text"],
+                # Cached answers would skip the very stages being measured
+                strategy_overrides={"use_cache": False}
+            ))
+            students.append({"student": os.path.basename(answer_pdf), "seconds": time.perf_counter() - started,
+                             "success": bool(result.get("success")), "error": result.get("error")})
+        return {"questions": questions, "answers": {"stages": metrics.summarize()["stages"]}, "students": students}
+    finally:
+        loop.close()
+
+def median_stages(runs, phase):
+    """Median total seconds and count per stage across runs"""
+    names = {stage for run in runs for stage in run[phase]["stages"]}
+    ordered = [stage for stage in REPORT_STAGES if stage in names] + sorted(names - set(REPORT_STAGES))
+    stages = {}
+    for stage in ordered:
+        totals = [run[phase]["stages"].get(stage, {}).get("total_seconds", 0.0) for run in runs]
+        counts = [run[phase]["stages"].get(stage, {}).get("count", 0) for run in runs]
+        stages[stage] = {"total_seconds": round(statistics.median(totals), 4), "count": int(statistics.median(counts))}
+    return stages
+
+def print_stages(title, stages, pages):
+    print(f"\n{title}")
+    for stage, summary in stages.items():
+        per_page = f"  {summary['total_seconds'] / pages * 1000:>8.1f} ms/page" if pages else ""
+        print(f"   {stage:<22} {summary['count']:>5} calls  {summary['total_seconds']:>9.3f}s{per_page}")
+
+def main():
+    args = parse_args()
+    from utils import replay
+    settings = replay.configure(mode=args.mode, directory=args.recordings, latency=args.latency,
+                                scale=args.latency_scale, jitter=args.jitter)
+    from agents import ExamProcessingOrchestrator
+
+    question_pdf = args.question or max(glob.glob(os.path.join("uploads", "question_data", "**", "*.pdf"), recursive=True),
+                                        key=os.path.getmtime, default=None)
+    answer_pdfs = sorted(glob.glob(os.path.join(args.students, "**", "*.pdf"), recursive=True))[:args.limit]
+    if not question_pdf or not answer_pdfs:
+        print("❌ Need a question paper and at least one answer sheet (see --question and --students)")
+        return 1
+
+    question_pages = page_count(question_pdf)
+    answer_pages = sum(page_count(path) for path in answer_pdfs)
+    output_folder = os.path.join("tmp", f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(output_folder, exist_ok=True)
+    print(f"🏁 {args.mode} run: {os.path.basename(question_pdf)} ({question_pages} pages) + "
+          f"{len(answer_pdfs)} answer sheets ({answer_pages} pages), {args.model.upper()}, "
+          f"latency {settings['latency']} x{settings['scale']}")
+
+    orchestrator = ExamProcessingOrchestrator()
+    repeat = 1 if args.mode == "record" else max(1, args.repeat)
+    runs = []
+    for number in range(1, repeat + 1):
+        try:
+            run = run_once(orchestrator, question_pdf, answer_pdfs, args.model, output_folder)
+        except replay.ReplayMissError as e:
+            print(f"❌ {e}")
+            return 1
+        runs.append(run)
+        wall = run["questions"]["seconds"] + sum(student["seconds"] for student in run["students"])
+        print(f"   Run {number}/{repeat}: {wall:.2f}s")
+
+    questions = median_stages(runs, "questions")
+    answers = median_stages(runs, "answers")
+    student_seconds = {}
+    for run in runs:
+        for student in run["students"]:
+            student_seconds.setdefault(student["student"], []).append(student["seconds"])
+    failures = {s["student"]: s["error"] for s in runs[-1]["students"] if not s["success"]}
+
+    print_stages(f"📄 Question paper ({question_pages} pages), median of {len(runs)} runs:", questions, question_pages)
+    print_stages(f"📝 Answer sheets ({answer_pages} pages), median of {len(runs)} runs:", answers, answer_pages)
+    print("\n⏱️ Per student (median):")
+    for student, seconds in student_seconds.items():
+        status = f"  ❌ {failures[student]}" if student in failures else ""
+        print(f"   {student:<48} {statistics.median(seconds):>8.2f}s{status}")
+
+    os.makedirs(args.output, exist_ok=True)
+    report_path = os.path.join(args.output, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": datetime.now().isoformat(),
+            "replay": settings,
+            "model": args.model,
+            "question_pdf": question_pdf,
+            "question_pages": question_pages,
+            "answer_pdfs": answer_pdfs,
+            "answer_pages": answer_pages,
+            "questions": questions,
+            "answers": answers,
+            "students": {student: round(statistics.median(seconds), 4) for student, seconds in student_seconds.items()},
+            "runs": runs
+        }, f, indent=2)
+    print(f"\n💾 Report written to {report_path}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
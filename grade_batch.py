@@ -0,0 +1,185 @@
+# grade_batch.py - Headless batch grading of a folder of answer sheets against one question paper
+#
+# Run:   python grade_batch.py uploads/question.pdf uploads/students_data --workers 4 --output outputs/run1
+#
+# The question paper is analyzed and extracted once. Each worker thread owns an
+# orchestrator and an event loop and grades scripts from a shared queue, so there is
+# no web server or per-request setup. Finished students are checkpointed under a run
+# id derived from the inputs: re-running the same command only grades what is left.
+import argparse
+import asyncio
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Default worker threads; each holds one orchestrator and one in-flight student
+DEFAULT_WORKERS = 4
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Grade every answer sheet in a folder against one question paper.")
+    parser.add_argument("question_pdf", help="question paper PDF")
+    parser.add_argument("students", help="folder of student answer PDFs (searched recursively)")
+    parser.add_argument("--output", default=os.path.join("outputs", f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}"),
+                        help="folder for compiled PDFs and the run summary")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="students graded in parallel")
+    parser.add_argument("--model", choices=("gemini", "openai"), default="gemini")
+    parser.add_argument("--cache-dir", help="answer result cache folder (default: cache/answers)")
+    parser.add_argument("--no-cache", action="store_true", help="neither reuse nor store cached answers")
+    parser.add_argument("--checkpoint-dir", help="checkpoint folder (default: checkpoints)")
+    parser.add_argument("--run-id", help="checkpoint run id (default: derived from the input files)")
+    parser.add_argument("--fresh", action="store_true", help="grade every student again, ignoring the checkpoint")
+    parser.add_argument("--profile", action="store_true", help="save a CPU profile and stage timeline per student")
+    return parser.parse_args()
+
+class Worker:
+    """One orchestrator with its own event loop, reused for every student the thread grades"""
+
+    _local = threading.local()
+
+    @classmethod
+    def current(cls):
+        if not hasattr(cls._local, "worker"):
+            cls._local.worker = cls()
+        return cls._local.worker
+
+    def __init__(self):
+        from agents import ExamProcessingOrchestrator
+        self.orchestrator = ExamProcessingOrchestrator()
+        self.loop = asyncio.new_event_loop()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+def grade_student(answer_pdf, question_pdf, question_text, args, checkpoint):
+    from utils.checkpoints import student_key
+
+    student_name = os.path.splitext(os.path.basename(answer_pdf))[0]
+    worker = Worker.current()
+    started = time.perf_counter()
+    try:
+        result = worker.run(worker.orchestrator.process_exam_documents(
+            question_pdf, answer_pdf, args.output, args.model,
+            question_text=question_text,
+            strategy_overrides={"use_cache": False} if args.no_cache else None,
+            profile=args.profile or None
+        ))
+    except Exception as e:
+        result = {"success": False, "error": str(e)}
+    seconds = time.perf_counter() - started
+
+    summary = {
+        "student": student_name,
+        "answer_pdf": answer_pdf,
+        "success": bool(result.get("success")),
+        "seconds": round(seconds, 2),
+        "pdf_filename": result.get("pdf_filename"),
+        "job_id": result.get("job_id"),
+        "error": result.get("error")
+    }
+    if summary["success"]:
+        checkpoint.mark_student(student_key(answer_pdf), "compiled", name=student_name, answer_pdf=answer_pdf,
+                                pdf_filename=summary["pdf_filename"], job_id=summary["job_id"])
+    return summary
+
+def print_summary(results, wall_seconds, workers):
+    from utils import metrics
+
+    graded = [r for r in results if not r.get("resumed")]
+    succeeded = [r for r in graded if r["success"]]
+    latencies = [r["seconds"] for r in graded]
+
+    print("\n📊 Batch summary")
+    print(f"   • Students: {len(results)} ({len(results) - len(graded)} resumed from checkpoint)")
+    print(f"   • Graded: {len(succeeded)} succeeded, {len(graded) - len(succeeded)} failed")
+    print(f"   • Wall time: {wall_seconds:.1f}s with {workers} workers")
+    if wall_seconds > 0 and graded:
+        print(f"   • Throughput: {len(graded) / wall_seconds * 60:.2f} students/min")
+    if latencies:
+        print(f"   • Latency per student: p50 {metrics.percentile(latencies, 50):.1f}s, "
+              f"p90 {metrics.percentile(latencies, 90):.1f}s, p99 {metrics.percentile(latencies, 99):.1f}s, "
+              f"max {max(latencies):.1f}s")
+
+    stages = metrics.summarize()["stages"]
+    if stages:
+        print("   • Stage timings:")
+        for stage, summary in sorted(stages.items(), key=lambda item: -item[1]["total_seconds"]):
+            print(f"       {stage:<24} {summary['count']:>4} runs  total {summary['total_seconds']:>8.1f}s  "
+                  f"avg {summary['avg_seconds']:>6.2f}s")
+
+    for r in graded:
+        if not r["success"]:
+            print(f"   ❌ {r['student']}: {r['error']}")
+
+def main():
+    args = parse_args()
+
+    # Cache and checkpoint locations are read when the pipeline is imported
+    if args.cache_dir:
+        os.environ["RESULT_CACHE_DIR"] = args.cache_dir
+    if args.checkpoint_dir:
+        os.environ["CHECKPOINT_DIR"] = args.checkpoint_dir
+    from utils.checkpoints import CheckpointStore, run_id_for, student_key
+
+    answer_pdfs = sorted(path for path in glob.glob(os.path.join(args.students, "**", "*.pdf"), recursive=True)
+                         if os.path.abspath(path) != os.path.abspath(args.question_pdf))
+    if not answer_pdfs:
+        print(f"❌ No PDFs found in {args.students}")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    workers = max(1, min(args.workers, len(answer_pdfs)))
+
+    checkpoint = CheckpointStore(args.run_id or run_id_for(f"cli_{args.model}", args.question_pdf, answer_pdfs))
+    print(f"🚀 Grading {len(answer_pdfs)} scripts with {workers} workers ({args.model.upper()}, run {checkpoint.run_id})")
+    started = time.perf_counter()
+
+    # Step 1: Questions once for the whole run
+    saved_questions = None if args.fresh else checkpoint.run_stage("questions")
+    if saved_questions:
+        print("📝 Using question text from checkpoint")
+        question_text = saved_questions["question_text"]
+    else:
+        question_result = Worker.current().run(Worker.current().orchestrator.extract_questions(args.question_pdf, args.model))
+        if not question_result.success:
+            print(f"❌ Question extraction failed: {question_result.error}")
+            return 1
+        question_text = question_result.data["question_text"]
+        checkpoint.mark_run("questions", question_text=question_text)
+
+    # Step 2: Every student not already compiled in an earlier run
+    results, pending = [], []
+    for answer_pdf in answer_pdfs:
+        compiled = None if args.fresh else checkpoint.student_stage(student_key(answer_pdf), "compiled")
+        if compiled and os.path.exists(os.path.join(args.output, compiled["pdf_filename"])):
+            results.append({"student": os.path.splitext(os.path.basename(answer_pdf))[0], "answer_pdf": answer_pdf,
+                            "success": True, "resumed": True, "pdf_filename": compiled["pdf_filename"]})
+        else:
+            pending.append(answer_pdf)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grader") as pool:
+        futures = [pool.submit(grade_student, answer_pdf, args.question_pdf, question_text, args, checkpoint)
+                   for answer_pdf in pending]
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            status = "✅" if result["success"] else "❌"
+            print(f"{status} [{done}/{len(pending)}] {result['student']} in {result['seconds']:.1f}s")
+
+    wall_seconds = time.perf_counter() - started
+    print_summary(results, wall_seconds, workers)
+
+    summary_path = os.path.join(args.output, "batch_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump({"run_id": checkpoint.run_id, "model": args.model, "workers": workers,
+                   "wall_seconds": round(wall_seconds, 2), "results": results}, f, indent=2)
+    print(f"💾 Summary written to {summary_path}")
+    return 0 if all(r["success"] for r in results) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
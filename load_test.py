@@ -0,0 +1,248 @@
+# load_test.py - Concurrency sweep against the Flask endpoints with stubbed providers
+#
+# Run:   python load_test.py                                   # spawn a stubbed server, sweep 1,2,4,8,16
+#        python load_test.py --levels 1,4,16 --mix index:1,agentic:1,folders:4
+#        python load_test.py --url http://127.0.0.1:5000       # drive a server started elsewhere
+#
+# The spawned server runs app.py with PROVIDER_REPLAY=stub and RESULT_CACHE=off:
+# providers answer with recorded responses where they exist and canned documents
+# otherwise, after a simulated latency, while uploads, rasterization, validation and
+# pdflatex run for real. Folders it creates under uploads/ and outputs/ are removed
+# afterwards. Start an external server the same way to load-test it with stubs.
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import httpx
+
+# Requests each worker sends per concurrency level
+DEFAULT_REQUESTS_PER_WORKER = 5
+# A pipeline request can legitimately take minutes
+REQUEST_TIMEOUT_SECONDS = 600
+SERVER_START_TIMEOUT_SECONDS = 60
+RESULTS_DIR = os.path.join("benchmarks", "results")
+# Folders and files the app writes into, restored after a spawned run
+TOUCHED_FOLDERS = (os.path.join("uploads", "question_data"), os.path.join("uploads", "students_data"), "outputs")
+FOLDERS_META_FILE = "folders_metadata.json"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure throughput and latency percentiles as concurrency rises.")
+    parser.add_argument("--url", help="base URL of a running server (default: spawn a stubbed one)")
+    parser.add_argument("--port", type=int, default=5077, help="port for the spawned server")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS_PER_WORKER, help="requests per worker per level")
+    parser.add_argument("--mix", default="index:1,agentic:1,folders:2", help="route:weight pairs (index, agentic, folders)")
+    parser.add_argument("--question", help="question paper PDF to upload (default: newest under uploads/question_data)")
+    parser.add_argument("--student", help="answer PDF to upload (default: first under uploads/students_data)")
+    parser.add_argument("--model", choices=("gemini", "openai"), default="gemini")
+    parser.add_argument("--latency", default="recorded",
+                        help='stub provider latency: "recorded" (PROVIDER_STUB_LATENCY for canned responses) or seconds')
+    parser.add_argument("--keep-files", action="store_true", help="keep uploads and outputs the spawned run created")
+    parser.add_argument("--output", default=RESULTS_DIR, help="folder for the JSON and CSV reports")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def serve(port):
+    """Server side of a spawned run: the Flask app on a threaded WSGI server, no reloader"""
+    from werkzeug.serving import make_server
+    from app import app
+    print(f"Stubbed server on http://127.0.0.1:{port}")
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+def spawn_server(args):
+    env = dict(os.environ, PROVIDER_REPLAY="stub", PROVIDER_REPLAY_LATENCY=args.latency, RESULT_CACHE="off")
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            httpx.get(f"{url}/api/metrics", timeout=2)
+            return server, url
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"Server did not start within {SERVER_START_TIMEOUT_SECONDS}s")
+
+def snapshot_files():
+    entries = {folder: set(os.listdir(folder)) if os.path.isdir(folder) else set() for folder in TOUCHED_FOLDERS}
+    metadata = open(FOLDERS_META_FILE, "rb").read() if os.path.exists(FOLDERS_META_FILE) else None
+    return entries, metadata
+
+def restore_files(snapshot):
+    entries, metadata = snapshot
+    removed = 0
+    for folder, before in entries.items():
+        for name in set(os.listdir(folder)) - before if os.path.isdir(folder) else ():
+            path = os.path.join(folder, name)
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            removed += 1
+    if metadata is not None:
+        with open(FOLDERS_META_FILE, "wb") as f:
+            f.write(metadata)
+    print(f"🧹 Removed {removed} uploads/outputs created by the run")
+
+class Routes:
+    """The three routes under test, with their payloads read once"""
+
+    def __init__(self, question_pdf, student_pdf, model):
+        self.question_pdf = question_pdf
+        self.student_pdf = student_pdf
+        self.model = model
+        self.question_bytes = open(question_pdf, "rb").read()
+        self.student_bytes = open(student_pdf, "rb").read()
+
+    def index(self, client):
+        """The upload form: a new question paper and a new student folder, one script selected"""
+        student_name = os.path.basename(self.student_pdf)
+        response = client.post("/", data={
+            "question_option": "new",
+            "student_option": "new",
+            "selected_student_pdf": student_name,
+            "fallback_model": self.model
+        }, files=[
+            ("question_paper", (os.path.basename(self.question_pdf), self.question_bytes, "application/pdf")),
+            ("student_pdfs", (student_name, self.student_bytes, "application/pdf"))
+        ])
+        # Success is a redirect to /results
+        return response.status_code, response.status_code in (302, 303)
+
+    def agentic(self, client):
+        response = client.post("/api/process_agentic", json={
+            "question_pdf": self.question_pdf,
+            "answer_pdf": self.student_pdf,
+            "fallback_model": self.model
+        })
+        try:
+            success = bool(response.json().get("success"))
+        except ValueError:
+            success = False
+        return response.status_code, response.status_code == 200 and success
+
+    def folders(self, client):
+        response = client.get("/api/folders")
+        return response.status_code, response.status_code == 200
+
+def parse_mix(mix):
+    schedule = []
+    for item in mix.split(","):
+        route, _, weight = item.partition(":")
+        if route not in ("index", "agentic", "folders"):
+            raise ValueError(f"Unknown route {route!r} in --mix")
+        schedule.extend([route] * int(weight or 1))
+    return schedule
+
+def run_level(url, routes, schedule, concurrency, requests_per_worker):
+    """concurrency workers each send requests_per_worker requests, cycling through the mix"""
+    samples = []
+    lock = threading.Lock()
+
+    def worker(index):
+        with httpx.Client(base_url=url, timeout=REQUEST_TIMEOUT_SECONDS, follow_redirects=False) as client:
+            for number in range(requests_per_worker):
+                # Offset per worker so every level sends the same mix from the start
+                route = schedule[(index + number * concurrency) % len(schedule)]
+                started = time.perf_counter()
+                try:
+                    status, ok = getattr(routes, route)(client)
+                except httpx.HTTPError as e:
+                    status, ok = type(e).__name__, False
+                sample = {"route": route, "status": status, "ok": ok, "seconds": time.perf_counter() - started}
+                with lock:
+                    samples.append(sample)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return samples, time.perf_counter() - started
+
+def summarize_level(samples, wall_seconds, concurrency):
+    from utils.metrics import percentile
+
+    rows = []
+    for route in ["all"] + sorted({sample["route"] for sample in samples}):
+        selected = [s for s in samples if route == "all" or s["route"] == route]
+        latencies = [s["seconds"] for s in selected]
+        rows.append({
+            "concurrency": concurrency,
+            "route": route,
+            "requests": len(selected),
+            "errors": sum(1 for s in selected if not s["ok"]),
+            "throughput_rps": round(len(selected) / wall_seconds, 3) if wall_seconds else 0.0,
+            "p50_seconds": round(percentile(latencies, 50), 3),
+            "p90_seconds": round(percentile(latencies, 90), 3),
+            "p99_seconds": round(percentile(latencies, 99), 3),
+            "max_seconds": round(max(latencies), 3) if latencies else 0.0
+        })
+    return rows
+
+def print_rows(rows):
+    print(f"   {'route':<9} {'reqs':>5} {'errors':>6} {'req/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for row in rows:
+        print(f"   {row['route']:<9} {row['requests']:>5} {row['errors']:>6} {row['throughput_rps']:>8.2f} "
+              f"{row['p50_seconds']:>7.2f}s {row['p90_seconds']:>7.2f}s {row['p99_seconds']:>7.2f}s {row['max_seconds']:>7.2f}s")
+
+def main():
+    args = parse_args()
+    if args.serve:
+        serve(args.port)
+        return 0
+
+    question_pdf = args.question or max(glob.glob(os.path.join("uploads", "question_data", "**", "*.pdf"), recursive=True),
+                                        key=os.path.getmtime, default=None)
+    student_pdf = args.student or next(iter(sorted(glob.glob(os.path.join("uploads", "students_data", "**", "*.pdf"),
+                                                             recursive=True))), None)
+    if not question_pdf or not student_pdf:
+        print("❌ Need a question paper and an answer sheet to upload (see --question and --student)")
+        return 1
+    routes = Routes(question_pdf, student_pdf, args.model)
+    schedule = parse_mix(args.mix)
+    levels = [int(level) for level in args.levels.split(",")]
+
+    server, snapshot = None, None
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        snapshot = snapshot_files()
+        server, url = spawn_server(args)
+    print(f"🔥 Load test against {url}: levels {levels}, {args.requests} requests per worker, mix {args.mix}")
+
+    rows = []
+    try:
+        for concurrency in levels:
+            samples, wall_seconds = run_level(url, routes, schedule, concurrency, args.requests)
+            level_rows = summarize_level(samples, wall_seconds, concurrency)
+            rows.extend(level_rows)
+            print(f"\n📈 Concurrency {concurrency}: {len(samples)} requests in {wall_seconds:.1f}s")
+            print_rows(level_rows)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if snapshot and not args.keep_files:
+            restore_files(snapshot)
+
+    os.makedirs(args.output, exist_ok=True)
+    stem = os.path.join(args.output, f"loadtest_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    with open(f"{stem}.json", "w", encoding="utf-8") as f:
+        json.dump({"url": url, "levels": levels, "requests_per_worker": args.requests, "mix": args.mix,
+                   "question_pdf": question_pdf, "student_pdf": student_pdf, "rows": rows}, f, indent=2)
+    with open(f"{stem}.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\n💾 Curves written to {stem}.csv and {stem}.json")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
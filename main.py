@@ -9,8 +9,18 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Keep your original utility imports
-from utils.ocr_openai import pdf_to_images, gpt4o_extract_answer_latex, gpt4o_extract_questions
+from utils.ocr_openai import pdf_to_images, DEFAULT_DPI, gpt4o_extract_answer_latex, gpt4o_extract_questions
 from utils.ocr_gemini import gemini_extract_answer_latex, gemini_extract_question_text
+from utils.page_stats import triage_pages
+from utils.metrics import timed
+from utils.profiling import profile_workflow
+from utils.pdf_text import typed_page_items
+from utils.hashing import file_sha256
+from utils.singleflight import SingleFlight
+from utils.result_cache import answer_cache_key, load_answer, store_answer
+from utils.resilience import retry_allowed, retry_budget
+from utils.latex_lint import lint_latex
+from utils.validation import validate_questions
 
 # Import agentic components
 try:
@@ -49,7 +59,19 @@ if AGENTIC_AVAILABLE:
         print(f"Failed to initialize orchestrator: {e}")
         AGENTIC_AVAILABLE = False
 
+_question_flights = SingleFlight("question_extraction")
+
 def extract_question_text(pdf_path: str, fallback_model: str = "gemini"):
+    """Extract questions; concurrent requests for the same paper and model share one extraction"""
+    key = (file_sha256(pdf_path), fallback_model)
+    return _question_flights.do(key, lambda: _with_retry_budget(_extract_question_text, pdf_path, fallback_model))
+
+def _with_retry_budget(fn, *args):
+    """Run one workflow under its own retry budget, shared by every fallback layer below it"""
+    with retry_budget():
+        return fn(*args)
+
+def _extract_question_text(pdf_path: str, fallback_model: str = "gemini"):
     """Extract questions using agentic system with proper model selection"""
     try:
         if AGENTIC_AVAILABLE:
@@ -98,10 +120,10 @@ def extract_question_text(pdf_path: str, fallback_model: str = "gemini"):
                     print(f"   • Model used: {extraction_result.data['model_used']}")
                     print(f"   • Confidence: {extraction_result.confidence:.2f}")
                     
-                    # Enhanced validation for multi-page content
-                    validation_result = _validate_extracted_questions(question_text, pages_processed)
+                    # Reuse the extractor's validation; only multi-page completeness is left to check
+                    validation_result = extraction_result.data.get("validation") or validate_questions(question_text, pages_processed)
                     
-                    if not validation_result["is_valid"]:
+                    if not validation_result["complete"] and retry_allowed("questions.fallback_model"):
                         print("⚠️ Validation failed, retrying with fallback model...")
                         strategy["recommended_model"] = fallback_model
                         extraction_task["strategy"] = strategy
@@ -127,38 +149,6 @@ def extract_question_text(pdf_path: str, fallback_model: str = "gemini"):
         print(f"❌ Agentic extraction failed, using enhanced fallback method: {e}")
         return _enhanced_extract_question_text(pdf_path, fallback_model)
 
-def _validate_extracted_questions(question_text: str, num_pages: int) -> dict:
-    """Validate extracted questions for multi-page completeness"""
-    validation = {
-        "is_valid": True,
-        "issues": []
-    }
-    
-    if not question_text or len(question_text.strip()) < 100:
-        validation["is_valid"] = False
-        validation["issues"].append("Text too short")
-        return validation
-    
-    # Check for reasonable content per page
-    if num_pages > 1:
-        expected_min_length = num_pages * 150
-        if len(question_text) < expected_min_length:
-            validation["is_valid"] = False
-            validation["issues"].append(f"Insufficient content for {num_pages} pages")
-    
-    # Check for question patterns
-    import re
-    question_count = len(re.findall(r'Question\s+\d+', question_text, re.IGNORECASE))
-    
-    if question_count == 0:
-        validation["is_valid"] = False
-        validation["issues"].append("No questions detected")
-    elif num_pages > 1 and question_count < 2:
-        validation["is_valid"] = False
-        validation["issues"].append("Too few questions for multi-page document")
-    
-    return validation
-
 def _enhanced_extract_question_text(pdf_path: str, model: str = "gemini"):
     """Enhanced question extraction method with multi-page support"""
     try:
@@ -216,7 +206,7 @@ Process ALL pages and output only the extracted questions in the specified forma
         print(f"📝 {model.upper()} returned {len(result)} characters")
         
         # Post-process and validate result
-        if not result or len(result.strip()) < 50:
+        if (not result or len(result.strip()) < 50) and retry_allowed("questions.alternative_prompt"):
             print("⚠️ First attempt produced insufficient content, trying alternative approach...")
             
             # Try with more specific prompt
@@ -243,8 +233,8 @@ Extract ALL questions from ALL pages completely and accurately.'''
             print(f"📝 Fallback attempt returned {len(result)} characters")
         
         # Final validation
-        final_validation = _validate_extracted_questions(result, len(image_paths))
-        if final_validation["is_valid"]:
+        final_validation = validate_questions(result, len(image_paths))
+        if final_validation["is_valid"] and final_validation["complete"]:
             print("✅ Enhanced question extraction complete and validated")
         else:
             print(f"⚠️ Validation issues: {final_validation['issues']}")
@@ -256,8 +246,17 @@ Extract ALL questions from ALL pages completely and accurately.'''
         print(traceback.format_exc())
         return f"Error extracting questions: {str(e)}"
 
-def process_student_pdf(filename: str, question_text: str, output_folder: str, fallback_model: str = "gemini"):
-    """Process student PDF with agentic system - using proper model selection"""
+def process_student_pdf(filename: str, question_text: str, output_folder: str, fallback_model: str = "gemini",
+                        profile: bool = None):
+    """Process student PDF with agentic system - using proper model selection
+    
+    profile (default: PROFILE_WORKFLOWS) saves a CPU profile and stage timeline next to the PDF
+    """
+    student_name = os.path.splitext(filename)[0]
+    with profile_workflow(f"{student_name}_answers", output_folder, enabled=profile):
+        return _with_retry_budget(_process_student_pdf, filename, question_text, output_folder, fallback_model)
+
+def _process_student_pdf(filename: str, question_text: str, output_folder: str, fallback_model: str = "gemini"):
     try:
         student_name = os.path.splitext(filename)[0]
         local_path = os.path.join("uploads/students_data", filename)
@@ -289,8 +288,8 @@ def process_student_pdf(filename: str, question_text: str, output_folder: str, f
                     recommended_model = strategy["recommended_model"]
                     print(f"🎯 Agentic system recommends for answer processing: {recommended_model}")
                     
-                    # Use the recommended model for processing
-                    return _enhanced_process_student_pdf(filename, question_text, output_folder, recommended_model)
+                    # Use the recommended model and render settings for processing
+                    return _enhanced_process_student_pdf(filename, question_text, output_folder, recommended_model, strategy)
                 else:
                     print("⚠️ Analysis failed, using fallback model")
                     return _enhanced_process_student_pdf(filename, question_text, output_folder, fallback_model)
@@ -305,7 +304,7 @@ def process_student_pdf(filename: str, question_text: str, output_folder: str, f
         print(f"❌ Error in agentic student processing: {e}")
         return _enhanced_process_student_pdf(filename, question_text, output_folder, fallback_model)
 
-def _enhanced_process_student_pdf(filename: str, question_text: str, output_folder: str, model: str = "gemini"):
+def _enhanced_process_student_pdf(filename: str, question_text: str, output_folder: str, model: str = "gemini", strategy: dict = None):
     """Enhanced processing with better question-answer mapping"""
     try:
         student_name = os.path.splitext(filename)[0]
@@ -316,12 +315,110 @@ def _enhanced_process_student_pdf(filename: str, question_text: str, output_fold
             print(f"❌ File not found: {local_path}")
             return None
             
-        print("📄 Converting student PDF to images...")
-        image_pages = pdf_to_images(local_path)
-        print(f"🖼️ Generated {len(image_pages)} pages")
+        strategy = strategy or {}
+        # Re-runs of the same script against the same paper skip rendering and model calls
+        cache_key = answer_cache_key(local_path, question_text, model, "enhanced")
+        cached = load_answer(cache_key)
+        if cached:
+            print(f"♻️ Reusing cached {cached.get('model', model).upper()} output from {cached.get('created')}")
+            latex_output = cached["latex_output"]
+        else:
+            latex_output = _extract_student_latex(local_path, student_name, question_text, model, strategy)
+            store_answer(cache_key, latex_output, model=model)
 
-        # Enhanced prompt with better question-answer mapping
-        enhanced_prompt = f'''Create a comprehensive LaTeX document that maps student answers to exam questions.
+        print(f"📝 Raw AI output preview: {latex_output[:300] if latex_output else 'No output'}...")
+        
+        # Enhanced cleaning and validation
+        latex_output = enhanced_clean_latex_output(latex_output, question_text, student_name)
+        latex_output, lint_issues = lint_latex(latex_output)
+        if lint_issues:
+            print(f"🧹 LaTeX lint: {'; '.join(lint_issues)}")
+        
+        tex_path = os.path.join(output_folder, f"{student_name}_answers.tex")
+        print(f"💾 Writing enhanced LaTeX to: {tex_path}")
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(latex_output)
+
+        print("🔨 Compiling LaTeX to PDF...")
+        with timed("latex_compile", student=student_name):
+            compile_command = [
+                "pdflatex",
+                "-interaction=nonstopmode",
+                "-output-directory", output_folder,
+                tex_path
+            ]
+
+            result = subprocess.run(compile_command, capture_output=True, text=True)
+        
+            # Try compilation twice (common LaTeX practice for references)
+            if result.returncode == 0:
+                subprocess.run(compile_command, capture_output=True, text=True)
+        
+            pdf_path = os.path.join(output_folder, f"{student_name}_answers.pdf")
+        
+            if not os.path.exists(pdf_path):
+                print(f"❌ LaTeX compile error: {result.stderr}")
+                print(f"📋 LaTeX stdout: {result.stdout}")
+            
+                # Create enhanced fallback PDF
+                error_latex = create_enhanced_fallback_latex(
+                    f"LaTeX compilation failed.\n\nError: {result.stderr}\n\nGenerated LaTeX:\n{latex_output[:1000]}",
+                    question_text,
+                    student_name
+                )
+                with open(tex_path, "w", encoding="utf-8") as f:
+                    f.write(error_latex)
+            
+                # Try compiling the fallback
+                fallback_result = subprocess.run(compile_command, capture_output=True, text=True)
+                if fallback_result.returncode != 0 or not os.path.exists(pdf_path):
+                    print("❌ Even enhanced fallback compilation failed")
+                    return None
+            
+        print(f"✅ PDF generated for {student_name}")
+
+        # Cleanup temporary files
+        base_name = f"{student_name}_answers"
+        cleanup_extensions = [".aux", ".log", ".tex", ".fdb_latexmk", ".fls", ".synctex.gz", ".out", ".toc"]
+        
+        for ext in cleanup_extensions:
+            cleanup_file = os.path.join(output_folder, f"{base_name}{ext}")
+            try:
+                if os.path.exists(cleanup_file):
+                    os.remove(cleanup_file)
+            except Exception as e:
+                print(f"⚠️ Could not remove {cleanup_file}: {e}")
+
+        return f"{student_name}_answers.pdf"
+        
+    except Exception as e:
+        print(f"❌ Error in _enhanced_process_student_pdf: {e}")
+        print(traceback.format_exc())
+        return None
+
+def _extract_student_latex(local_path: str, student_name: str, question_text: str, model: str, strategy: dict) -> str:
+    """Render the student's pages and run the answer extraction model"""
+    print("📄 Converting student PDF to images...")
+    dpi = strategy.get("dpi_setting", DEFAULT_DPI)
+    preprocess = strategy.get("preprocessing_needed", False)
+    with timed("render", dpi=dpi, preprocessed=preprocess):
+        # Typed pages go as text plus figure crops; only the rest is rendered
+        typed_pages, total_pages = typed_page_items(local_path, f"tmp/{student_name}/figures")
+        scan_pages = [num for num in range(1, total_pages + 1) if num not in typed_pages]
+        if not typed_pages:
+            rendered = dict(enumerate(pdf_to_images(local_path, dpi=dpi, preprocess=preprocess), 1))
+        elif scan_pages:
+            rendered = dict(zip(scan_pages, pdf_to_images(local_path, dpi=dpi, pages=scan_pages, preprocess=preprocess)))
+        else:
+            rendered = {}
+    print(f"🖼️ Generated {len(rendered)} page images and {len(typed_pages)} typed pages")
+    kept_paths, _ = triage_pages(list(rendered.values())) if rendered else ([], [])
+    pages = {num: path for num, path in rendered.items() if path in kept_paths}
+    pages.update(typed_pages)
+    image_pages = [pages[num] for num in sorted(pages)]
+
+    # Enhanced prompt with better question-answer mapping
+    enhanced_prompt = f'''Create a comprehensive LaTeX document that maps student answers to exam questions.
 
 REQUIRED OUTPUT: Complete LaTeX document starting with \\documentclass and ending with \\end{{document}}
 
@@ -371,77 +468,14 @@ QUESTION PAPER CONTENT:
 STUDENT ANSWER SHEET:
 Now examine the answer sheet images and create the complete LaTeX document.'''
 
-        print(f"🤖 Extracting answers with enhanced mapping using {model.upper()}...")
+    print(f"🤖 Extracting answers with enhanced mapping using {model.upper()}...")
+    with timed("answer_extraction", model=model, pages=len(image_pages)):
         if model == "gemini":
             latex_output = gemini_extract_answer_latex(image_pages, question_text, enhanced_prompt)
         else:
             latex_output = gpt4o_extract_answer_latex(image_pages, question_text, enhanced_prompt)
 
-        print(f"📝 Raw AI output preview: {latex_output[:300] if latex_output else 'No output'}...")
-        
-        # Enhanced cleaning and validation
-        latex_output = enhanced_clean_latex_output(latex_output, question_text, student_name)
-        
-        tex_path = os.path.join(output_folder, f"{student_name}_answers.tex")
-        print(f"💾 Writing enhanced LaTeX to: {tex_path}")
-        with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(latex_output)
-
-        print("🔨 Compiling LaTeX to PDF...")
-        compile_command = [
-            "pdflatex",
-            "-interaction=nonstopmode",
-            "-output-directory", output_folder,
-            tex_path
-        ]
-
-        result = subprocess.run(compile_command, capture_output=True, text=True)
-        
-        # Try compilation twice (common LaTeX practice for references)
-        if result.returncode == 0:
-            subprocess.run(compile_command, capture_output=True, text=True)
-        
-        pdf_path = os.path.join(output_folder, f"{student_name}_answers.pdf")
-        
-        if not os.path.exists(pdf_path):
-            print(f"❌ LaTeX compile error: {result.stderr}")
-            print(f"📋 LaTeX stdout: {result.stdout}")
-            
-            # Create enhanced fallback PDF
-            error_latex = create_enhanced_fallback_latex(
-                f"LaTeX compilation failed.\n\nError: {result.stderr}\n\nGenerated LaTeX:\n{latex_output[:1000]}",
-                question_text,
-                student_name
-            )
-            with open(tex_path, "w", encoding="utf-8") as f:
-                f.write(error_latex)
-            
-            # Try compiling the fallback
-            fallback_result = subprocess.run(compile_command, capture_output=True, text=True)
-            if fallback_result.returncode != 0 or not os.path.exists(pdf_path):
-                print("❌ Even enhanced fallback compilation failed")
-                return None
-            
-        print(f"✅ PDF generated for {student_name}")
-
-        # Cleanup temporary files
-        base_name = f"{student_name}_answers"
-        cleanup_extensions = [".aux", ".log", ".tex", ".fdb_latexmk", ".fls", ".synctex.gz", ".out", ".toc"]
-        
-        for ext in cleanup_extensions:
-            cleanup_file = os.path.join(output_folder, f"{base_name}{ext}")
-            try:
-                if os.path.exists(cleanup_file):
-                    os.remove(cleanup_file)
-            except Exception as e:
-                print(f"⚠️ Could not remove {cleanup_file}: {e}")
-
-        return f"{student_name}_answers.pdf"
-        
-    except Exception as e:
-        print(f"❌ Error in _enhanced_process_student_pdf: {e}")
-        print(traceback.format_exc())
-        return None
+    return latex_output
 
 def enhanced_clean_latex_output(latex_text: str, question_text: str, student_name: str) -> str:
     """Enhanced LaTeX cleaning and validation with question integration"""
@@ -629,7 +663,8 @@ Please try processing again or check the input files.
 \\end{{document}}"""
 
 # New agentic processing function for direct use
-async def process_exam_documents_agentic(question_pdf: str, answer_pdf: str, output_folder: str, fallback_model: str = "gemini"):
+async def process_exam_documents_agentic(question_pdf: str, answer_pdf: str, output_folder: str, fallback_model: str = "gemini",
+                                         profile: bool = None):
     """
     Direct agentic processing function for advanced use cases
     Returns detailed workflow information
@@ -642,10 +677,49 @@ async def process_exam_documents_agentic(question_pdf: str, answer_pdf: str, out
         }
     
     try:
-        return await orchestrator.process_exam_documents(question_pdf, answer_pdf, output_folder, fallback_model)
+        return await orchestrator.process_exam_documents(question_pdf, answer_pdf, output_folder, fallback_model,
+                                                         profile=profile)
     except Exception as e:
         return {
             "success": False,
             "error": str(e),
             "fallback_used": True
-        }
\ No newline at end of file
+        }
+
+async def process_exam_batch_offline(question_pdf: str, answer_pdfs: list, output_folder: str, poll_interval: int = 60):
+    """
+    Offline grading of a whole class through the OpenAI Batch API
+    Returns per-student results once every batch job has finished
+    """
+    if not AGENTIC_AVAILABLE:
+        return {
+            "success": False,
+            "error": "Agentic system not available"
+        }
+    
+    try:
+        return await orchestrator.process_exam_batch_offline(question_pdf, answer_pdfs, output_folder, poll_interval)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+async def rebuild_job_from_stage(job_id: str, stage: str):
+    """
+    Re-run a stored agentic job from "extract", "clean" or "compile"
+    using the artifacts kept from its previous run
+    """
+    if not AGENTIC_AVAILABLE:
+        return {
+            "success": False,
+            "error": "Agentic system not available"
+        }
+    
+    try:
+        return await orchestrator.rebuild_from_stage(job_id, stage)
+    except Exception as e:
+        return {
+            "success": False,
+            "error": str(e)
+        }
@@ -0,0 +1,82 @@
+# utils/artifacts.py - Per-job artifact directories with a manifest of stage outputs
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "artifacts")
+# Stage outputs in pipeline order
+STAGES = ("questions", "pages", "raw", "cleaned", "pdf")
+MANIFEST_NAME = "manifest.json"
+
+def new_job_id(student_name):
+    return f"{student_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+class JobArtifacts:
+    """Stage outputs of one student's run plus the inputs needed to re-run it.
+
+    manifest.json records the inputs and, per stage, its files and completion time.
+    """
+
+    def __init__(self, job_id, manifest):
+        self.job_id = job_id
+        self.path = os.path.join(ARTIFACTS_DIR, job_id)
+        self.manifest = manifest
+
+    @classmethod
+    def create(cls, job_id, **inputs):
+        os.makedirs(os.path.join(ARTIFACTS_DIR, job_id), exist_ok=True)
+        artifacts = cls(job_id, {"job_id": job_id, "created": datetime.now().isoformat(), "inputs": inputs, "stages": {}})
+        artifacts._write_manifest()
+        return artifacts
+
+    @classmethod
+    def load(cls, job_id):
+        path = os.path.join(ARTIFACTS_DIR, job_id, MANIFEST_NAME)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No artifacts for job {job_id}")
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(job_id, json.load(f))
+
+    def _write_manifest(self):
+        path = os.path.join(self.path, MANIFEST_NAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def _record(self, stage, files, **details):
+        self.manifest["stages"][stage] = {"files": files, "completed": datetime.now().isoformat(), **details}
+        # Later stages were produced from the old output and are now stale
+        for later in STAGES[STAGES.index(stage) + 1:]:
+            self.manifest["stages"].pop(later, None)
+        self._write_manifest()
+
+    def save_text(self, stage, filename, text, **details):
+        with open(os.path.join(self.path, filename), "w", encoding="utf-8") as f:
+            f.write(text or "")
+        self._record(stage, [filename], **details)
+
+    def save_files(self, stage, paths, **details):
+        """Copy files (e.g. page images or the compiled PDF) into the stage directory"""
+        stage_dir = os.path.join(self.path, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        names = []
+        for source in paths:
+            name = os.path.basename(source)
+            shutil.copy2(source, os.path.join(stage_dir, name))
+            names.append(os.path.join(stage, name))
+        self._record(stage, names, **details)
+
+    def has_stage(self, stage):
+        return stage in self.manifest["stages"]
+
+    def stage_files(self, stage):
+        if not self.has_stage(stage):
+            raise FileNotFoundError(f"Job {self.job_id} has no '{stage}' artifact")
+        return [os.path.join(self.path, name) for name in self.manifest["stages"][stage]["files"]]
+
+    def read_text(self, stage):
+        with open(self.stage_files(stage)[0], "r", encoding="utf-8") as f:
+            return f.read()
@@ -0,0 +1,100 @@
+# utils/checkpoints.py - Per-student, per-stage progress of batch runs, kept on local disk
+import json
+import os
+import threading
+from datetime import datetime
+from utils.hashing import file_sha256, text_sha256
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+
+def run_id_for(mode, question_pdf, answer_pdfs):
+    """Stable id for a class run, so restarting the same run finds its checkpoint"""
+    hashes = sorted(file_sha256(path) for path in answer_pdfs)
+    return f"{mode}_{text_sha256('|'.join([file_sha256(question_pdf)] + hashes))[:16]}"
+
+def student_key(answer_pdf):
+    """Students are tracked by script content, so renamed or re-uploaded files still match"""
+    return file_sha256(answer_pdf)[:16]
+
+class CheckpointStore:
+    """JSON checkpoint of one batch run, rewritten atomically after every update.
+
+    Layout: {"run_id", "created", "updated", "run": {stage: data},
+             "students": {key: {"name", "answer_pdf", "stages": {stage: data}}},
+             "batches": {batch_id: {"custom_ids", "status"}}}
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.path = os.path.join(CHECKPOINT_DIR, f"{run_id}.json")
+        self.lock = threading.Lock()
+        self.state = self._read() or {
+            "run_id": run_id,
+            "created": datetime.now().isoformat(),
+            "run": {},
+            "students": {},
+            "batches": {}
+        }
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            print(f"DEBUG: Resuming run {self.run_id} from checkpoint ({len(state.get('students', {}))} students tracked)")
+            return state
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            # A corrupt checkpoint only costs a full re-run, never a crash
+            print(f"DEBUG: Ignoring unreadable checkpoint {self.path}: {e}")
+            return None
+
+    def _write(self):
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self.state["updated"] = datetime.now().isoformat()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    # Run-level stages (e.g. extracted question text)
+    def run_stage(self, stage):
+        return self.state["run"].get(stage)
+
+    def mark_run(self, stage, **data):
+        with self.lock:
+            self.state["run"][stage] = {"completed": datetime.now().isoformat(), **data}
+            self._write()
+
+    # Student stages
+    def student_stage(self, key, stage):
+        return self.state["students"].get(key, {}).get("stages", {}).get(stage)
+
+    def mark_student(self, key, stage, name=None, answer_pdf=None, **data):
+        with self.lock:
+            student = self.state["students"].setdefault(key, {"name": name, "answer_pdf": answer_pdf, "stages": {}})
+            if answer_pdf:
+                # Keep the latest path in case the file moved since the last run
+                student["answer_pdf"] = answer_pdf
+            student["stages"][stage] = {"completed": datetime.now().isoformat(), **data}
+            self._write()
+
+    def clear_student_stage(self, key, stage):
+        with self.lock:
+            self.state["students"].get(key, {}).get("stages", {}).pop(stage, None)
+            self._write()
+
+    # Provider batch jobs
+    def record_batch(self, batch_id, custom_ids):
+        with self.lock:
+            self.state["batches"][batch_id] = {"custom_ids": list(custom_ids), "status": "submitted"}
+            self._write()
+
+    def update_batch(self, batch_id, status):
+        with self.lock:
+            self.state["batches"].setdefault(batch_id, {"custom_ids": []})["status"] = status
+            self._write()
+
+    def unfinished_batches(self):
+        """Batches submitted by an earlier process whose results were never collected"""
+        return [batch_id for batch_id, batch in self.state["batches"].items() if batch["status"] == "submitted"]
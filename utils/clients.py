@@ -0,0 +1,104 @@
+# utils/clients.py - Process-wide provider clients shared by every agent and retry
+import os
+import threading
+import httpx
+import openai
+import google.generativeai as genai
+from dotenv import load_dotenv
+from utils import replay
+from utils.progress import STREAM_STALL_SECONDS
+
+load_dotenv()
+
+GEMINI_MODEL = 'gemini-2.0-flash-exp'
+
+# Vision calls with several pages routinely take over a minute to answer
+CONNECT_TIMEOUT_SECONDS = 10.0
+READ_TIMEOUT_SECONDS = 180.0
+WRITE_TIMEOUT_SECONDS = 60.0
+POOL_TIMEOUT_SECONDS = 30.0
+# Sized above the adaptive concurrency ceiling so the pool never becomes the limit
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+KEEPALIVE_EXPIRY_SECONDS = 60.0
+# Streamed responses send chunks continuously, so a long quiet read means a stalled generation
+STREAM_TIMEOUT = httpx.Timeout(
+    STREAM_STALL_SECONDS,
+    connect=CONNECT_TIMEOUT_SECONDS,
+    write=WRITE_TIMEOUT_SECONDS,
+    pool=POOL_TIMEOUT_SECONDS
+)
+
+_openai_client = None
+_openai_batch_client = None
+_gemini_configured = False
+_gemini_models = {}
+_clients_lock = threading.Lock()
+
+def _http2_available():
+    # httpx only speaks HTTP/2 when the optional h2 package is installed
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def get_openai_client():
+    """Shared OpenAI client with a keep-alive connection pool and tuned timeouts"""
+    global _openai_client
+    with _clients_lock:
+        if _openai_client is None:
+            http_client = httpx.Client(
+                http2=_http2_available(),
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS
+                ),
+                timeout=httpx.Timeout(
+                    READ_TIMEOUT_SECONDS,
+                    connect=CONNECT_TIMEOUT_SECONDS,
+                    write=WRITE_TIMEOUT_SECONDS,
+                    pool=POOL_TIMEOUT_SECONDS
+                )
+            )
+            # 429 retries and backoff are handled by call_with_rate_limit
+            _openai_client = openai.OpenAI(http_client=http_client, max_retries=0)
+        return _openai_client
+
+def get_openai_batch_client():
+    """Client for Batch API traffic; OPENAI_BATCH_BASE_URL points it at a stand-in server"""
+    global _openai_batch_client
+    base_url = os.getenv("OPENAI_BATCH_BASE_URL")
+    if not base_url:
+        return get_openai_client()
+    with _clients_lock:
+        if _openai_batch_client is None:
+            _openai_batch_client = openai.OpenAI(
+                base_url=base_url,
+                api_key=os.getenv("OPENAI_API_KEY") or "batch-stub",
+                timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+            )
+        return _openai_batch_client
+
+def configure_gemini():
+    """Configure the Gemini SDK once per process"""
+    global _gemini_configured
+    with _clients_lock:
+        if _gemini_configured:
+            return
+        # Replayed runs never reach the API, so they need no key
+        api_key = os.getenv("GEMINI_API_KEY") or ("replay" if replay.offline() else None)
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY not found in environment variables")
+        # The gRPC transport keeps one HTTP/2 channel open for every request
+        genai.configure(api_key=api_key, transport="grpc")
+        _gemini_configured = True
+
+def get_gemini_model(name=GEMINI_MODEL):
+    """Shared GenerativeModel for name, built once after configuring the SDK"""
+    configure_gemini()
+    with _clients_lock:
+        if name not in _gemini_models:
+            _gemini_models[name] = genai.GenerativeModel(name)
+        return _gemini_models[name]
@@ -0,0 +1,87 @@
+# utils/concurrency.py - AIMD concurrency window per provider
+import os
+import threading
+import time
+from utils import metrics
+
+DEFAULT_WINDOWS = {
+    "openai": {"initial": 4, "max": 16},
+    "gemini": {"initial": 2, "max": 8}
+}
+# Latency above this multiple of the baseline counts as "not stable"
+LATENCY_TOLERANCE = 1.5
+# Weight of each new sample in the baseline latency average
+LATENCY_SMOOTHING = 0.2
+# One burst of 429s should shrink the window once, not once per request
+DECREASE_COOLDOWN_SECONDS = 2.0
+
+class AdaptiveConcurrencyLimiter:
+    """Additive-increase / multiplicative-decrease limit on in-flight provider calls.
+
+    The window grows by roughly one slot per window's worth of successful calls
+    while latency stays near its baseline, and halves on throttling or timeouts.
+    """
+
+    def __init__(self, name, initial=4, maximum=16, minimum=1):
+        self.name = name
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self._publish()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.window):
+                self.condition.wait()
+            self.in_flight += 1
+            self._publish()
+
+    def release(self, latency, outcome):
+        """Record a finished call; outcome is "ok", "throttled", "timeout" or "error"."""
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self._on_success(latency)
+            elif outcome in ("throttled", "timeout"):
+                self._on_congestion()
+            self._publish()
+            self.condition.notify_all()
+
+    def _on_success(self, latency):
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        stable = latency <= self.baseline_latency * LATENCY_TOLERANCE
+        self.baseline_latency += LATENCY_SMOOTHING * (latency - self.baseline_latency)
+        if stable:
+            self.window = min(self.maximum, self.window + 1.0 / self.window)
+
+    def _on_congestion(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= DECREASE_COOLDOWN_SECONDS:
+            self.window = max(self.minimum, self.window / 2)
+            self.last_decrease = now
+
+    def _publish(self):
+        metrics.set_gauge(f"{self.name}_concurrency_window", round(self.window, 2))
+        metrics.set_gauge(f"{self.name}_in_flight", self.in_flight)
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_concurrency_limiter(provider):
+    with _controllers_lock:
+        if provider not in _controllers:
+            defaults = DEFAULT_WINDOWS.get(provider, {"initial": 2, "max": 8})
+            initial = int(os.getenv(f"{provider.upper()}_CONCURRENCY", defaults["initial"]))
+            maximum = int(os.getenv(f"{provider.upper()}_MAX_CONCURRENCY", defaults["max"]))
+            _controllers[provider] = AdaptiveConcurrencyLimiter(provider, initial, max(initial, maximum))
+        return _controllers[provider]
+
+def is_timeout_error(error):
+    if isinstance(error, TimeoutError):
+        return True
+    return type(error).__name__ in ("APITimeoutError", "Timeout", "ReadTimeout", "DeadlineExceeded")
@@ -0,0 +1,40 @@
+# utils/continuation.py - Stitching length-limited model output with its continuation
+import os
+import re
+
+# Follow-up calls allowed after a length-limited stop before the partial output is returned
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", 2))
+# How far back to look for text the model repeated at the start of its continuation
+MAX_OVERLAP_CHARS = 400
+# Shorter matches are as likely to be coincidence as repetition
+MIN_OVERLAP_CHARS = 8
+
+CONTINUE_PROMPT = """Your previous response was cut off by the output length limit.
+Continue EXACTLY where it stopped. Do not repeat anything already written, do not restart
+the document and do not add commentary or code fences. Close every environment you opened."""
+
+def _strip_leading_fence(text):
+    """Drop a code fence the model may open its continuation with (and the closing one)"""
+    text = re.sub(r'^\s*```(?:latex|tex)?[ \t]*\n', '', text)
+    return re.sub(r'\n?```\s*$', '', text)
+
+def stitch(previous, continuation):
+    """Append a continuation, dropping text it repeats from the end of previous"""
+    continuation = _strip_leading_fence(continuation or "")
+    if not continuation.strip():
+        return previous
+
+    # Longest suffix of previous that the continuation starts with
+    window = min(len(previous), len(continuation), MAX_OVERLAP_CHARS)
+    for size in range(window, MIN_OVERLAP_CHARS - 1, -1):
+        if continuation.startswith(previous[-size:]):
+            return previous + continuation[size:]
+
+    # Otherwise resume on a fresh line when either side is at a line or command boundary,
+    # and mid-word as-is; a single newline is only a space to LaTeX
+    stripped = continuation.lstrip(" \t")
+    if previous.endswith("\n"):
+        return previous + stripped.lstrip("\n")
+    if stripped.startswith(("\n", "\\")):
+        return previous + "\n" + stripped.lstrip("\n")
+    return previous + continuation
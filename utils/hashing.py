@@ -0,0 +1,35 @@
+# utils/hashing.py - Content hashes used as cache and deduplication keys
+import hashlib
+import os
+import threading
+
+# Read files in 1 MB blocks so large scans are not loaded at once
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_CACHE_SIZE = 4096
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def file_sha256(path):
+    """SHA-256 of a file's content, cached by path, size and mtime"""
+    info = os.stat(path)
+    cache_key = (os.path.abspath(path), info.st_size, info.st_mtime_ns)
+    with _hash_lock:
+        cached = _hash_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    result = digest.hexdigest()
+
+    with _hash_lock:
+        if len(_hash_cache) >= HASH_CACHE_SIZE:
+            _hash_cache.clear()
+        _hash_cache[cache_key] = result
+    return result
+
+def text_sha256(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
@@ -0,0 +1,355 @@
+# utils/latex_lint.py - Repair common faults in model-written LaTeX before the first pdflatex run
+import re
+
+# Environments whose content is typeset in math mode
+MATH_ENVS = {"equation", "equation*", "align", "align*", "alignat", "alignat*", "flalign", "flalign*",
+             "gather", "gather*", "multline", "multline*", "eqnarray", "eqnarray*", "displaymath", "math"}
+# Environments whose cells are text even when nested in math
+TEXT_ENVS = {"tabular", "tabular*", "tabularx", "longtable", "minipage"}
+# Environments where & separates columns
+ALIGN_ENVS = {"tabular", "tabular*", "tabularx", "longtable", "array", "align", "align*", "alignat", "alignat*",
+              "flalign", "flalign*", "eqnarray", "eqnarray*", "aligned", "alignedat", "split", "cases",
+              "matrix", "pmatrix", "bmatrix", "Bmatrix", "vmatrix", "Vmatrix", "smallmatrix"}
+# Environments copied through untouched
+VERBATIM_ENVS = {"verbatim", "verbatim*", "lstlisting", "minted", "comment"}
+
+# Math-only commands the models also write in running text, with their number of brace arguments
+MATH_COMMANDS = {
+    "frac": 2, "dfrac": 2, "tfrac": 2, "binom": 2, "sqrt": 1, "overline": 1, "vec": 1, "hat": 1, "bar": 1,
+    "mathbb": 1, "mathbf": 1, "mathrm": 1, "mathcal": 1,
+    "alpha": 0, "beta": 0, "gamma": 0, "delta": 0, "epsilon": 0, "varepsilon": 0, "zeta": 0, "eta": 0,
+    "theta": 0, "lambda": 0, "mu": 0, "nu": 0, "xi": 0, "pi": 0, "rho": 0, "sigma": 0, "tau": 0, "phi": 0,
+    "varphi": 0, "chi": 0, "psi": 0, "omega": 0, "Gamma": 0, "Delta": 0, "Theta": 0, "Lambda": 0,
+    "Sigma": 0, "Phi": 0, "Psi": 0, "Omega": 0, "Pi": 0,
+    "le": 0, "leq": 0, "ge": 0, "geq": 0, "neq": 0, "ne": 0, "approx": 0, "equiv": 0, "times": 0,
+    "div": 0, "cdot": 0, "pm": 0, "mp": 0, "infty": 0, "to": 0, "rightarrow": 0, "leftarrow": 0,
+    "Rightarrow": 0, "Leftarrow": 0, "leftrightarrow": 0, "Leftrightarrow": 0, "in": 0, "notin": 0,
+    "subset": 0, "subseteq": 0, "cup": 0, "cap": 0, "forall": 0, "exists": 0, "partial": 0, "nabla": 0,
+    "sum": 0, "prod": 0, "int": 0, "lim": 0, "log": 0, "ln": 0, "sin": 0, "cos": 0, "tan": 0, "circ": 0
+}
+# Commands whose braced argument is text even inside math
+TEXT_ARG_COMMANDS = {"text", "textrm", "textbf", "textit", "texttt", "textnormal", "mbox", "intertext"}
+# Commands whose arguments are labels, paths or definitions and must not be escaped
+RAW_ARG_COMMANDS = {"label": 1, "ref": 1, "eqref": 1, "pageref": 1, "cite": 1, "url": 1, "href": 1,
+                    "includegraphics": 1, "input": 1, "include": 1, "newcommand": 2, "renewcommand": 2}
+
+# Symbols that pdflatex cannot typeset from UTF-8 text, as math-mode macros
+UNICODE_MATH = {
+    "≤": r"\le", "≥": r"\ge", "≠": r"\neq", "≈": r"\approx", "≡": r"\equiv", "×": r"\times", "÷": r"\div",
+    "±": r"\pm", "∓": r"\mp", "−": "-", "·": r"\cdot", "→": r"\to", "←": r"\leftarrow", "↔": r"\leftrightarrow",
+    "⇒": r"\Rightarrow", "⇐": r"\Leftarrow", "⇔": r"\Leftrightarrow", "∞": r"\infty", "√": r"\surd",
+    "∑": r"\sum", "∏": r"\prod", "∫": r"\int", "∂": r"\partial", "∇": r"\nabla", "∈": r"\in", "∉": r"\notin",
+    "⊂": r"\subset", "⊆": r"\subseteq", "∪": r"\cup", "∩": r"\cap", "∅": r"\emptyset", "∀": r"\forall",
+    "∃": r"\exists", "¬": r"\neg", "∧": r"\wedge", "∨": r"\vee", "°": r"^\circ", "²": "^2", "³": "^3",
+    "α": r"\alpha", "β": r"\beta", "γ": r"\gamma", "δ": r"\delta", "ε": r"\epsilon", "ζ": r"\zeta",
+    "η": r"\eta", "θ": r"\theta", "κ": r"\kappa", "λ": r"\lambda", "μ": r"\mu", "ν": r"\nu", "ξ": r"\xi",
+    "π": r"\pi", "ρ": r"\rho", "σ": r"\sigma", "τ": r"\tau", "φ": r"\phi", "χ": r"\chi", "ψ": r"\psi",
+    "ω": r"\omega", "Γ": r"\Gamma", "Δ": r"\Delta", "Θ": r"\Theta", "Λ": r"\Lambda", "Π": r"\Pi",
+    "Σ": r"\Sigma", "Φ": r"\Phi", "Ψ": r"\Psi", "Ω": r"\Omega"
+}
+_UNICODE_RE = re.compile("[" + "".join(UNICODE_MATH) + "]")
+
+_TOKEN_RE = re.compile(r"""
+    (?P<begin>\\begin\s*\{(?P<begin_name>[^{}]*)\})
+  | (?P<end>\\end\s*\{(?P<end_name>[^{}]*)\})
+  | (?P<verb>\\verb\*?(?P<delim>[^a-zA-Z\s*]).*?(?P=delim))
+  | (?P<word>\\[a-zA-Z@]+)
+  | (?P<symbol>\\[^a-zA-Z@])
+  | (?P<dollar>\$\$?)
+  | (?P<par>\n[ \t]*\n\s*)
+  | (?P<special>[%&#_^{}])
+  | (?P<text>[^\\$%&#_^{}\n]+|\n|\\)
+""", re.VERBOSE | re.DOTALL)
+
+_PACKAGE_USES = {
+    "amsmath": re.compile(r"\\(?:text|dfrac|tfrac|binom|begin\{(?:align|gather|multline|cases|[pbBvV]?matrix|split)\*?\})\b"),
+    "amssymb": re.compile(r"\\(?:mathbb|emptyset|varnothing|therefore|because|square|checkmark)\b")
+}
+# Restarts allowed for moving stray $ signs; each one fixes one paragraph
+MAX_PASSES = 25
+
+class _StrayDollar(Exception):
+    def __init__(self, position):
+        self.position = position
+
+def lint_latex(source):
+    """Repair constructs that would make pdflatex fail; returns (fixed_source, issues).
+
+    Only the document body is rewritten (plus missing math packages in the preamble):
+    special characters in text are escaped, stray $ signs escaped, math-only commands
+    and Unicode math symbols in text wrapped in $...$, unmatched braces and environments
+    closed or dropped. Verbatim content, comments and label/path arguments are left alone.
+    """
+    begin = source.find("\\begin{document}")
+    if begin < 0:
+        return source, []
+    body_start = begin + len("\\begin{document}")
+    end = source.rfind("\\end{document}")
+    if end < body_start:
+        end = len(source)
+    preamble, body, tail = source[:body_start], source[body_start:end], source[end:]
+
+    issues = []
+    if not tail:
+        tail = "\n\\end{document}\n"
+        issues.append("added missing \\end{document}")
+
+    stray = set()
+    for _ in range(MAX_PASSES):
+        try:
+            fixed_body, body_issues = _lint_body(body, stray)
+            break
+        except _StrayDollar as e:
+            stray.add(e.position)
+    else:
+        return source, ["too many stray $ signs, left unchanged"]
+
+    if stray:
+        body_issues.insert(0, f"escaped {len(stray)} stray $")
+    issues.extend(body_issues)
+
+    for package, pattern in _PACKAGE_USES.items():
+        loaded = re.search(r"\\usepackage(?:\[[^\]]*\])?\{[^}]*\b" + package + r"\b", preamble)
+        if not loaded and pattern.search(fixed_body):
+            preamble = preamble.replace("\\begin{document}", f"\\usepackage{{{package}}}\n\\begin{{document}}", 1)
+            issues.append(f"added \\usepackage{{{package}}}")
+
+    return preamble + fixed_body + tail, issues
+
+def _group_end(text, pos):
+    """End of the balanced {...} group starting at pos (or pos itself if there is none)"""
+    if pos >= len(text) or text[pos] != "{":
+        return pos
+    depth = 0
+    i = pos
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return pos
+
+def _skip_space(text, pos):
+    while pos < len(text) and text[pos] in " \t":
+        pos += 1
+    return pos
+
+def _arguments_end(text, pos, count, optional=True):
+    """End of a command's optional [..] argument and count brace arguments"""
+    pos = _skip_space(text, pos)
+    if optional and pos < len(text) and text[pos] == "[":
+        close = text.find("]", pos)
+        pos = close + 1 if close > 0 else pos
+    for _ in range(count):
+        start = _skip_space(text, pos)
+        end = _group_end(text, start)
+        if end == start:
+            break
+        pos = end
+    return pos
+
+def _scripts_end(text, pos):
+    """End of any _x / ^{...} scripts following a math command"""
+    while pos < len(text) and text[pos] in "_^":
+        group = _group_end(text, pos + 1)
+        pos = group if group > pos + 1 else min(len(text), pos + 2)
+    return pos
+
+def _lint_body(body, stray):
+    out = []
+    counts = {}
+    # Open frames, innermost last: {"kind": "env"|"group"|"math", "name", "math", "align", "pos"}
+    stack = [{"kind": "env", "name": "document", "math": False, "align": False, "pos": 0}]
+
+    def note(message):
+        counts[message] = counts.get(message, 0) + 1
+
+    def push(kind, name, math, align, start):
+        stack.append({"kind": kind, "name": name, "math": math, "align": align, "pos": start})
+
+    def innermost(test):
+        return next((i for i in range(len(stack) - 1, 0, -1) if test(stack[i])), None)
+
+    def close_above(index, reason, boundary):
+        """Close every frame above stack[index] at a boundary that ends them"""
+        for frame in stack[index + 1:]:
+            if frame["kind"] == "math" and frame["name"] == "$":
+                # Inline math cannot cross this boundary, so its opening $ was stray
+                raise _StrayDollar(_choose_stray(body, frame["pos"], boundary, stray))
+        while len(stack) > index + 1:
+            frame = stack.pop()
+            if frame["kind"] == "group":
+                out.append("}")
+                note(f"closed unbalanced {{ before {reason}")
+            elif frame["kind"] == "env":
+                out.append(f"\\end{{{frame['name']}}}")
+                note(f"closed \\begin{{{frame['name']}}} before {reason}")
+            else:
+                out.append({"\\[": "\\]", "\\(": "\\)"}.get(frame["name"], frame["name"]))
+                note(f"closed {frame['name']} before {reason}")
+
+    pos = 0
+    next_group_text = False
+    while pos < len(body):
+        match = _TOKEN_RE.match(body, pos)
+        token, kind = match.group(0), match.lastgroup
+        start, pos = pos, match.end()
+        text_group, next_group_text = next_group_text, False
+        in_math = stack[-1]["math"]
+
+        if kind == "begin":
+            name = match.group("begin_name").strip()
+            if name in VERBATIM_ENVS:
+                close = body.find(f"\\end{{{name}}}", pos)
+                pos = len(body) if close < 0 else close + len(f"\\end{{{name}}}")
+                out.append(body[start:pos])
+                continue
+            math = name in MATH_ENVS or (in_math and name not in TEXT_ENVS)
+            push("env", name, math, name in ALIGN_ENVS, start)
+            out.append(token)
+
+        elif kind == "end":
+            name = match.group("end_name").strip()
+            index = innermost(lambda frame: frame["kind"] == "env" and frame["name"] == name)
+            if index is None:
+                note(f"removed unmatched \\end{{{name}}}")
+                continue
+            close_above(index, f"\\end{{{name}}}", start)
+            stack.pop()
+            out.append(token)
+
+        elif kind == "verb":
+            out.append(token)
+
+        elif kind == "word":
+            name = token[1:]
+            if name in RAW_ARG_COMMANDS:
+                pos = _arguments_end(body, pos, RAW_ARG_COMMANDS[name])
+                out.append(body[start:pos])
+            elif name == "def":
+                brace = body.find("{", pos)
+                pos = _group_end(body, brace) if brace >= 0 else pos
+                out.append(body[start:pos])
+            elif name in MATH_COMMANDS and not in_math:
+                pos = _scripts_end(body, _arguments_end(body, pos, MATH_COMMANDS[name], optional=name == "sqrt"))
+                out.append(f"${body[start:pos]}$")
+                note("wrapped math-only commands in $...$")
+            else:
+                next_group_text = name in TEXT_ARG_COMMANDS
+                out.append(token)
+
+        elif kind == "symbol":
+            if token in ("\\[", "\\("):
+                if in_math:
+                    note(f"removed {token} inside math")
+                    continue
+                push("math", token, True, False, start)
+            elif token in ("\\]", "\\)"):
+                opener = "\\[" if token == "\\]" else "\\("
+                index = innermost(lambda frame: frame["kind"] != "group")
+                if index is None or stack[index]["name"] != opener:
+                    note(f"removed unmatched {token}")
+                    continue
+                close_above(index, token, start)
+                stack.pop()
+            out.append(token)
+
+        elif kind == "dollar":
+            index = innermost(lambda frame: frame["kind"] != "group")
+            if start in stray or (in_math and (index is None or stack[index]["name"] != token)):
+                # $ inside display math or a math environment is never intended either
+                out.append("\\$")
+                pos = start + 1
+                if start not in stray:
+                    note("escaped $ inside math")
+            elif index is not None and stack[index]["name"] == token:
+                close_above(index, token, start)
+                stack.pop()
+                out.append(token)
+            else:
+                push("math", token, True, False, start)
+                out.append(token)
+
+        elif kind == "par":
+            index = innermost(lambda frame: frame["kind"] == "math" and frame["name"] in ("$", "\\("))
+            if index is not None:
+                close_above(index - 1, "a paragraph break", start)
+            out.append(token)
+
+        elif kind == "special":
+            if token == "{":
+                push("group", token, False if text_group else in_math, stack[-1]["align"], start)
+                out.append(token)
+            elif token == "}":
+                index = innermost(lambda frame: frame["kind"] == "group")
+                if index is None:
+                    note("removed unmatched }")
+                    continue
+                close_above(index, "}", start)
+                stack.pop()
+                out.append(token)
+            elif token == "%":
+                line_start = body.rfind("\n", 0, start) + 1
+                if body[line_start:start].strip():
+                    out.append("\\%")
+                    note("escaped %")
+                else:
+                    # A whole-line comment stays a comment
+                    close = body.find("\n", start)
+                    pos = len(body) if close < 0 else close
+                    out.append(body[start:pos])
+            elif token == "&":
+                out.append(token if stack[-1]["align"] else "\\&")
+                if not stack[-1]["align"]:
+                    note("escaped &")
+            elif token == "#":
+                out.append("\\#")
+                note("escaped #")
+            elif in_math:
+                out.append(token)
+            else:
+                out.append("\\_" if token == "_" else "\\^{}")
+                note(f"escaped {token} in text")
+
+        else:
+            if not token.strip():
+                # Spacing between a text command and its argument keeps the argument in text mode
+                next_group_text = text_group
+            if _UNICODE_RE.search(token):
+                token = _UNICODE_RE.sub(lambda m: _unicode_math(m.group(0), in_math), token)
+                note("replaced Unicode math symbols")
+            out.append(token)
+
+    close_above(0, "\\end{document}", len(body))
+    issues = [message if count == 1 else f"{message} (x{count})" for message, count in counts.items()]
+    return "".join(out), issues
+
+def _unicode_math(char, math):
+    macro = UNICODE_MATH[char]
+    if math:
+        return macro + " " if macro[-1].isalpha() else macro
+    return f"${macro}$"
+
+def _choose_stray(body, opener, paragraph_end, stray):
+    """Pick the $ to escape in a paragraph with an odd number of them.
+
+    A $ directly before a digit after a space reads as currency ("costs $5");
+    otherwise the $ that opened the unclosed formula is escaped.
+    """
+    paragraph_start = body.rfind("\n\n", 0, opener) + 1
+    for match in re.finditer(r"(?<![\\$])\$(?!\$)", body[paragraph_start:paragraph_end]):
+        position = paragraph_start + match.start()
+        if position in stray:
+            continue
+        before = body[position - 1] if position else " "
+        after = body[position + 1] if position + 1 < len(body) else ""
+        if before.isspace() and after.isdigit():
+            return position
+    return opener
@@ -0,0 +1,100 @@
+# utils/metrics.py - Lightweight in-process timing and gauge registry
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from utils import progress
+
+# Recent timing events kept for /api/metrics and debugging
+MAX_EVENTS = 1000
+
+_events = deque(maxlen=MAX_EVENTS)
+# Per-stage running count and total, kept beyond the recent-event window
+_totals = {}
+_gauges = {}
+_lock = threading.Lock()
+# Events of the block being captured, see capture_timeline; shared with its tasks and to_thread workers
+_timeline = contextvars.ContextVar("metrics_timeline", default=None)
+
+def record_timing(stage, seconds, **labels):
+    """Record how long a stage took, with labels such as mode or model"""
+    event = {
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "labels": labels,
+        "timestamp": datetime.now().isoformat()
+    }
+    with _lock:
+        _events.append(event)
+        totals = _totals.setdefault(stage, {"count": 0, "total_seconds": 0.0})
+        totals["count"] += 1
+        totals["total_seconds"] += seconds
+    timeline = _timeline.get()
+    if timeline is not None:
+        timeline.append({**event, "end": time.perf_counter(), "thread": threading.current_thread().name})
+    return event
+
+@contextmanager
+def capture_timeline():
+    """Collect every timing recorded inside the block, with its perf_counter end and thread"""
+    timeline = []
+    token = _timeline.set(timeline)
+    try:
+        yield timeline
+    finally:
+        _timeline.reset(token)
+
+@contextmanager
+def timed(stage, **labels):
+    """Time a block; labels may be updated inside the block before it is recorded.
+
+    Start and end are also published as "stage" progress events of the current job.
+    """
+    start = time.perf_counter()
+    progress.publish("stage", stage=stage, status="started")
+    try:
+        yield labels
+    finally:
+        event = record_timing(stage, time.perf_counter() - start, **labels)
+        label_text = ", ".join(f"{key}={value}" for key, value in labels.items())
+        print(f"⏱️ {stage}: {event['seconds']:.2f}s ({label_text})")
+        progress.publish("stage", stage=stage, status="finished", seconds=event["seconds"])
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+def recent_events(limit=100, stage=None):
+    with _lock:
+        events = list(_events)
+    if stage:
+        events = [event for event in events if event["stage"] == stage]
+    return events[-limit:]
+
+def summarize():
+    """Per-stage count, total and average duration since start (or reset) plus current gauges"""
+    with _lock:
+        stages = {stage: dict(totals) for stage, totals in _totals.items()}
+        gauges = dict(_gauges)
+
+    for summary in stages.values():
+        summary["avg_seconds"] = round(summary["total_seconds"] / summary["count"], 4)
+        summary["total_seconds"] = round(summary["total_seconds"], 4)
+
+    return {"stages": stages, "gauges": gauges}
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0.0 for an empty list)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def reset():
+    """Clear timings (gauges are kept), e.g. between benchmark runs"""
+    with _lock:
+        _events.clear()
+        _totals.clear()
@@ -1,21 +1,93 @@
 # utils/ocr_gemini.py - Enhanced version with multi-page support
-import os
-import google.generativeai as genai
 from dotenv import load_dotenv
 from PIL import Image
 import re
+from utils.clients import get_gemini_model
+from utils.continuation import CONTINUE_PROMPT, MAX_CONTINUATIONS, stitch
+from utils.progress import StreamProgress
+from utils.prompt_cache import get_gemini_cached_model
+from utils.rate_limit import call_with_rate_limit, estimate_tokens
+from utils import replay
+from utils.resilience import retry_allowed
+from utils.validation import validate_latex, validate_questions
 
 load_dotenv()
 
-def configure_gemini():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise ValueError("GEMINI_API_KEY not found in environment variables")
-    genai.configure(api_key=api_key)
+# Gemini's default output ceiling, reserved against the token budget
+DEFAULT_MAX_OUTPUT_TOKENS = 8192
 
-def gemini_extract_answer_latex(image_paths, question_text, prompt=None):
-    configure_gemini()
+def _generate_content(model, parts, generation_config=None, stream_label=None):
+    """Every Gemini call goes through here so calls share one rate budget.
+
+    parts is a flat list of prompt parts or a list of {"role", "parts"} turns.
+    With stream_label the response is streamed and its progress published under that label.
+    """
+    flat = [part for item in parts for part in (item["parts"] if isinstance(item, dict) else [item])]
+    text_chars = sum(len(part) for part in flat if isinstance(part, str))
+    images = sum(1 for part in flat if not isinstance(part, str))
+    max_output = (generation_config or {}).get("max_output_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
     
+    if stream_label:
+        live = lambda: _stream_content(model, parts, generation_config, stream_label)
+    else:
+        live = lambda: model.generate_content(parts, generation_config=generation_config)
+    # Recorded or replayed instead of sent when a benchmark enables replay
+    request = lambda: replay.call("gemini", live, flat, stream_label,
+                                  model=getattr(model, "model_name", ""), generation_config=generation_config)
+    return call_with_rate_limit("gemini", request, estimate_tokens(text_chars, images, max_output))
+
+def _stream_content(model, parts, generation_config, stream_label):
+    """Stream a response; once iterated it exposes .text and .candidates like a normal one"""
+    response = model.generate_content(parts, generation_config=generation_config, stream=True)
+    progress = StreamProgress("gemini", stream_label)
+    try:
+        for chunk in response:
+            try:
+                progress.add(chunk.text)
+            except ValueError:
+                # The closing chunk may carry only the finish reason
+                pass
+    except Exception:
+        # Close the stream for progress subscribers; the caller handles the error
+        progress.finish("error")
+        raise
+    progress.finish("MAX_TOKENS" if _hit_token_limit(response) else "STOP")
+    return response
+
+def _generate_with_continuation(model, parts, generation_config=None, stream_label="answer"):
+    """Streamed response text; a stop at max_output_tokens is continued and stitched rather than regenerated"""
+    response = _generate_content(model, parts, generation_config, stream_label)
+    text = response.text
+    
+    for attempt in range(MAX_CONTINUATIONS):
+        if not _hit_token_limit(response):
+            break
+        print(f"DEBUG: Gemini output hit max_output_tokens after {len(text)} characters, requesting continuation {attempt + 1}")
+        turns = [
+            {"role": "user", "parts": parts},
+            {"role": "model", "parts": [text]},
+            {"role": "user", "parts": [CONTINUE_PROMPT]}
+        ]
+        response = _generate_content(model, turns, generation_config, f"{stream_label}_continuation")
+        text = stitch(text, response.text)
+    return text
+
+def _hit_token_limit(response):
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError):
+        return False
+    # FinishReason enum in current SDKs, a bare int (2) in older ones
+    return getattr(reason, "name", reason) in ("MAX_TOKENS", 2)
+
+def _model_with_context(context):
+    """Model bound to the cached prompt prefix, or the shared model plus the prefix sent inline"""
+    cached_model = get_gemini_cached_model(context)
+    if cached_model is not None:
+        return cached_model, []
+    return get_gemini_model(), [context] if context else []
+
+def gemini_extract_answer_latex(image_paths, question_text, prompt=None):
     if prompt is None:
         prompt = f"""Create a comprehensive LaTeX document that properly maps student answers to exam questions.
 
@@ -78,21 +150,19 @@ QUESTION PAPER CONTENT:
 STUDENT ANSWER SHEET:
 Examine the answer sheet images and create the complete LaTeX document mapping student responses to the questions above."""
 
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    # The whole prompt is shared by every student of the batch; only the pages differ
+    model, prefix = _model_with_context(prompt)
     
-    images = []
-    for image_path in image_paths:
-        images.append(Image.open(image_path))
+    images = _answer_page_parts(image_paths)
     
     try:
-        response = model.generate_content([prompt] + images)
-        latex_text = response.text.strip()
+        latex_text = _generate_with_continuation(model, prefix + images).strip()
         
         # Clean and validate LaTeX output
         latex_text = _clean_gemini_latex_output(latex_text)
         
         # Validate structure
-        if not _validate_gemini_latex_structure(latex_text):
+        if validate_latex(latex_text)["missing"]:
             print("Generated LaTeX failed validation, creating fallback...")
             latex_text = _create_gemini_fallback_latex(latex_text, question_text)
         
@@ -102,9 +172,60 @@ Examine the answer sheet images and create the complete LaTeX document mapping s
         print(f"Error in Gemini processing: {e}")
         return _create_gemini_fallback_latex(f"Error: {str(e)}", question_text)
 
-def gemini_extract_question_text(image_paths, prompt=None):
-    configure_gemini()
+def gemini_map_answer_pages(image_paths, prompt, context=None):
+    """Cheap pass: ask Gemini which pages answer which questions using thumbnails.
+
+    context is the stable prompt prefix shared across students; prompt is the per-call suffix.
+    """
+    model, prefix = _model_with_context(context)
     
+    # Page-level layout is enough for mapping
+    images = _answer_page_parts(image_paths, max_side=768)
+    
+    try:
+        response = _generate_content(
+            model, prefix + [prompt] + images,
+            generation_config={"temperature": 0.0, "max_output_tokens": 800}
+        )
+        return response.text.strip()
+    except Exception as e:
+        print(f"Error in Gemini page mapping: {e}")
+        return ""
+
+def gemini_extract_answer_section(image_paths, prompt, max_tokens=4000, context=None):
+    """Extract the LaTeX body for a subset of questions from a subset of pages"""
+    model, prefix = _model_with_context(context)
+    
+    images = _answer_page_parts(image_paths)
+    
+    try:
+        section = _generate_with_continuation(
+            model, prefix + [prompt] + images,
+            generation_config={"temperature": 0.1, "max_output_tokens": max_tokens},
+            stream_label="section"
+        )
+        return _clean_gemini_latex_output(section)
+    except Exception as e:
+        print(f"Error in Gemini section extraction: {e}")
+        return ""
+
+def _answer_page_parts(pages, max_side=None):
+    """Content parts for answer pages: rendered image paths or typed page dicts
+    ({"page", "text", "figures"}) whose text is sent as-is with small figure crops."""
+    parts = []
+    for page in pages:
+        if isinstance(page, dict):
+            parts.append(f"TYPED ANSWER PAGE {page['page']}:\n{page['text']}")
+            parts.extend(Image.open(figure) for figure in page.get("figures", []))
+        else:
+            image = Image.open(page)
+            if max_side:
+                image.thumbnail((max_side, max_side))
+            parts.append(image)
+    return parts
+
+def gemini_extract_question_text(image_paths, prompt=None, page_fallback=True):
+    """Multi-page question extraction; page_fallback enables the per-page retry on failed validation"""
     if prompt is None:
         prompt = '''EXTRACT ALL EXAMINATION QUESTIONS FROM ALL PAGES
 
@@ -155,7 +276,7 @@ CRITICAL: Process ALL images/pages provided. Extract COMPLETE text for each ques
 
 Extract ALL questions from ALL pages in the specified format:'''
 
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    model = get_gemini_model()
     
     # Load ALL images
     images = []
@@ -166,7 +287,7 @@ Extract ALL questions from ALL pages in the specified format:'''
     
     try:
         # Send ALL images at once to process the complete document
-        response = model.generate_content([prompt] + images)
+        response = _generate_content(model, [prompt] + images, stream_label="questions")
         result = response.text.strip()
         
         print(f"DEBUG: Extracted {len(result)} characters from {len(images)} pages")
@@ -175,7 +296,7 @@ Extract ALL questions from ALL pages in the specified format:'''
         result = _enhance_multi_page_extraction(result, len(images))
         
         # Final validation
-        if _validate_multi_page_extraction(result, len(images)):
+        if _validate_multi_page_extraction(result, len(images)) or not page_fallback or not retry_allowed("gemini.questions_page_by_page"):
             return result
         else:
             # Try page-by-page extraction as fallback
@@ -212,7 +333,7 @@ Extract ALL content from this page that students need to answer.
 """
         
         try:
-            response = model.generate_content([page_prompt, image])
+            response = _generate_content(model, [page_prompt, image])
             page_result = response.text.strip()
             
             if page_result and len(page_result) > 50:
@@ -231,26 +352,11 @@ Extract ALL content from this page that students need to answer.
 
 def _validate_multi_page_extraction(text, num_pages):
     """Validate that extraction covered multiple pages"""
-    if not text or len(text.strip()) < 100:
-        print("DEBUG: Validation failed - text too short")
+    validation = validate_questions(text, num_pages)
+    if not validation["complete"]:
+        print(f"DEBUG: Multi-page validation failed - {'; '.join(validation['issues'])}")
         return False
-    
-    # For multi-page documents, expect proportionally more content
-    if num_pages > 1:
-        expected_min_length = num_pages * 200  # At least 200 chars per page
-        if len(text) < expected_min_length:
-            print(f"DEBUG: Extracted text ({len(text)} chars) seems too short for {num_pages} pages")
-            return False
-    
-    # Check for question distribution
-    import re
-    question_count = len(re.findall(r'Question\s+\d+', text, re.IGNORECASE))
-    
-    if num_pages > 1 and question_count < 2:
-        print(f"DEBUG: Only found {question_count} questions in {num_pages} pages - might be incomplete")
-        return False
-    
-    print(f"DEBUG: Multi-page validation passed - {question_count} questions in {num_pages} pages")
+    print(f"DEBUG: Multi-page validation passed - {validation['question_count']} questions in {num_pages} pages")
     return True
 
 def _enhance_multi_page_extraction(text, num_pages):
@@ -284,18 +390,6 @@ def _clean_gemini_latex_output(latex_text):
     
     return latex_text.strip()
 
-def _validate_gemini_latex_structure(latex_text):
-    """Validate LaTeX structure"""
-    required_elements = [
-        "\\documentclass",
-        "\\begin{document}",
-        "\\end{document}",
-        "\\title{",
-        "\\maketitle"
-    ]
-    
-    return all(element in latex_text for element in required_elements)
-
 def _create_gemini_fallback_latex(content, question_text):
     """Create fallback LaTeX document"""
     return f"""\\documentclass[12pt]{{article}}
@@ -354,26 +448,7 @@ def _enhance_question_extraction(text):
 
 def _validate_question_extraction(text):
     """Validate question extraction"""
-    if not text or len(text.strip()) < 50:
-        return False
-    
-    # Check for question indicators
-    question_patterns = [
-        r'Question\s+\d+',
-        r'Q\d+',
-        r'^\d+[\.:]\s',
-        r'\(\w\)',
-        r'Consider',
-        r'Which',
-        r'What',
-        r'How',
-        r'Explain'
-    ]
-    
-    has_questions = any(re.search(pattern, text, re.MULTILINE | re.IGNORECASE) 
-                       for pattern in question_patterns)
-    
-    return has_questions
+    return validate_questions(text)["has_question_cues"] if text and len(text.strip()) >= 50 else False
 
 def _create_enhanced_question_prompt():
     """Create enhanced question extraction prompt"""
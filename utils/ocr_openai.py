@@ -4,26 +4,78 @@ from dotenv import load_dotenv
 from PIL import Image
 from pdf2image import convert_from_path
 import base64
-import openai
 import re
-
-def pdf_to_images(pdf_path):
-    # Enhanced with higher DPI for better text recognition
-    images = convert_from_path(pdf_path, dpi=350, fmt='png')
-    image_paths = []
+import time
+from types import SimpleNamespace
+from utils.clients import get_openai_client, STREAM_TIMEOUT
+from utils.continuation import CONTINUE_PROMPT, MAX_CONTINUATIONS, stitch
+from utils.hashing import file_sha256
+from utils.page_stats import preprocess_page
+from utils.progress import StreamProgress
+from utils.prompt_cache import context_key
+from utils.rate_limit import call_with_rate_limit, estimate_tokens
+from utils import metrics, replay
+from utils.resilience import retry_allowed
+from utils.singleflight import SingleFlight
+from utils.validation import validate_latex, validate_questions
+
+# Full-quality render used for final extraction and re-renders
+DEFAULT_DPI = 350
+# Modest first-pass render for progressive mode
+PREVIEW_DPI = 200
+# Room for a complete multi-question answer document
+ANSWER_MAX_TOKENS = 10000
+
+_render_flights = SingleFlight("render")
+
+def pdf_to_images(pdf_path, dpi=DEFAULT_DPI, pages=None, preprocess=False):
+    """Render a PDF (or only the given 1-based page numbers) to PNG files under tmp/
+
+    With preprocess=True pages are converted to grayscale, contrast-stretched and
+    deskewed before saving. Concurrent renders of the same document and settings
+    share one conversion.
+    """
+    key = (file_sha256(pdf_path), dpi, tuple(pages) if pages is not None else None, preprocess)
+    return list(_render_flights.do(key, lambda: _render_pdf_pages(pdf_path, dpi, pages, preprocess)))
+
+def _render_pdf_pages(pdf_path, dpi, pages, preprocess):
     base_name = os.path.splitext(os.path.basename(pdf_path))[0]
     os.makedirs(f"tmp/{base_name}", exist_ok=True)
-    for i, img in enumerate(images):
-        img_path = f"tmp/{base_name}/page_{i + 1}.png"
+    
+    start = time.perf_counter()
+    if pages is None:
+        images = convert_from_path(pdf_path, dpi=dpi, fmt='png')
+        page_numbers = list(range(1, len(images) + 1))
+    else:
+        images = []
+        for page_num in pages:
+            images.extend(convert_from_path(pdf_path, dpi=dpi, fmt='png', first_page=page_num, last_page=page_num))
+        page_numbers = list(pages)
+    metrics.record_timing("rasterize", time.perf_counter() - start, pages=len(images), dpi=dpi)
+    
+    start = time.perf_counter()
+    image_paths = []
+    for page_num, img in zip(page_numbers, images):
+        if preprocess:
+            img = preprocess_page(img)
+        # Keep renders at other resolutions alongside the default ones
+        suffix = "" if dpi == DEFAULT_DPI else f"_{dpi}dpi"
+        if preprocess:
+            suffix += "_clean"
+        img_path = f"tmp/{base_name}/page_{page_num}{suffix}.png"
         img.save(img_path, "PNG", optimize=True, quality=95)
         image_paths.append(img_path)
+    metrics.record_timing("png_write", time.perf_counter() - start, pages=len(image_paths), preprocess=preprocess)
     
-    print(f"DEBUG: Converted PDF to {len(image_paths)} images")
+    print(f"DEBUG: Converted PDF to {len(image_paths)} images at {dpi} DPI")
     return image_paths
 
 def encode_image_base64(image_path):
+    start = time.perf_counter()
     with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode("utf-8")
+        encoded = base64.b64encode(img_file.read()).decode("utf-8")
+    metrics.record_timing("base64_encode", time.perf_counter() - start)
+    return encoded
 
 def gpt4o_extract_answer_latex(image_paths, question_text, prompt=None):
     if prompt is None:
@@ -93,54 +145,208 @@ CRITICAL REQUIREMENTS:
 
 Generate ONLY the complete LaTeX document. Start with \\documentclass and end with \\end{{document}}."""
     
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompt
-                }
-            ]
-        }
-    ]
-    
-    for path in image_paths:
-        img_b64 = encode_image_base64(path)
-        messages[0]["content"].append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{img_b64}",
-                "detail": "high"  # Enhanced for better text recognition
-            }
-        })
+    messages = answer_latex_messages(image_paths, prompt)
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.1,
-            max_tokens=10000  # Increased for longer documents
-        )
-        
-        latex_output = response.choices[0].message.content
-        
-        # Enhanced cleaning and validation
-        latex_output = _enhanced_clean_openai_output(latex_output)
-        
-        # Validate structure
-        if not _validate_openai_latex_structure(latex_output):
-            print("Generated LaTeX failed validation, creating enhanced fallback...")
-            latex_output = _create_openai_enhanced_fallback(latex_output, question_text)
-        
-        return latex_output
+        # The prompt is identical for every student of a batch, so it forms the cached prefix
+        latex_output = _complete_with_continuation(messages, max_tokens=ANSWER_MAX_TOKENS, temperature=0.1, cache_key=context_key(prompt))
+        return finalize_answer_latex(latex_output, question_text)
         
     except Exception as e:
         print(f"Error in OpenAI processing: {e}")
         return _create_openai_enhanced_fallback(f"Error: {str(e)}", question_text)
 
-def gpt4o_extract_questions(image_paths, prompt=None):
-    """Enhanced function for multi-page question extraction with GPT-4V"""
+def answer_latex_messages(image_paths, prompt):
+    """Chat messages for a full answer document; also used to build Batch API requests"""
+    messages = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
+    
+    # Enhanced for better text recognition
+    messages[0]["content"].extend(_answer_page_parts(image_paths, detail="high"))
+    return messages
+
+def finalize_answer_latex(latex_output, question_text):
+    """Clean a raw answer document and replace it with a fallback if it is malformed"""
+    # Enhanced cleaning and validation
+    latex_output = _enhanced_clean_openai_output(latex_output)
+    
+    # Validate structure
+    if validate_latex(latex_output)["missing"]:
+        print("Generated LaTeX failed validation, creating enhanced fallback...")
+        latex_output = _create_openai_enhanced_fallback(latex_output, question_text)
+    
+    return latex_output
+
+def gpt4o_map_answer_pages(image_paths, prompt, context=None):
+    """Cheap pass: ask GPT-4o which pages answer which questions using low-detail images.
+
+    context is the stable prompt prefix shared across students; prompt is the per-call suffix.
+    """
+    messages = [{"role": "user", "content": _prompt_parts(prompt, context)}]
+    
+    # Page-level layout is enough for mapping
+    messages[0]["content"].extend(_answer_page_parts(image_paths, detail="low"))
+    
+    try:
+        response = _create_chat_completion(messages, max_tokens=800, temperature=0.0, cache_key=context and context_key(context))
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error in OpenAI page mapping: {e}")
+        return ""
+
+def gpt4o_extract_answer_section(image_paths, prompt, max_tokens=4000, context=None):
+    """Extract the LaTeX body for a subset of questions from a subset of pages"""
+    messages = [{"role": "user", "content": _prompt_parts(prompt, context)}]
+    
+    messages[0]["content"].extend(_answer_page_parts(image_paths, detail="high"))
+    
+    try:
+        section = _complete_with_continuation(messages, max_tokens=max_tokens, temperature=0.1,
+                                              cache_key=context and context_key(context), stream_label="section")
+        return _strip_code_fences(section)
+    except Exception as e:
+        print(f"Error in OpenAI section extraction: {e}")
+        return ""
+
+def _prompt_parts(prompt, context=None):
+    """Stable prefix first so OpenAI's automatic prompt caching can match it across students"""
+    parts = [{"type": "text", "text": context}] if context else []
+    parts.append({"type": "text", "text": prompt})
+    return parts
+
+def _create_chat_completion(messages, max_tokens, temperature=0.1, cache_key=None, stream_label=None):
+    """Every GPT-4o call goes through here so calls share one rate budget.
+
+    cache_key routes requests sharing a prompt prefix to the same prompt cache.
+    With stream_label the response is streamed and its progress published under that label.
+    """
+    text_chars, images = 0, 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                text_chars += len(part["text"])
+            else:
+                images += 1
+    
+    if stream_label:
+        live = lambda: _stream_chat_completion(messages, max_tokens, temperature, cache_key, stream_label)
+    else:
+        live = lambda: get_openai_client().chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            extra_body={"prompt_cache_key": cache_key} if cache_key else None
+        )
+    # Recorded or replayed instead of sent when a benchmark enables replay
+    request = lambda: replay.call("openai", live, messages, stream_label,
+                                  model="gpt-4o", max_tokens=max_tokens, temperature=temperature)
+    return call_with_rate_limit("openai", request, estimate_tokens(text_chars, images, max_tokens))
+
+def _stream_chat_completion(messages, max_tokens, temperature, cache_key, stream_label):
+    """Stream a completion and return it shaped like a non-streamed response.
+
+    The read timeout applies between chunks, so a generation that stalls fails
+    after STREAM_STALL_SECONDS instead of after the full response timeout.
+    """
+    stream = get_openai_client().chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        timeout=STREAM_TIMEOUT,
+        extra_body={"prompt_cache_key": cache_key} if cache_key else None
+    )
+    progress = StreamProgress("openai", stream_label)
+    finish_reason = None
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta and choice.delta.content:
+                progress.add(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+    except Exception:
+        # Close the stream for progress subscribers; the caller handles the error
+        progress.finish("error")
+        raise
+    progress.finish(finish_reason)
+    
+    message = SimpleNamespace(content=progress.text)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)])
+
+def _complete_with_continuation(messages, max_tokens, temperature=0.1, cache_key=None, stream_label="answer"):
+    """Streamed completion text; a stop at max_tokens is continued and stitched rather than regenerated"""
+    response = _create_chat_completion(messages, max_tokens, temperature, cache_key, stream_label)
+    choice = response.choices[0]
+    return continue_completion(messages, choice.message.content or "", choice.finish_reason, max_tokens,
+                               temperature, cache_key, stream_label)
+
+def continue_completion(messages, text, finish_reason, max_tokens, temperature=0.1, cache_key=None, stream_label="answer"):
+    """Continue text that stopped at max_tokens (finish_reason "length") and stitch the parts.
+    
+    Also used for Batch API outputs, which are continued interactively.
+    """
+    for attempt in range(MAX_CONTINUATIONS):
+        if finish_reason != "length":
+            break
+        print(f"DEBUG: OpenAI output hit max_tokens after {len(text)} characters, requesting continuation {attempt + 1}")
+        follow_up = messages + [
+            {"role": "assistant", "content": text},
+            {"role": "user", "content": CONTINUE_PROMPT}
+        ]
+        response = _create_chat_completion(follow_up, max_tokens, temperature, cache_key, f"{stream_label}_continuation")
+        choice = response.choices[0]
+        finish_reason = choice.finish_reason
+        text = stitch(text, choice.message.content or "")
+    return text
+
+def _answer_page_parts(pages, detail="high"):
+    """Message parts for answer pages.
+
+    A page is either a rendered image path or a typed page dict
+    ({"page", "text", "figures"}) whose text is sent as-is with small figure crops.
+    """
+    parts = []
+    for page in pages:
+        if isinstance(page, dict):
+            parts.append({"type": "text", "text": f"TYPED ANSWER PAGE {page['page']}:\n{page['text']}"})
+            for figure in page.get("figures", []):
+                parts.append({
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/png;base64,{encode_image_base64(figure)}", "detail": "low"}
+                })
+        else:
+            parts.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/png;base64,{encode_image_base64(page)}", "detail": detail}
+            })
+    return parts
+
+def _strip_code_fences(text):
+    """Remove markdown code fences around a model response"""
+    if not text:
+        return ""
+    if "```latex" in text:
+        text = text.split("```latex")[1].split("```")[0]
+    elif "```" in text:
+        parts = text.split("```")
+        if len(parts) >= 3:
+            text = parts[1]
+    return text.strip()
+
+def gpt4o_extract_questions(image_paths, prompt=None, page_fallback=True):
+    """Enhanced function for multi-page question extraction with GPT-4V
+
+    page_fallback controls whether a failed multi-page validation falls back to
+    one request per page (batch_with_page_fallback) or returns as-is (batch_process).
+    """
     
     if prompt is None:
         prompt = """COMPREHENSIVE MULTI-PAGE QUESTION EXTRACTION
@@ -225,12 +431,7 @@ Process ALL pages and extract ALL questions in the specified format. Be thorough
     print(f"DEBUG: Sending {len(image_paths)} pages to OpenAI for question extraction")
     
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.1,
-            max_tokens=10000  # Increased for multi-page content
-        )
+        response = _create_chat_completion(messages, max_tokens=10000, temperature=0.1, stream_label="questions")  # Increased for multi-page content
         
         result = response.choices[0].message.content.strip()
         print(f"DEBUG: OpenAI returned {len(result)} characters for {len(image_paths)} pages")
@@ -239,7 +440,7 @@ Process ALL pages and extract ALL questions in the specified format. Be thorough
         result = _enhance_openai_multi_page_extraction(result, len(image_paths))
         
         # Validate the extraction
-        if _is_valid_openai_multi_page_extraction(result, len(image_paths)):
+        if _is_complete_extraction(result, len(image_paths)) or not page_fallback or not retry_allowed("openai.questions_page_by_page"):
             return result
         else:
             # Retry with page-by-page approach
@@ -290,12 +491,7 @@ Extract ALL content from this page that students need to answer.
         }]
         
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0.1,
-                max_tokens=3000
-            )
+            response = _create_chat_completion(messages, max_tokens=3000, temperature=0.1)
             
             page_result = response.choices[0].message.content.strip()
             if page_result and len(page_result) > 50:
@@ -312,28 +508,13 @@ Extract ALL content from this page that students need to answer.
     print(f"DEBUG: Combined result from all pages: {len(combined_result)} characters")
     return combined_result
 
-def _is_valid_openai_multi_page_extraction(text, num_pages):
-    """Validate OpenAI multi-page extraction"""
-    if not text or len(text.strip()) < 100:
-        print("DEBUG: OpenAI validation failed - text too short")
+def _is_complete_extraction(text, num_pages):
+    """Shared question validation, plus the reason a multi-page extraction looks incomplete"""
+    validation = validate_questions(text, num_pages)
+    if not validation["complete"]:
+        print(f"DEBUG: OpenAI multi-page validation failed - {'; '.join(validation['issues'])}")
         return False
-        
-    # For multi-page documents, expect more content
-    if num_pages > 1:
-        expected_min_length = num_pages * 150
-        if len(text) < expected_min_length:
-            print(f"DEBUG: OpenAI extracted content too short for {num_pages} pages")
-            return False
-    
-    # Check for question distribution
-    import re
-    question_count = len(re.findall(r'Question\s+\d+', text, re.IGNORECASE))
-    
-    if num_pages > 2 and question_count < num_pages:
-        print(f"DEBUG: Only {question_count} questions found across {num_pages} pages")
-        # Don't fail here - some pages might have fewer questions
-    
-    print(f"DEBUG: OpenAI multi-page validation passed - {question_count} questions in {num_pages} pages")
+    print(f"DEBUG: OpenAI multi-page validation passed - {validation['question_count']} questions in {num_pages} pages")
     return True
 
 def _enhance_openai_multi_page_extraction(text, num_pages):
@@ -366,18 +547,6 @@ def _enhanced_clean_openai_output(latex_output):
     
     return latex_output.strip()
 
-def _validate_openai_latex_structure(latex_output):
-    """Validate LaTeX structure for OpenAI output"""
-    required_elements = [
-        "\\documentclass",
-        "\\begin{document}",
-        "\\end{document}",
-        "\\title{",
-        "\\maketitle"
-    ]
-    
-    return all(element in latex_output for element in required_elements)
-
 def _create_openai_enhanced_fallback(content, question_text):
     """Create enhanced fallback document for OpenAI"""
     return f"""\\documentclass[12pt]{{article}}
@@ -436,33 +605,15 @@ def _enhance_openai_question_extraction(text):
 
 def _is_valid_openai_question_extraction(text):
     """Validate OpenAI question extraction"""
-    if not text or len(text.strip()) < 100:
+    validation = validate_questions(text)
+    if not validation["is_valid"] or not validation["has_question_cues"]:
         return False
-        
-    # Check for question patterns
-    question_patterns = [
-        r'Question\s+\d+',
-        r'Q\d+',
-        r'^\d+[\.:]\s',
-        r'\(\w\)',
-        r'Consider',
-        r'Which',
-        r'What',
-        r'How',
-        r'Explain'
-    ]
-    
-    has_questions = any(re.search(pattern, text, re.MULTILINE | re.IGNORECASE) 
-                       for pattern in question_patterns)
-    
-    # Check for reasonable length and content
-    has_sufficient_content = len(text.strip()) > 100
     
     # Check it's not mostly administrative content
     admin_indicators = ['total marks', 'duration', 'time allowed', 'instructions']
     admin_heavy = sum(1 for indicator in admin_indicators if indicator in text.lower()) > 2
     
-    return has_questions and has_sufficient_content and not admin_heavy
+    return not admin_heavy
 
 def _create_openai_enhanced_question_prompt():
     """Create enhanced question extraction prompt for OpenAI"""
@@ -0,0 +1,97 @@
+# utils/openai_batch.py - OpenAI Batch API packaging, submission and result download
+import json
+import os
+from utils.clients import get_openai_batch_client
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# The Batch API rejects input files above 200 MB; page images make lines large
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def build_batch_line(custom_id, messages, max_tokens, temperature=0.1, model="gpt-4o"):
+    """One JSONL request line for the chat completions batch endpoint"""
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+    })
+
+def write_batch_files(requests, output_dir, prefix="batch", max_bytes=MAX_BATCH_FILE_BYTES):
+    """Write (custom_id, line) requests into as few JSONL files as the size limit allows.
+
+    Returns [(path, custom_ids)] so callers know which requests went into which job.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = []
+    handle, size = None, 0
+
+    for custom_id, line in requests:
+        data = (line + "\n").encode("utf-8")
+        if handle is None or (size and size + len(data) > max_bytes):
+            if handle:
+                handle.close()
+            path = os.path.join(output_dir, f"{prefix}_{len(files) + 1}.jsonl")
+            handle, size = open(path, "wb"), 0
+            files.append((path, []))
+        handle.write(data)
+        size += len(data)
+        files[-1][1].append(custom_id)
+
+    if handle:
+        handle.close()
+    return files
+
+def submit_batch(jsonl_path, metadata=None):
+    """Upload a request file and start a batch job; returns the batch id"""
+    client = get_openai_batch_client()
+    with open(jsonl_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata=metadata
+    )
+    print(f"DEBUG: Submitted batch {batch.id} from {os.path.basename(jsonl_path)}")
+    return batch.id
+
+def get_batch(batch_id):
+    return get_openai_batch_client().batches.retrieve(batch_id)
+
+def is_batch_finished(batch):
+    return batch.status in FINISHED_STATUSES
+
+def _read_file_lines(file_id):
+    if not file_id:
+        return []
+    content = get_openai_batch_client().files.content(file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+def download_batch_results(batch):
+    """Map custom_id -> {"content": text} or {"error": message} for a finished batch"""
+    results = {}
+    for record in _read_file_lines(batch.output_file_id) + _read_file_lines(getattr(batch, "error_file_id", None)):
+        custom_id = record.get("custom_id")
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+
+        if record.get("error"):
+            error = record["error"]
+            results[custom_id] = {"error": error.get("message", str(error)) if isinstance(error, dict) else str(error)}
+        elif response.get("status_code") != 200:
+            message = (body.get("error") or {}).get("message", f"status {response.get('status_code')}")
+            results[custom_id] = {"error": message}
+        else:
+            choice = body["choices"][0]
+            results[custom_id] = {
+                "content": choice["message"]["content"],
+                "finish_reason": choice.get("finish_reason")
+            }
+    return results
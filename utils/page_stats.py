@@ -0,0 +1,155 @@
+# utils/page_stats.py - Cheap local image statistics for rendered pages
+import os
+import threading
+import numpy as np
+from PIL import Image, ImageOps
+
+# Pages are downsampled before analysis; ink coverage survives this well
+ANALYSIS_MAX_SIDE = 512
+# Scanner edges and punch holes show up as dark borders
+MARGIN_FRACTION = 0.03
+# Ink ratio below which a page is treated as blank and not uploaded
+BLANK_INK_RATIO = 0.003
+# Ink ratio below which a page is kept but marked as sparse
+SPARSE_INK_RATIO = 0.015
+# Candidate skew angles in degrees, checked with projection profiles
+SKEW_ANGLES = np.arange(-5.0, 5.25, 0.25)
+
+# Upper bound on cached pages so a long-running server does not grow forever
+STATS_CACHE_SIZE = 4096
+
+_stats_cache = {}
+_stats_lock = threading.Lock()
+
+def load_gray_array(image, max_side=ANALYSIS_MAX_SIDE):
+    """Return a downsampled grayscale float32 array for a PIL image or image path"""
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    gray = image.convert('L')
+    gray.thumbnail((max_side, max_side))
+    return np.asarray(gray, dtype=np.float32)
+
+def _crop_margins(gray):
+    height, width = gray.shape
+    dy = int(height * MARGIN_FRACTION)
+    dx = int(width * MARGIN_FRACTION)
+    return gray[dy:height - dy, dx:width - dx] if dy and dx else gray
+
+def _ink_mask(gray):
+    # Paper is the dominant tone; ink is anything well below it
+    background = float(np.median(gray))
+    threshold = min(background * 0.75, background - 40)
+    return gray < threshold
+
+def _laplacian_variance(gray):
+    """Variance of the 4-neighbour Laplacian; low values mean a blurry page"""
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+                 - 4.0 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+def _estimate_skew(mask):
+    """Angle (degrees) whose row projection of ink pixels is sharpest"""
+    ys, xs = np.nonzero(mask)
+    if ys.size < 50:
+        return 0.0
+
+    xs = xs - xs.mean()
+    # Shear ink coordinates for every candidate angle at once
+    offsets = np.outer(np.tan(np.radians(SKEW_ANGLES)), xs)
+    rows = np.rint(ys[None, :] + offsets).astype(np.int64)
+    rows -= rows.min()
+
+    scores = np.empty(len(SKEW_ANGLES))
+    for i in range(len(SKEW_ANGLES)):
+        histogram = np.bincount(rows[i])
+        scores[i] = float(np.dot(histogram, histogram))
+    return float(SKEW_ANGLES[int(np.argmax(scores))])
+
+def compute_page_stats(gray):
+    """Ink density, contrast, blur and skew for one downsampled grayscale page"""
+    gray = _crop_margins(gray)
+    if gray.size == 0:
+        return {"ink_ratio": 0.0, "contrast": 0.0, "blur_variance": 0.0, "skew_degrees": 0.0}
+
+    mask = _ink_mask(gray)
+    ink_pixels = np.count_nonzero(mask)
+    # Contrast between paper and ink, so sparse pages are not penalised
+    contrast = float(np.median(gray) - gray[mask].mean()) if ink_pixels else 0.0
+    return {
+        "ink_ratio": float(ink_pixels) / gray.size,
+        "contrast": contrast,
+        "blur_variance": _laplacian_variance(gray),
+        "skew_degrees": _estimate_skew(mask)
+    }
+
+def get_page_stats(image, cache_key=None):
+    """Compute page statistics once and cache them.
+
+    Paths are keyed by path, size and mtime automatically; in-memory PIL images
+    need an explicit cache_key (for example file path, page number and DPI).
+    """
+    if cache_key is None and not isinstance(image, Image.Image):
+        info = os.stat(image)
+        cache_key = (os.path.abspath(image), info.st_size, info.st_mtime_ns)
+
+    if cache_key is not None:
+        with _stats_lock:
+            cached = _stats_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    stats = compute_page_stats(load_gray_array(image))
+
+    if cache_key is not None:
+        with _stats_lock:
+            if len(_stats_cache) >= STATS_CACHE_SIZE:
+                _stats_cache.clear()
+            _stats_cache[cache_key] = stats
+    return stats
+
+def classify_page(ratio):
+    if ratio < BLANK_INK_RATIO:
+        return "blank"
+    if ratio < SPARSE_INK_RATIO:
+        return "sparse"
+    return "content"
+
+def triage_pages(image_paths):
+    """Drop near-empty pages before upload.
+
+    Returns the paths worth sending and a per-page report. If every page looks
+    blank the original list is returned unchanged so nothing is lost.
+    """
+    report = []
+    kept_paths = []
+
+    for page_num, path in enumerate(image_paths, 1):
+        try:
+            ratio = get_page_stats(path)["ink_ratio"]
+            status = classify_page(ratio)
+        except Exception as e:
+            print(f"DEBUG: Could not triage page {page_num}: {e}")
+            ratio, status = None, "content"
+
+        report.append({"page": page_num, "path": path, "ink_ratio": ratio, "status": status})
+        if status != "blank":
+            kept_paths.append(path)
+
+    if not kept_paths:
+        print("DEBUG: All pages look blank, keeping every page")
+        return list(image_paths), report
+
+    skipped = len(image_paths) - len(kept_paths)
+    sparse = sum(1 for page in report if page["status"] == "sparse")
+    print(f"DEBUG: Page triage kept {len(kept_paths)}/{len(image_paths)} pages ({skipped} blank, {sparse} sparse)")
+    return kept_paths, report
+
+def preprocess_page(image, skew_limit=1.0):
+    """Grayscale, stretch contrast and deskew a rendered page before upload"""
+    gray = ImageOps.autocontrast(image.convert('L'), cutoff=1)
+    skew = compute_page_stats(load_gray_array(gray))["skew_degrees"]
+    if abs(skew) > skew_limit:
+        gray = gray.rotate(-skew, resample=Image.BICUBIC, expand=False, fillcolor=255)
+    return gray
@@ -0,0 +1,169 @@
+# utils/pdf_text.py - Embedded text layer access via poppler (already required by pdf2image)
+import os
+import re
+import subprocess
+
+# A page needs this much real text before we trust its text layer
+MIN_PAGE_CHARS = 80
+MIN_ALNUM_RATIO = 0.5
+# Embedded images smaller than this (pixels per side) are logos or rules, not figures
+MIN_FIGURE_SIDE = 120
+# An image covering this much of its page makes it a scan, even with an OCR text layer on top
+SCANNED_PAGE_COVERAGE = 0.6
+
+def extract_page_texts(pdf_path):
+    """Return the embedded text of every page, or [] when there is no usable text tool/layer"""
+    try:
+        result = subprocess.run(
+            ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"DEBUG: pdftotext unavailable: {e}")
+        return []
+
+    if result.returncode != 0:
+        print(f"DEBUG: pdftotext failed: {result.stderr.strip()}")
+        return []
+
+    # pdftotext separates pages with form feeds and ends with one
+    pages = result.stdout.split("\f")
+    if pages and not pages[-1].strip():
+        pages = pages[:-1]
+    return pages
+
+def is_usable_text(text):
+    """True when a page's text layer is real text rather than empty or OCR garbage"""
+    stripped = "".join(text.split())
+    if len(stripped) < MIN_PAGE_CHARS:
+        return False
+    alnum = sum(1 for char in stripped if char.isalnum())
+    return alnum / len(stripped) >= MIN_ALNUM_RATIO and "�" not in stripped[:200]
+
+def _list_images(pdf_path):
+    """Embedded images as (page, width, height, x_ppi, y_ppi) from pdfimages -list"""
+    try:
+        result = subprocess.run(["pdfimages", "-list", pdf_path], capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+
+    images = []
+    # Columns: page num type width height color comp bpc enc interp object ID x-ppi y-ppi ...;
+    # the first two lines are headers
+    for line in result.stdout.splitlines()[2:]:
+        columns = line.split()
+        if len(columns) < 14 or not columns[0].isdigit() or columns[2] != "image":
+            continue
+        try:
+            images.append((int(columns[0]), int(columns[3]), int(columns[4]), float(columns[12]), float(columns[13])))
+        except ValueError:
+            continue
+    return images
+
+def figure_pages(pdf_path):
+    """Map page number -> count of embedded images large enough to be figures"""
+    counts = {}
+    for page, width, height, _, _ in _list_images(pdf_path):
+        if min(width, height) >= MIN_FIGURE_SIDE:
+            counts[page] = counts.get(page, 0) + 1
+    return counts
+
+def page_sizes(pdf_path):
+    """Map page number -> (width, height) in points, from pdfinfo"""
+    try:
+        result = subprocess.run(["pdfinfo", "-f", "1", "-l", "100000", pdf_path],
+                                capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+
+    sizes = {}
+    for match in re.finditer(r"^Page\s+(\d+)\s+size:\s+([\d.]+)\s+x\s+([\d.]+)", result.stdout, re.MULTILINE):
+        sizes[int(match.group(1))] = (float(match.group(2)), float(match.group(3)))
+    return sizes
+
+def scanned_pages(pdf_path):
+    """Page numbers whose embedded image covers most of the page, i.e. scans.
+
+    Scanner apps add an OCR text layer to such pages, which passes is_usable_text
+    but is far worse than reading the page image, especially for handwriting.
+    """
+    sizes = page_sizes(pdf_path)
+    scanned = set()
+    for page, width, height, x_ppi, y_ppi in _list_images(pdf_path):
+        if page not in sizes or not x_ppi or not y_ppi:
+            continue
+        page_width, page_height = sizes[page]
+        # Image extent in points (72 per inch); area is unaffected by page rotation
+        image_area = (width / x_ppi * 72) * (height / y_ppi * 72)
+        if image_area >= SCANNED_PAGE_COVERAGE * page_width * page_height:
+            scanned.add(page)
+    return scanned
+
+def extract_page_figures(pdf_path, page_num, output_dir, max_side=768):
+    """Save the figure-sized embedded images of one page as small PNG crops"""
+    from PIL import Image
+
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.join(output_dir, f"page_{page_num}_img")
+    try:
+        subprocess.run(
+            ["pdfimages", "-png", "-f", str(page_num), "-l", str(page_num), pdf_path, prefix],
+            capture_output=True, timeout=60
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"DEBUG: pdfimages unavailable: {e}")
+        return []
+
+    crops = []
+    for name in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, name)
+        if not name.startswith(f"page_{page_num}_img"):
+            continue
+        with Image.open(path) as image:
+            if min(image.size) < MIN_FIGURE_SIDE:
+                os.remove(path)
+                continue
+            image.thumbnail((max_side, max_side))
+            image.save(path, "PNG", optimize=True)
+        crops.append(path)
+    return crops
+
+def format_question_text(text):
+    """Normalise a text-layer page into the "Question N:" format the pipeline expects.
+
+    Only numbers that continue the running sequence are promoted, so numbered
+    lists inside a question are left alone.
+    """
+    lines = []
+    expected = 1
+    number_pattern = re.compile(r'^\s*(?:Q(?:uestion)?\.?\s*)?(\d{1,2})\s*[.):]\s+(.*)$', re.IGNORECASE)
+
+    for raw_line in text.splitlines():
+        line = raw_line.rstrip()
+        match = number_pattern.match(line)
+        if match and int(match.group(1)) == expected:
+            line = f"Question {expected}: {match.group(2).strip()}"
+            expected += 1
+        lines.append(line)
+
+    formatted = "\n".join(lines)
+    return re.sub(r'\n{3,}', '\n\n', formatted).strip()
+
+def typed_page_items(pdf_path, output_dir, max_figure_side=512):
+    """Typed/tablet-exported pages as {"page", "text", "figures"} dicts keyed by page number.
+
+    Returns (items, total_pages); pages without a usable text layer, and scans whose
+    text layer is only OCR, are left out and must be rendered as images. total_pages
+    is 0 when no text tool is available.
+    """
+    page_texts = extract_page_texts(pdf_path)
+    figures = figure_pages(pdf_path) if page_texts else {}
+    scanned = scanned_pages(pdf_path) if page_texts else set()
+
+    items = {}
+    for page_num, text in enumerate(page_texts, 1):
+        if page_num in scanned or not is_usable_text(text):
+            continue
+        crops = extract_page_figures(pdf_path, page_num, output_dir, max_figure_side) if figures.get(page_num) else []
+        items[page_num] = {"page": page_num, "text": text.strip(), "figures": crops}
+    return items, len(page_texts)
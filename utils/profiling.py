@@ -0,0 +1,210 @@
+# utils/profiling.py - Opt-in CPU profile and stage timeline per workflow, saved next to its output
+import cProfile
+import contextvars
+import functools
+import html
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from utils import metrics
+
+# PROFILE_WORKFLOWS=on profiles every workflow; callers can also opt in per call
+PROFILE_ENABLED = os.getenv("PROFILE_WORKFLOWS", "off").lower() == "on"
+# Functions listed in the text report, by cumulative time
+PROFILE_TOP_FUNCTIONS = 40
+# Files written per workflow; "report" is the HTML page linked from the results page
+PROFILE_FILES = {
+    "stats": "_profile.prof",
+    "text": "_profile.txt",
+    "timeline": "_timeline.json",
+    "report": "_profile.html"
+}
+
+# Session of the workflow being profiled; copied into asyncio tasks and to_thread workers
+_current = contextvars.ContextVar("profile_session", default=None)
+
+class ProfileSession:
+    """Profilers and timeline of one workflow, written out as PROFILE_FILES under one stem"""
+
+    def __init__(self, name, output_folder):
+        self.name = name
+        self.output_folder = output_folder
+        self.started = time.perf_counter()
+        self.created = datetime.now().isoformat()
+        self.wall_seconds = None
+        self.profilers = []  # one per thread that ran workflow code
+        self.timeline = []
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def start_profiler(self):
+        """A running profiler for the calling thread, or None if another one already owns it"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows one active profiler per interpreter
+            print(f"DEBUG: CPU profile unavailable for {self.name}: {e}")
+            return None
+        with self._lock:
+            self.profilers.append(profiler)
+        return profiler
+
+    def stages(self):
+        """Timeline entries with start and end relative to the workflow start, in start order"""
+        stages = []
+        for event in self.timeline:
+            end = event["end"] - self.started
+            stages.append({
+                "stage": event["stage"],
+                "start": round(end - event["seconds"], 4),
+                "end": round(end, 4),
+                "seconds": event["seconds"],
+                "thread": event["thread"],
+                "labels": event["labels"]
+            })
+        return sorted(stages, key=lambda stage: stage["start"])
+
+    def save(self):
+        os.makedirs(self.output_folder, exist_ok=True)
+        paths = {kind: os.path.join(self.output_folder, f"{self.name}{suffix}") for kind, suffix in PROFILE_FILES.items()}
+
+        profile_text = "No CPU profile was captured."
+        if self.profilers:
+            buffer = io.StringIO()
+            stats = pstats.Stats(*self.profilers, stream=buffer)
+            stats.dump_stats(paths["stats"])
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            profile_text = buffer.getvalue()
+        else:
+            del paths["stats"]
+        with open(paths["text"], "w", encoding="utf-8") as f:
+            f.write(profile_text)
+
+        stages = self.stages()
+        totals = {}
+        for stage in stages:
+            summary = totals.setdefault(stage["stage"], {"count": 0, "total_seconds": 0.0})
+            summary["count"] += 1
+            summary["total_seconds"] = round(summary["total_seconds"] + stage["seconds"], 4)
+        timeline = {"name": self.name, "created": self.created, "wall_seconds": round(self.wall_seconds, 4),
+                    "totals": totals, "stages": stages}
+        with open(paths["timeline"], "w", encoding="utf-8") as f:
+            json.dump(timeline, f, indent=2, default=str)
+
+        with open(paths["report"], "w", encoding="utf-8") as f:
+            f.write(_render_report(timeline, profile_text, {kind: os.path.basename(path) for kind, path in paths.items()}))
+        self.files = {kind: os.path.basename(path) for kind, path in paths.items()}
+        print(f"🔬 Profile for {self.name}: {self.wall_seconds:.2f}s wall, {len(stages)} timed stages, "
+              f"report {paths['report']}")
+        return self.files
+
+def is_enabled(requested=None):
+    """requested (per call) wins over PROFILE_WORKFLOWS when given"""
+    return PROFILE_ENABLED if requested is None else bool(requested)
+
+def report_filename(stem):
+    return f"{stem}{PROFILE_FILES['report']}"
+
+@contextmanager
+def profile_workflow(name, output_folder, enabled=None):
+    """Profile the block and save the reports as output_folder/<name>_profile.*; yields the
+    session, or None when profiling is off.
+
+    The CPU profile covers the calling thread and functions wrapped with threaded(); the
+    timeline holds every stage recorded through utils.metrics, from any thread.
+    """
+    if not is_enabled(enabled):
+        yield None
+        return
+
+    session = ProfileSession(name, output_folder)
+    token = _current.set(session)
+    try:
+        with metrics.capture_timeline() as timeline:
+            session.timeline = timeline
+            profiler = session.start_profiler()
+            try:
+                yield session
+            finally:
+                if profiler:
+                    profiler.disable()
+    finally:
+        _current.reset(token)
+        session.wall_seconds = time.perf_counter() - session.started
+        try:
+            session.save()
+        except Exception as e:
+            print(f"⚠️ Could not save profile for {name}: {e}")
+
+def threaded(fn):
+    """Wrap fn before handing it to asyncio.to_thread so its CPU time joins the current profile"""
+    session = _current.get()
+    if session is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profiler = session.start_profiler()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+    return wrapper
+
+def _render_report(timeline, profile_text, files):
+    """Self-contained HTML page: stage bars on a shared time axis, per-stage totals, top functions"""
+    wall = timeline["wall_seconds"] or 1.0
+    rows = []
+    for stage in timeline["stages"]:
+        labels = ", ".join(f"{key}={value}" for key, value in stage["labels"].items())
+        left = stage["start"] / wall * 100
+        width = max(stage["seconds"] / wall * 100, 0.3)
+        rows.append(
+            f'<tr><td>{html.escape(stage["stage"])}</td><td class="num">{stage["start"]:.2f}s</td>'
+            f'<td class="num">{stage["seconds"]:.2f}s</td>'
+            f'<td class="track"><div class="bar" style="left:{left:.2f}%;width:{width:.2f}%"></div></td>'
+            f'<td class="labels">{html.escape(stage["thread"])} {html.escape(labels)}</td></tr>'
+        )
+    totals = "".join(
+        f'<tr><td>{html.escape(stage)}</td><td class="num">{summary["count"]}</td>'
+        f'<td class="num">{summary["total_seconds"]:.2f}s</td>'
+        f'<td class="num">{summary["total_seconds"] / wall * 100:.1f}%</td></tr>'
+        for stage, summary in sorted(timeline["totals"].items(), key=lambda item: -item[1]["total_seconds"])
+    )
+    downloads = " · ".join(f'<a href="{html.escape(name)}">{html.escape(name)}</a>'
+                           for kind, name in files.items() if kind != "report")
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>Profile: {html.escape(timeline["name"])}</title>
+    <style>
+        body {{ font-family: 'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; margin: 30px; color: #2d3748; }}
+        table {{ border-collapse: collapse; width: 100%; margin-bottom: 30px; font-size: 0.9rem; }}
+        td, th {{ padding: 4px 8px; border-bottom: 1px solid #e2e8f0; text-align: left; white-space: nowrap; }}
+        .num {{ text-align: right; }}
+        .track {{ position: relative; width: 50%; }}
+        .bar {{ position: absolute; top: 5px; height: 12px; background: #667eea; border-radius: 3px; }}
+        .labels {{ color: #718096; font-size: 0.8rem; }}
+        pre {{ background: #f7fafc; padding: 15px; overflow-x: auto; font-size: 0.8rem; }}
+    </style>
+</head>
+<body>
+    <h1>{html.escape(timeline["name"])}</h1>
+    <p>{timeline["wall_seconds"]:.2f}s wall clock, profiled {html.escape(timeline["created"])}. Files: {downloads}</p>
+    <h2>Stage timeline</h2>
+    <table><tr><th>Stage</th><th>Start</th><th>Duration</th><th>0 – {wall:.1f}s</th><th>Thread and labels</th></tr>
+    {"".join(rows)}</table>
+    <h2>Time per stage</h2>
+    <table><tr><th>Stage</th><th>Count</th><th>Total</th><th>Of wall clock</th></tr>{totals}</table>
+    <h2>CPU profile (top {PROFILE_TOP_FUNCTIONS} by cumulative time)</h2>
+    <pre>{html.escape(profile_text)}</pre>
+</body>
+</html>
+"""
@@ -0,0 +1,162 @@
+# utils/progress.py - Per-job progress events (stages and streamed tokens) for live UI updates
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Events kept per job so a late or reconnecting subscriber can catch up
+MAX_EVENTS_PER_JOB = 500
+# Finished jobs stay readable this long before they are dropped
+JOB_TTL_SECONDS = 600
+# Token progress is published at most this often per stream
+TOKEN_EVENT_INTERVAL_SECONDS = 0.5
+# A streamed response that goes quiet this long is treated as stalled
+STREAM_STALL_SECONDS = float(os.getenv("STREAM_STALL_SECONDS", 45))
+
+class JobProgress:
+    """Ordered event log of one job plus the streams currently producing tokens"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.events = deque(maxlen=MAX_EVENTS_PER_JOB)
+        self.next_id = 1
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self.streams = {}  # stream label -> last time it produced text
+        self.condition = threading.Condition()
+
+    def add(self, event_type, data):
+        with self.condition:
+            event = {"id": self.next_id, "type": event_type, "time": datetime.now().isoformat(), **data}
+            self.next_id += 1
+            self.events.append(event)
+            self.condition.notify_all()
+            return event
+
+    def since(self, last_id):
+        return [event for event in self.events if event["id"] > last_id]
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+# Set around a job's processing; copied into asyncio tasks and to_thread workers
+_current_job = contextvars.ContextVar("progress_job", default=None)
+
+def _prune(now):
+    for job_id, job in list(_jobs.items()):
+        # Also drop ids that were subscribed to but never processed
+        expired_at = job.finished_at or (None if job.events else job.created_at)
+        if expired_at and now - expired_at > JOB_TTL_SECONDS:
+            del _jobs[job_id]
+
+def get_job(job_id, create=False):
+    with _jobs_lock:
+        _prune(time.monotonic())
+        if create and job_id not in _jobs:
+            _jobs[job_id] = JobProgress(job_id)
+        return _jobs.get(job_id)
+
+def current_job_id():
+    return _current_job.get()
+
+def publish(event_type, job_id=None, **data):
+    """Add an event to the given job, or to the job bound to this context; no-op without one"""
+    job = get_job(job_id or _current_job.get())
+    return job.add(event_type, data) if job else None
+
+@contextmanager
+def track(job_id):
+    """Bind job_id to everything run inside the block and bracket it with started/done events"""
+    if not job_id:
+        yield None
+        return
+
+    job = get_job(job_id, create=True)
+    token = _current_job.set(job_id)
+    job.add("started", {})
+    status = "failed"
+    try:
+        yield job
+        status = "finished"
+    finally:
+        _current_job.reset(token)
+        job.add("done", {"status": status})
+        job.finished_at = time.monotonic()
+
+_stream_ids = itertools.count(1)
+
+class StreamProgress:
+    """Accumulates a streamed response and publishes throttled token counts for the current job"""
+
+    def __init__(self, provider, label):
+        self.provider = provider
+        # Numbered so parallel section streams of one job stay distinct
+        self.label = f"{provider}:{label}#{next(_stream_ids)}"
+        self.job = get_job(_current_job.get())
+        self.parts = []
+        self.chars = 0
+        self.last_publish = 0.0
+        self._touch()
+        if self.job:
+            self.job.add("stream_start", {"provider": provider, "stream": self.label})
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def _touch(self):
+        if self.job:
+            with self.job.condition:
+                self.job.streams[self.label] = time.monotonic()
+
+    def add(self, text):
+        if not text:
+            return
+        self.parts.append(text)
+        self.chars += len(text)
+        self._touch()
+        now = time.monotonic()
+        if self.job and now - self.last_publish >= TOKEN_EVENT_INTERVAL_SECONDS:
+            self.last_publish = now
+            # Roughly four characters per token, as in the rate limiter's estimate
+            self.job.add("tokens", {"stream": self.label, "chars": self.chars, "tokens": self.chars // 4})
+
+    def finish(self, finish_reason=None):
+        if self.job:
+            with self.job.condition:
+                self.job.streams.pop(self.label, None)
+            self.job.add("stream_end", {"stream": self.label, "chars": self.chars, "tokens": self.chars // 4,
+                                        "finish_reason": finish_reason})
+
+def subscribe(job_id, last_id=0, heartbeat_seconds=15.0):
+    """Yield a job's events after last_id as they arrive, until its "done" event.
+
+    Yields None when nothing happened for heartbeat_seconds so the caller can keep
+    the connection alive, and a synthetic "stalled" event when an active stream has
+    produced nothing for STREAM_STALL_SECONDS.
+    """
+    job = get_job(job_id, create=True)
+    reported_stalls = set()
+    while True:
+        with job.condition:
+            events = job.since(last_id)
+            if not events:
+                job.condition.wait(heartbeat_seconds)
+                events = job.since(last_id)
+            now = time.monotonic()
+            stalled = [label for label, last in job.streams.items()
+                       if now - last > STREAM_STALL_SECONDS and label not in reported_stalls]
+
+        for event in events:
+            last_id = event["id"]
+            yield event
+            if event["type"] == "done":
+                return
+        for label in stalled:
+            reported_stalls.add(label)
+            yield {"id": last_id, "type": "stalled", "stream": label, "seconds": STREAM_STALL_SECONDS}
+        if not events and not stalled:
+            yield None
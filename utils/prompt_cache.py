@@ -0,0 +1,103 @@
+# utils/prompt_cache.py - Provider-side caching of the shared prompt prefix (instructions + question paper)
+import datetime
+import hashlib
+import os
+import threading
+import time
+from utils.clients import GEMINI_MODEL, configure_gemini
+from utils.rate_limit import call_with_rate_limit, estimate_tokens
+from utils import replay
+
+# Long enough to cover a class batch; entries are recreated after expiry
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", 3600))
+# Gemini rejects cached contents below a model-specific minimum size
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", 4096))
+# Stop using a local entry a little before the provider drops it
+EXPIRY_MARGIN_SECONDS = 60
+# OpenAI caches prompt prefixes of at least this many tokens automatically
+OPENAI_CACHE_MIN_TOKENS = 1024
+# Registration errors that will not go away on retry: the model cannot cache at all,
+# or this prefix is below the model's minimum. Anything else is retried on the next call.
+UNSUPPORTED_ERROR_MARKERS = ("not supported", "unsupported", "not found for api version")
+TOO_SMALL_ERROR_MARKERS = ("too small", "min_total_token_count")
+
+_cached_models = {}
+_unsupported_models = set()
+_too_small_keys = set()
+_key_locks = {}
+_registry_lock = threading.Lock()
+
+def context_key(context):
+    """Short stable identifier for a prompt prefix"""
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+
+def get_gemini_cached_model(context, model_name=GEMINI_MODEL):
+    """GenerativeModel bound to a provider-side cache of context.
+
+    The first student of a batch registers the context; later calls reuse it
+    until the TTL runs out. Returns None when the context is too small or the
+    model does not support caching, and callers then send the context inline.
+    """
+    if not context or len(context) // 4 < GEMINI_CACHE_MIN_TOKENS:
+        return None
+    # Recorded requests must carry the full prompt, and replay runs offline
+    if replay.active():
+        return None
+
+    key = (model_name, context_key(context))
+    with _registry_lock:
+        if model_name in _unsupported_models or key in _too_small_keys:
+            return None
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    # Concurrent students with the same paper wait for one registration
+    with key_lock:
+        entry = _cached_models.get(key)
+        if entry and entry["expires_at"] > time.monotonic():
+            return entry["model"]
+
+        try:
+            import google.generativeai as genai
+            from google.generativeai import caching
+
+            configure_gemini()
+            cached_content = call_with_rate_limit(
+                "gemini",
+                lambda: caching.CachedContent.create(
+                    model=model_name,
+                    display_name=f"question-paper-{key[1]}",
+                    contents=[context],
+                    ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_SECONDS)
+                ),
+                estimate_tokens(len(context))
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        except Exception as e:
+            message = str(e).lower()
+            if any(marker in message for marker in UNSUPPORTED_ERROR_MARKERS):
+                print(f"DEBUG: Gemini context caching unsupported for {model_name}, sending prompts inline: {e}")
+                with _registry_lock:
+                    _unsupported_models.add(model_name)
+            elif any(marker in message for marker in TOO_SMALL_ERROR_MARKERS):
+                print(f"DEBUG: Prompt prefix {key[1]} too small to cache, sending it inline: {e}")
+                with _registry_lock:
+                    _too_small_keys.add(key)
+            else:
+                print(f"DEBUG: Gemini context cache registration failed, sending prompt inline this time: {e}")
+            return None
+
+        _cached_models[key] = {
+            "model": model,
+            "expires_at": time.monotonic() + GEMINI_CACHE_TTL_SECONDS - EXPIRY_MARGIN_SECONDS
+        }
+        print(f"DEBUG: Registered Gemini context cache {key[1]} ({len(context)} chars)")
+        return model
+
+def prefix_cacheable(context, provider, model_name=GEMINI_MODEL):
+    """True when the provider will serve context from its cache, so repeating it is cheap.
+
+    For Gemini this registers the context if needed; OpenAI caches long prefixes itself.
+    """
+    if provider == "gemini":
+        return get_gemini_cached_model(context, model_name) is not None
+    return bool(context) and len(context) // 4 >= OPENAI_CACHE_MIN_TOKENS
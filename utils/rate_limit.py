@@ -0,0 +1,153 @@
+# utils/rate_limit.py - Shared per-provider request/token budgets with 429-aware backoff
+import os
+import random
+import threading
+import time
+from utils.concurrency import get_concurrency_limiter, is_timeout_error
+from utils.resilience import get_circuit_breaker, is_provider_failure
+
+# Per-minute quotas; override with e.g. OPENAI_RPM / OPENAI_TPM in .env
+DEFAULT_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 30000},
+    "gemini": {"rpm": 10, "tpm": 4000000}
+}
+# Rough token cost of one page image sent to a vision model
+TOKENS_PER_IMAGE = 1100
+MAX_ATTEMPTS = 5
+BASE_DELAY_SECONDS = 1.0
+MAX_DELAY_SECONDS = 60.0
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at capacity-per-minute"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available (0 if it is available now)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class ProviderRateLimiter:
+    """Budgets requests per minute and tokens per minute for one provider"""
+
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, estimated_tokens):
+        """Block until one request and estimated_tokens fit in the budget"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = max(
+                    self.blocked_until - now,
+                    self.requests.wait_time(1, now),
+                    self.tokens.wait_time(estimated_tokens, now)
+                )
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    return
+            time.sleep(min(wait, 5.0))
+
+    def block_for(self, seconds):
+        """Pause every caller of this provider, e.g. after a 429 with Retry-After"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(provider):
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = DEFAULT_LIMITS.get(provider, {"rpm": 60, "tpm": 100000})
+            rpm = int(os.getenv(f"{provider.upper()}_RPM", limits["rpm"]))
+            tpm = int(os.getenv(f"{provider.upper()}_TPM", limits["tpm"]))
+            _limiters[provider] = ProviderRateLimiter(provider, rpm, tpm)
+        return _limiters[provider]
+
+def estimate_tokens(text_chars=0, images=0, max_output_tokens=0):
+    """Approximate tokens a request counts against TPM (input plus reserved output)"""
+    return text_chars // 4 + images * TOKENS_PER_IMAGE + max_output_tokens
+
+def is_rate_limit_error(error):
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if status == 429:
+        return True
+    return type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+def retry_after_seconds(error):
+    """Retry-After from the provider response, if it sent one"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Jittered exponential delay, never shorter than the server's Retry-After"""
+    ceiling = min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * (2 ** attempt))
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    return max(delay, retry_after or 0.0)
+
+def call_with_rate_limit(provider, fn, estimated_tokens=0):
+    """Run a provider call inside its rate budget, concurrency window and
+    circuit breaker, retrying 429s with backoff.
+
+    Other errors are raised immediately so callers keep their own fallbacks;
+    while the provider's breaker is open, CircuitOpenError is raised without a call.
+    """
+    limiter = get_limiter(provider)
+    concurrency = get_concurrency_limiter(provider)
+    breaker = get_circuit_breaker(provider)
+
+    for attempt in range(MAX_ATTEMPTS):
+        breaker.before_call()
+        limiter.acquire(estimated_tokens)
+        concurrency.acquire()
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            result = fn()
+            outcome = "ok"
+            breaker.record_success()
+            return result
+        except Exception as e:
+            if is_rate_limit_error(e):
+                outcome = "throttled"
+            elif is_timeout_error(e):
+                outcome = "timeout"
+            # A throttled or rejected request still shows the provider is up
+            if outcome != "throttled" and is_provider_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if outcome != "throttled" or attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt, retry_after_seconds(e))
+            print(f"DEBUG: {provider} rate limited (attempt {attempt + 1}), backing off {delay:.1f}s")
+            limiter.block_for(delay)
+        finally:
+            # Latency and outcome drive the AIMD concurrency window
+            concurrency.release(time.monotonic() - start, outcome)
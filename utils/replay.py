@@ -0,0 +1,214 @@
+# utils/replay.py - Record provider responses to disk and replay them offline with simulated latency
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from utils import metrics
+from utils.progress import StreamProgress
+
+# "off" calls providers, "record" calls them and saves every response, "replay" serves saved ones,
+# "stub" serves saved ones where they exist and canned documents otherwise (for load tests)
+REPLAY_MODES = ("off", "record", "replay", "stub")
+# Simulated latency in replay: "recorded" (what the live call took) or a fixed number of seconds
+DEFAULT_LATENCY = "recorded"
+# Replayed streams are published in this many chunks so progress events look like live ones
+REPLAY_STREAM_CHUNKS = 8
+# "Recorded" latency of canned stub responses
+STUB_LATENCY_SECONDS = float(os.getenv("PROVIDER_STUB_LATENCY", 3.0))
+
+STUB_QUESTION_TEXT = """Question 1: Define a social network and explain the role of nodes and edges. [5 marks]
+(a) Give one example of a directed network.
+(b) Give one example of an undirected network.
+
+Question 2: Compute the degree centrality of every node in the graph shown. [10 marks]
+
+Question 3: Which of the following measures captures brokerage between communities? [2 marks]
+A. Degree centrality
+B. Betweenness centrality
+C. Closeness centrality
+D. Eigenvector centrality"""
+
+STUB_ANSWER_LATEX = """\\documentclass[12pt]{article}
+\\usepackage{amsmath, amssymb, geometry}
+\\geometry{margin=1in}
+\\begin{document}
+\\title{Student Answer Sheet Analysis}
+\\maketitle
+\\section*{Questions and Student Responses}
+\\subsection*{Question 1}
+\\textbf{Question:} Define a social network.
+
+\\textbf{Student Answer:}
+\\begin{quote}
+A social network is a set of actors (nodes) joined by relationships (edges).
+\\end{quote}
+\\subsection*{Question 2}
+\\textbf{Student Answer:}
+\\begin{quote}
+The degree centrality of node $A$ is $\\frac{3}{4}$.
+\\end{quote}
+\\end{document}"""
+
+_settings = {
+    "mode": os.getenv("PROVIDER_REPLAY", "off"),
+    "directory": os.getenv("PROVIDER_REPLAY_DIR", os.path.join("benchmarks", "recordings")),
+    "latency": os.getenv("PROVIDER_REPLAY_LATENCY", DEFAULT_LATENCY),
+    "scale": float(os.getenv("PROVIDER_REPLAY_LATENCY_SCALE", 1.0)),
+    "jitter": float(os.getenv("PROVIDER_REPLAY_JITTER", 0.0))
+}
+_write_lock = threading.Lock()
+
+class ReplayMissError(Exception):
+    """Raised in replay mode for a request that was never recorded"""
+
+    def __init__(self, provider, key):
+        super().__init__(f"No recorded {provider} response for request {key[:12]}; record it first")
+        self.provider = provider
+        self.key = key
+
+def configure(mode=None, directory=None, latency=None, scale=None, jitter=None):
+    """Override the environment settings, e.g. from a benchmark's command line"""
+    updates = {"mode": mode, "directory": directory, "latency": latency, "scale": scale, "jitter": jitter}
+    _settings.update({name: value for name, value in updates.items() if value is not None})
+    if _settings["mode"] not in REPLAY_MODES:
+        raise ValueError(f"Unknown replay mode {_settings['mode']!r}, expected one of {REPLAY_MODES}")
+    return dict(_settings)
+
+def mode():
+    return _settings["mode"]
+
+def offline():
+    """True when no request reaches a provider, so no API keys are needed"""
+    return _settings["mode"] in ("replay", "stub")
+
+def active():
+    """True when responses are recorded or replayed; provider-side prompt caches are bypassed then"""
+    return _settings["mode"] != "off"
+
+def _digest_part(part, digest):
+    if isinstance(part, (str, bytes)):
+        digest.update(part.encode("utf-8") if isinstance(part, str) else part)
+    elif isinstance(part, dict):
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+    elif hasattr(part, "tobytes"):
+        # PIL images: pixels, size and mode identify the page
+        digest.update(f"{getattr(part, 'mode', '')}{getattr(part, 'size', '')}".encode("utf-8"))
+        digest.update(part.tobytes())
+    else:
+        digest.update(repr(part).encode("utf-8"))
+
+def request_key(provider, parts, **params):
+    """Stable hash of a request: provider, every prompt part (text and images) and the call parameters"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"provider": provider, **params}, sort_keys=True, default=str).encode("utf-8"))
+    for part in parts:
+        _digest_part(part, digest)
+    return digest.hexdigest()
+
+def _recording_path(provider, key):
+    return os.path.join(_settings["directory"], provider, key[:2], f"{key}.json")
+
+def _openai_fields(response):
+    choice = response.choices[0]
+    return choice.message.content or "", choice.finish_reason
+
+def _openai_response(text, finish_reason):
+    message = SimpleNamespace(content=text)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason=finish_reason)])
+
+def _gemini_fields(response):
+    try:
+        reason = response.candidates[0].finish_reason
+        reason = getattr(reason, "name", reason)
+    except (AttributeError, IndexError):
+        reason = None
+    return response.text, reason
+
+def _gemini_response(text, finish_reason):
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(finish_reason=finish_reason)])
+
+# How to read a provider response and how to rebuild one shaped like it
+_ADAPTERS = {
+    "openai": (_openai_fields, _openai_response),
+    "gemini": (_gemini_fields, _gemini_response)
+}
+
+def _replay_latency(key, recorded_seconds):
+    latency = _settings["latency"]
+    seconds = recorded_seconds if latency == "recorded" else float(latency)
+    seconds *= _settings["scale"]
+    if _settings["jitter"]:
+        # Seeded per request so every benchmark run sleeps the same amounts
+        seconds *= 1 + random.Random(key).uniform(-_settings["jitter"], _settings["jitter"])
+    return max(0.0, seconds)
+
+def _stub_entry(provider, stream_label):
+    text = STUB_QUESTION_TEXT if stream_label == "questions" else STUB_ANSWER_LATEX
+    return {"text": text, "finish_reason": "stop" if provider == "openai" else "STOP", "seconds": STUB_LATENCY_SECONDS}
+
+def _replay(provider, key, stream_label):
+    path = _recording_path(provider, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        if _settings["mode"] != "stub":
+            raise ReplayMissError(provider, key)
+        entry = _stub_entry(provider, stream_label)
+
+    text, finish_reason = entry["text"], entry.get("finish_reason")
+    delay = _replay_latency(key, entry.get("seconds", 0.0))
+    if stream_label:
+        # Spread the text over the simulated latency like a live stream
+        stream = StreamProgress(provider, stream_label)
+        step = max(1, len(text) // REPLAY_STREAM_CHUNKS)
+        chunks = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+        for chunk in chunks:
+            time.sleep(delay / len(chunks))
+            stream.add(chunk)
+        stream.finish(finish_reason)
+    else:
+        time.sleep(delay)
+    return _ADAPTERS[provider][1](text, finish_reason)
+
+def _record(provider, key, response, seconds, params):
+    text, finish_reason = _ADAPTERS[provider][0](response)
+    path = _recording_path(provider, key)
+    entry = {
+        "provider": provider,
+        "key": key,
+        "text": text,
+        "finish_reason": finish_reason,
+        "seconds": round(seconds, 3),
+        "params": params,
+        "recorded": datetime.now().isoformat()
+    }
+    with _write_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, indent=2)
+        os.replace(tmp_path, path)
+
+def call(provider, live, parts, stream_label=None, **params):
+    """Run one provider request through the current mode and time it as the "provider" stage.
+
+    live performs the real request; parts and params identify it for recording. Replayed
+    responses expose the same fields the callers read from live ones.
+    """
+    current = _settings["mode"]
+    key = request_key(provider, parts, **params) if current != "off" else None
+    start = time.perf_counter()
+    try:
+        if current in ("replay", "stub"):
+            return _replay(provider, key, stream_label)
+        response = live()
+        if current == "record":
+            _record(provider, key, response, time.perf_counter() - start, params)
+        return response
+    finally:
+        metrics.record_timing("provider", time.perf_counter() - start, provider=provider, mode=current)
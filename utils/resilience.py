@@ -0,0 +1,155 @@
+# utils/resilience.py - Per-workflow retry budget and per-provider circuit breakers
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from utils import metrics
+from utils.concurrency import is_timeout_error
+
+# Extra attempts (agent retries, model switches, re-renders, simplified prompts,
+# page-by-page fallbacks) one workflow may spend across every layer combined
+DEFAULT_RETRY_BUDGET = int(os.getenv("RETRY_BUDGET", 4))
+# Consecutive provider failures that open a breaker, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+# Exception types (by name, so no SDK import is needed) that mean the provider is down or unreachable
+PROVIDER_FAILURE_ERRORS = {
+    "APIConnectionError", "InternalServerError",  # openai
+    "ServiceUnavailable", "BadGateway", "GatewayTimeout", "ServerError",  # google.api_core
+    "ConnectError", "RemoteProtocolError", "ReadError", "WriteError", "NetworkError"  # httpx
+}
+
+class RetryBudget:
+    """Count of extra attempts left for one workflow, shared by every retry site in it"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.spent = []
+        self.lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        return max(0, self.limit - len(self.spent))
+
+    def spend(self, label):
+        with self.lock:
+            if len(self.spent) >= self.limit:
+                print(f"DEBUG: Retry budget exhausted, skipping {label} (spent on {', '.join(self.spent)})")
+                return False
+            self.spent.append(label)
+            print(f"DEBUG: Retry budget {len(self.spent)}/{self.limit} spent on {label}")
+            return True
+
+# Copied into asyncio tasks and asyncio.to_thread workers, so nested layers see the same budget
+_current_budget = contextvars.ContextVar("retry_budget", default=None)
+
+@contextmanager
+def retry_budget(limit=None):
+    """Scope a retry budget around one workflow; a nested scope reuses the outer budget"""
+    existing = _current_budget.get()
+    if existing is not None:
+        yield existing
+        return
+
+    budget = RetryBudget(DEFAULT_RETRY_BUDGET if limit is None else limit)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+def retry_allowed(label):
+    """Spend one retry from the current workflow's budget; unlimited outside a workflow"""
+    budget = _current_budget.get()
+    return budget is None or budget.spend(label)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose breaker is open"""
+
+    def __init__(self, provider, retry_in):
+        super().__init__(f"{provider} circuit open after repeated failures, retrying in {retry_in:.0f}s")
+        self.provider = provider
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """Fails fast while a provider is down.
+
+    closed: calls pass; failure_threshold consecutive failures open the breaker.
+    open: calls raise CircuitOpenError until reset_seconds have passed.
+    half_open: one probe call passes; success closes the breaker, failure reopens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        self._publish()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                print(f"DEBUG: {self.name} circuit half-open, sending a probe request")
+                return
+            raise CircuitOpenError(self.name, max(0.0, self.reset_seconds - (now - self.opened_at)))
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                print(f"DEBUG: {self.name} circuit closed, provider recovered")
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+            self._publish()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"DEBUG: {self.name} circuit open after {self.failures} failures, "
+                          f"failing fast for {self.reset_seconds:.0f}s")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+            self._publish()
+
+    def _publish(self):
+        metrics.set_gauge(f"{self.name}_circuit_open", int(self.state != "closed"))
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider):
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        return _breakers[provider]
+
+def is_provider_failure(error):
+    """Errors that suggest the provider is unhealthy: 5xx and 408 responses, timeouts and
+    connection errors from the provider SDKs or their HTTP client.
+
+    Client errors such as bad requests say nothing about the provider's health, and
+    neither do errors raised by our own code (KeyError, TypeError, ...) around the call.
+    Throttling is handled separately by the rate limiter and concurrency window.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)) or is_timeout_error(error):
+        return True
+    if type(error).__name__ in PROVIDER_FAILURE_ERRORS:
+        return True
+    # Only provider and HTTP errors carry a response status
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return isinstance(status, int) and not isinstance(status, bool) and (status >= 500 or status == 408)
@@ -0,0 +1,61 @@
+# utils/result_cache.py - On-disk cache of answer extraction outputs
+import json
+import os
+import threading
+from datetime import datetime
+from utils.hashing import file_sha256, text_sha256
+
+CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join("cache", "answers"))
+# RESULT_CACHE=off disables reads and writes, e.g. so a load test never short-circuits the pipeline
+CACHE_ENABLED = os.getenv("RESULT_CACHE", "on").lower() != "off"
+# Bump whenever answer prompts or post-processing change so old outputs are not reused
+PROMPT_VERSION = "answers-v3"
+# Text both providers put in their fallback documents; those are never cached
+PROVIDER_FALLBACK_MARKER = "encountered difficulties"
+
+def answer_cache_key(pdf_path, question_text, model, pipeline, prompt_version=PROMPT_VERSION):
+    """Key from the script's content, the question text, model, pipeline and prompt version"""
+    parts = [file_sha256(pdf_path), text_sha256(question_text), model, pipeline, prompt_version]
+    return text_sha256("|".join(parts))
+
+def is_cacheable(latex_output):
+    return bool(latex_output) and PROVIDER_FALLBACK_MARKER not in latex_output
+
+def _entry_path(key):
+    # Two-level fan-out keeps directories small for a whole term of scripts
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.json")
+
+def load_answer(key):
+    """Cached entry ({"latex_output", "model", ...}) or None"""
+    if not CACHE_ENABLED:
+        return None
+    path = _entry_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"DEBUG: Ignoring unreadable cache entry {path}: {e}")
+        return None
+
+    print(f"DEBUG: Answer cache hit {key[:12]} ({entry.get('model')}, {entry.get('created')})")
+    return entry
+
+def store_answer(key, latex_output, **meta):
+    """Write an entry atomically so a concurrent reader never sees a partial file"""
+    if not CACHE_ENABLED or not is_cacheable(latex_output):
+        return False
+
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {"latex_output": latex_output, "prompt_version": PROMPT_VERSION, "created": datetime.now().isoformat(), **meta}
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"DEBUG: Could not write answer cache entry: {e}")
+        return False
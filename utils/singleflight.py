@@ -0,0 +1,50 @@
+# utils/singleflight.py - Coalesce identical in-flight work across request threads
+import threading
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Run fn once per key at a time; concurrent callers with the same key share its result.
+
+    Nothing is remembered after the call finishes, so this complements a cache
+    rather than replacing one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            print(f"DEBUG: {self.name}: joining in-flight call for {key}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            if call.waiters:
+                print(f"DEBUG: {self.name}: shared result with {call.waiters} waiting caller(s)")
+            call.done.set()
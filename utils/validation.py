@@ -0,0 +1,219 @@
+# utils/validation.py - Single-pass validation of extracted question text and answer LaTeX
+import re
+import time
+from functools import lru_cache
+from utils import metrics
+
+# Extracted question text shorter than this is treated as a failed extraction
+MIN_QUESTION_CHARS = 100
+# Below this many characters per page a multi-page extraction probably missed pages
+MIN_CHARS_PER_PAGE = 150
+# Per-page content above this raises confidence
+RICH_CHARS_PER_PAGE = 500
+# Answer documents need this much output and this much body between begin/end document
+MIN_LATEX_CHARS = 100
+MIN_LATEX_BODY_CHARS = 50
+# Texts whose scan results are kept; the same text is validated by the provider helper and the agent
+SCAN_CACHE_SIZE = 64
+
+# Every question signal in one alternation, so a text is scanned once
+_QUESTION_RE = re.compile(r"""
+    (?P<heading>^[ \t]*Question\s+(?P<number>\d+)\s*[:.]?)
+  | (?P<question>Question\s+\d+)
+  | (?P<marks>\[\d+(?:\s*marks?)?\]|\(\d+\s*marks?\))
+  | (?P<mcq>(?-i:[A-D]\.\s))
+  | (?P<none>NO\s+QUESTIONS\s+FOUND)
+  | (?P<page>PAGE)
+  | (?P<cue>Q\d+|^\d+[.:]\s|\(\w\)|\d+\)|Consider|Which|What|How|Explain)
+""", re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+
+# Required answer-document markers plus the provider fallback notice, also in one alternation
+_LATEX_RE = re.compile(r"""
+    (?P<documentclass>\\documentclass)
+  | (?P<begin>\\begin\{document\})
+  | (?P<end>\\end\{document\})
+  | (?P<title>\\title\{)
+  | (?P<maketitle>\\maketitle)
+  | (?P<fallback>encountered\ difficulties)
+""", re.VERBOSE)
+
+LATEX_REQUIRED = {
+    "documentclass": "\\documentclass",
+    "begin": "\\begin{document}",
+    "end": "\\end{document}"
+}
+LATEX_TITLE = {"title": "\\title{", "maketitle": "\\maketitle"}
+
+@lru_cache(maxsize=SCAN_CACHE_SIZE)
+def _scan_questions(text):
+    counts = {"question": 0, "marks": 0, "mcq": 0, "none": 0, "page": 0, "cue": 0}
+    headings = []
+    for match in _QUESTION_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == "heading":
+            headings.append((match.group("number"), match.start()))
+            kind = "question"
+        counts[kind] += 1
+    return {
+        "chars": len(text),
+        "question_count": counts["question"],
+        "headings": tuple(headings),
+        "has_marks": counts["marks"] > 0,
+        "mcq_options": counts["mcq"],
+        "no_questions_found": counts["none"] > 0,
+        "page_markers": counts["page"] > 0,
+        # Question headings count as cues too
+        "has_question_cues": counts["cue"] + counts["question"] > 0
+    }
+
+def scan_questions(text):
+    """All question-text signals from one pass: counts, marks, MCQ options, headings"""
+    return dict(_scan_questions(text or ""))
+
+def question_blocks(text):
+    """Question text split into blocks keyed by question number, from the scan's headings"""
+    headings = scan_questions(text)["headings"]
+    blocks = {}
+    for i, (number, start) in enumerate(headings):
+        end = headings[i + 1][1] if i + 1 < len(headings) else len(text)
+        # Keep the first occurrence if page-by-page extraction repeated a number
+        blocks.setdefault(number, text[start:end].strip())
+    return blocks
+
+def validate_questions(text, num_pages=1):
+    """Validate extracted question text.
+
+    is_valid: the text is long enough and not a "no questions" reply; should_retry: another
+    model or prompt is worth trying (also set, with low confidence, when no question cue
+    is found); complete: the paper looks fully covered (question cues, and on multi-page
+    papers enough text per page and at least two questions), used to decide on
+    page-by-page fallbacks.
+    confidence combines the signals as the question extractor always has.
+    """
+    start = time.perf_counter()
+    try:
+        return _validate_questions(text or "", num_pages)
+    finally:
+        metrics.record_timing("validation", time.perf_counter() - start, kind="questions")
+
+def _validate_questions(text, num_pages):
+    signals = scan_questions(text)
+    validation = {
+        "is_valid": True,
+        "should_retry": False,
+        "complete": True,
+        "confidence": 0.9,
+        "issues": [],
+        "pages_processed": num_pages,
+        **signals
+    }
+    del validation["headings"]
+
+    if len(text.strip()) < MIN_QUESTION_CHARS:
+        validation.update(is_valid=False, should_retry=True, complete=False, confidence=0.1)
+        validation["issues"].append("Extracted text too short")
+        return validation
+
+    if signals["no_questions_found"]:
+        validation.update(is_valid=False, should_retry=True, complete=False, confidence=0.0)
+        validation["issues"].append("No questions detected")
+        return validation
+
+    if not signals["has_question_cues"]:
+        # Still valid, as the extractor always treated it: low confidence and worth a retry
+        validation.update(should_retry=True, complete=False)
+        validation["confidence"] *= 0.3
+        validation["issues"].append("No clear question patterns found")
+
+    if num_pages > 1:
+        if len(text) < num_pages * MIN_CHARS_PER_PAGE:
+            validation["complete"] = False
+            validation["confidence"] *= 0.6
+            validation["issues"].append(f"Content seems short for {num_pages} pages")
+        if signals["question_count"] < 2:
+            validation["complete"] = False
+            validation["confidence"] *= 0.7
+            validation["issues"].append(f"Only {signals['question_count']} questions found across {num_pages} pages")
+
+    # Mark allocations are a good indicator of real questions
+    if signals["has_marks"]:
+        validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
+    else:
+        validation["confidence"] *= 0.8
+        validation["issues"].append("No mark allocations found")
+
+    # At least one complete MCQ
+    if signals["mcq_options"] >= 4:
+        validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
+
+    if signals["page_markers"] and num_pages > 1:
+        validation["confidence"] = min(validation["confidence"] + 0.05, 1.0)
+        validation["issues"].append("Page-by-page extraction detected")
+
+    if len(text) / max(num_pages, 1) > RICH_CHARS_PER_PAGE:
+        validation["confidence"] = min(validation["confidence"] + 0.1, 1.0)
+
+    return validation
+
+@lru_cache(maxsize=SCAN_CACHE_SIZE)
+def _scan_latex(latex):
+    found = {}
+    body_chars = None
+    for match in _LATEX_RE.finditer(latex):
+        kind = match.lastgroup
+        if kind == "end" and body_chars is None and "begin" in found:
+            body_chars = len(latex[found["begin"].end():match.start()].strip())
+        found.setdefault(kind, match)
+    return {
+        "chars": len(latex),
+        "missing": tuple(marker for name, marker in {**LATEX_REQUIRED, **LATEX_TITLE}.items() if name not in found),
+        "body_chars": body_chars,
+        "fallback_document": "fallback" in found
+    }
+
+def scan_latex(latex):
+    """All answer-document signals from one pass: missing markers, body size, fallback notice"""
+    signals = dict(_scan_latex(latex or ""))
+    signals["missing"] = list(signals["missing"])
+    return signals
+
+def validate_latex(latex):
+    """Validate an answer LaTeX document.
+
+    is_valid requires \\documentclass, \\begin{document}, \\end{document} and some body;
+    missing also lists an absent \\title or \\maketitle, which the provider helpers require.
+    """
+    start = time.perf_counter()
+    try:
+        return _validate_latex(latex or "")
+    finally:
+        metrics.record_timing("validation", time.perf_counter() - start, kind="latex")
+
+def _validate_latex(latex):
+    signals = scan_latex(latex)
+    validation = {
+        "is_valid": True,
+        "should_retry": False,
+        "confidence": 0.9,
+        "issues": [],
+        **signals
+    }
+
+    if len(latex.strip()) < MIN_LATEX_CHARS:
+        validation.update(is_valid=False, should_retry=True, confidence=0.1)
+        validation["issues"].append("Output too short")
+        return validation
+
+    for marker in LATEX_REQUIRED.values():
+        if marker in signals["missing"]:
+            validation.update(is_valid=False, confidence=0.3)
+            validation["issues"].append(f"Missing {marker}")
+
+    if signals["body_chars"] is None:
+        validation.update(is_valid=False, confidence=0.2)
+        validation["issues"].append("Cannot find document content")
+    elif signals["body_chars"] < MIN_LATEX_BODY_CHARS:
+        validation.update(is_valid=False, confidence=0.4)
+        validation["issues"].append("Insufficient content in document")
+
+    return validation